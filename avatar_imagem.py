@@ -0,0 +1,64 @@
+# avatar_imagem.py
+# Transformação das fotos de perfil (CPU pura, sem Flask/banco).
+# Fica fora do main.py porque roda nos processos do pool de imagens: o worker
+# importa só este módulo + Pillow, e não o app inteiro.
+
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+import os
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+AVATAR_TAMANHOS = (64, 128, 400)
+AVATAR_JPEG_LADO = 400
+AVATAR_WEBP_QUALIDADE = int(os.getenv("AVATAR_WEBP_QUALIDADE", "80"))
+AVATAR_JPEG_QUALIDADE = int(os.getenv("AVATAR_JPEG_QUALIDADE", "82"))
+AVATAR_FORMATOS = {"JPEG", "MPO", "PNG", "WEBP", "GIF"}
+
+
+def validar(dados: bytes) -> str:
+    """Só lê o cabeçalho (sem decodificar pixels). Devolve o formato ou levanta ValueError."""
+    img = Image.open(BytesIO(dados))
+    if img.format not in AVATAR_FORMATOS:
+        raise ValueError(f"formato não suportado: {img.format}")
+    return img.format
+
+
+def transformar(dados: bytes) -> dict:
+    """bytes da imagem enviada -> {"400.webp": b"...", ..., "400.jpg": b"..."}."""
+    img = Image.open(BytesIO(dados))
+    img.draft("RGB", (AVATAR_JPEG_LADO * 2, AVATAR_JPEG_LADO * 2))  # JPEG: decodifica já reduzido
+    img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        fundo = Image.new("RGB", img.size, (255, 255, 255))
+        fundo.paste(img, mask=img.getchannel("A"))
+        img = fundo
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    lado = min(img.size)
+    left, top = (img.width - lado) // 2, (img.height - lado) // 2
+    img = img.crop((left, top, left + lado, top + lado))
+
+    saidas = {}
+    atual = img
+    for t in sorted(AVATAR_TAMANHOS, reverse=True):  # cada tamanho reduz do anterior
+        if atual.width != t:
+            atual = atual.resize((t, t), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        buf = BytesIO()
+        atual.save(buf, "WEBP", quality=AVATAR_WEBP_QUALIDADE, method=4)
+        saidas[f"{t}.webp"] = buf.getvalue()
+        if t == AVATAR_JPEG_LADO:
+            buf = BytesIO()
+            atual.save(buf, "JPEG", quality=AVATAR_JPEG_QUALIDADE, optimize=True, progressive=True)
+            saidas[f"{t}.jpg"] = buf.getvalue()
+    return saidas
+
+
+def transformar_arquivo(caminho: str) -> dict:
+    """Entrada do pool: lê o original do disco (evita mandar os bytes pelo pipe)."""
+    with open(caminho, "rb") as f:
+        return transformar(f.read())
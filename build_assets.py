@@ -0,0 +1,98 @@
+# build_assets.py
+# ------------------------------------------------------------
+# Gera static/dist/ com os estáticos "fingerprintados":
+#   - style.css -> style.<hash>.css (hash do conteúdo, então nunca muda)
+#   - irmãos .gz e .br quando comprimir vale a pena (CSS/JS/SVG/ICO;
+#     PNG/JPG já vêm comprimidos e ficam sem)
+#   - manifest.json: nome original -> arquivo gerado + codificações
+# O app (asset_url / rota /assets) lê o manifest no import. Sem manifest,
+# asset_url cai no url_for('static') normal.
+#
+# Roda antes do gunicorn (Procfile) ou à mão:
+#   python build_assets.py
+# ------------------------------------------------------------
+from typing import Dict
+from pathlib import Path
+import gzip
+import hashlib
+import json
+import re
+import sys
+import unicodedata
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # sem .br; o handler serve .gz ou o original
+
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+DIST_DIR = STATIC_DIR / "dist"
+MANIFEST = DIST_DIR / "manifest.json"
+
+EXTENSOES = {".css", ".js", ".svg", ".ico", ".png", ".jpg", ".jpeg", ".webp", ".json"}
+GANHO_MINIMO = 0.9  # só grava .gz/.br se ficar < 90% do original
+
+
+def _nome_fingerprint(origem: Path, digest: str) -> str:
+    stem = unicodedata.normalize("NFKD", origem.stem).encode("ascii", "ignore").decode("ascii")
+    stem = re.sub(r"[^A-Za-z0-9_.-]+", "-", stem).strip("-") or "asset"
+    return f"{stem}.{digest[:12]}{origem.suffix.lower()}"
+
+
+def _grava(destino: Path, conteudo: bytes) -> None:
+    tmp = destino.with_name(destino.name + ".tmp")
+    tmp.write_bytes(conteudo)
+    tmp.replace(destino)
+
+
+def main() -> None:
+    DIST_DIR.mkdir(parents=True, exist_ok=True)
+    if brotli is None:
+        print("Aviso: módulo brotli ausente (pip install Brotli); gerando só .gz", file=sys.stderr)
+
+    manifest: Dict[str, dict] = {}
+    por_digest: Dict[tuple, str] = {}
+    gerados = {MANIFEST.name}
+
+    # só o nível de cima de static/ (uploads/ e thumbs/ são conteúdo de usuário)
+    for origem in sorted(p for p in STATIC_DIR.iterdir() if p.is_file() and p.suffix.lower() in EXTENSOES):
+        dados = origem.read_bytes()
+        digest = hashlib.sha256(dados).hexdigest()
+
+        # conteúdo idêntico com outro nome (mesma extensão) -> mesmo arquivo gerado
+        chave = (digest, origem.suffix.lower())
+        if chave in por_digest:
+            manifest[origem.name] = dict(manifest[por_digest[chave]])
+            print(f"  = {origem.name} (duplicata de {por_digest[chave]})")
+            continue
+        por_digest[chave] = origem.name
+
+        nome = _nome_fingerprint(origem, digest)
+        _grava(DIST_DIR / nome, dados)
+        gerados.add(nome)
+
+        codificacoes = []
+        variantes = [("gzip", ".gz", lambda b: gzip.compress(b, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variantes.insert(0, ("br", ".br", lambda b: brotli.compress(b, quality=11)))
+        for codificacao, sufixo, comprimir in variantes:
+            comprimido = comprimir(dados)
+            if len(comprimido) < len(dados) * GANHO_MINIMO:
+                _grava(DIST_DIR / (nome + sufixo), comprimido)
+                gerados.add(nome + sufixo)
+                codificacoes.append(codificacao)
+
+        manifest[origem.name] = {"arquivo": nome, "bytes": len(dados), "codificacoes": codificacoes}
+        print(f"  + {origem.name} -> {nome} {' '.join(codificacoes)}")
+
+    # remove sobras de builds anteriores
+    for antigo in DIST_DIR.iterdir():
+        if antigo.is_file() and antigo.name not in gerados:
+            antigo.unlink()
+
+    _grava(MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True).encode("utf-8"))
+    print(f"\n✅ Gerado: {MANIFEST}  |  {len(manifest)} assets")
+
+
+if __name__ == "__main__":
+    main()
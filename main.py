@@ -1,6 +1,6 @@
 from flask import (
     Flask, render_template, request, redirect, url_for, flash, session,
-    render_template_string, send_file, jsonify, abort, g
+    render_template_string, send_file, jsonify, abort, g, stream_with_context
 )
 # Removido o uso de Flask-Mail; usamos Resend + SMTP com timeout
 from flask_sqlalchemy import SQLAlchemy
@@ -14,12 +14,13 @@ import csv
 import io
 import re
 import uuid
+import hashlib
 import logging
 import json
 import requests
 from unicodedata import normalize
-from sqlalchemy import inspect, text, or_, func, create_engine
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import inspect, text, or_, func, create_engine, bindparam
+from sqlalchemy.exc import OperationalError, InterfaceError
 from pathlib import Path
 import random
 from jinja2 import TemplateNotFound
@@ -143,6 +144,160 @@ def _safe_from_address() -> str:
         return EMAIL_FROM
     return f"AcheTece <no-reply@{RESEND_DOMAIN}>"
 
+# --------------------------------------------------------------------
+# Conexões reaproveitáveis para entrega de e-mail.
+# HTTP: uma requests.Session por provedor (pool keep-alive do urllib3),
+# recriada após fork. SMTP: pool pequeno de sessões já autenticadas
+# (TLS + AUTH uma vez só); antes de reusar uma conexão é feito um RSET, e
+# conexões velhas/mortas são descartadas e reabertas. Falha DEPOIS do RSET
+# não é reenviada aqui: o servidor pode já ter aceitado a mensagem, então
+# fica para o backoff do outbox.
+# --------------------------------------------------------------------
+import threading, atexit
+from requests.adapters import HTTPAdapter
+
+EMAIL_HTTP_POOL = int(os.getenv("EMAIL_HTTP_POOL", "4"))
+EMAIL_SMTP_POOL = int(os.getenv("EMAIL_SMTP_POOL", "2"))
+EMAIL_SMTP_MAX_IDADE_SEG = float(os.getenv("EMAIL_SMTP_MAX_IDADE_SEG", "300"))
+EMAIL_SMTP_MAX_MSGS = int(os.getenv("EMAIL_SMTP_MAX_MSGS", "100"))
+
+_HTTP_SESSOES: dict = {}
+_HTTP_SESSOES_LOCK = threading.Lock()
+
+def _http_sessao(provedor: str) -> requests.Session:
+    """Session compartilhada do provedor (thread-safe para POSTs simples)."""
+    chave = (provedor, os.getpid())
+    s = _HTTP_SESSOES.get(chave)
+    if s is not None:
+        return s
+    with _HTTP_SESSOES_LOCK:
+        s = _HTTP_SESSOES.get(chave)
+        if s is None:
+            s = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=EMAIL_HTTP_POOL, max_retries=0)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            for k in [k for k in _HTTP_SESSOES if k[1] != os.getpid()]:
+                _HTTP_SESSOES.pop(k, None)  # herdadas do processo pai: não fecha sockets alheios
+            _HTTP_SESSOES[chave] = s
+        return s
+
+class _SmtpPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._livres: list = []  # [smtp, chave, criado_em, usado_em, msgs]
+        self._pid = os.getpid()
+        self.stats = {"abertas": 0, "reusos": 0, "rset": 0, "descartadas": 0}
+
+    def _contar(self, nome: str) -> None:
+        with self._lock:
+            self.stats[nome] += 1
+
+    @staticmethod
+    def _chave() -> tuple:
+        return (app.config.get("SMTP_HOST") or "smtp.gmail.com", int(app.config.get("SMTP_PORT") or 465),
+                app.config.get("SMTP_USER") or "")
+
+    @staticmethod
+    def _fechar(smtp) -> None:
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _abrir(self, chave: tuple) -> list:
+        host, port, user = chave
+        timeout = int(app.config.get("MAIL_TIMEOUT") or 8)
+        if port == 465:
+            smtp = smtplib.SMTP_SSL(host, port, timeout=timeout, context=ssl.create_default_context())
+        else:
+            smtp = smtplib.SMTP(host, port, timeout=timeout)
+            smtp.ehlo()
+            smtp.starttls(context=ssl.create_default_context())
+            smtp.ehlo()
+        try:
+            smtp.login(user, app.config.get("SMTP_PASS") or "")
+        except Exception:
+            self._fechar(smtp)
+            raise
+        self._contar("abertas")
+        agora = time.monotonic()
+        return [smtp, chave, agora, agora, 0]
+
+    def _viva(self, item: list, chave: tuple) -> bool:
+        smtp, ch, criado, usado, msgs = item
+        if ch != chave or msgs >= EMAIL_SMTP_MAX_MSGS or time.monotonic() - criado > EMAIL_SMTP_MAX_IDADE_SEG:
+            return False
+        # RSET antes do MAIL FROM: confirma que a sessão está viva e limpa o
+        # envelope; se falhar aqui, nada da mensagem chegou ao servidor
+        self._contar("rset")
+        try:
+            return smtp.rset()[0] == 250
+        except Exception:
+            return False
+
+    def obter(self) -> tuple:
+        """Retorna (item, reusada): a conexão livre mais recente que esteja viva, ou uma nova."""
+        chave = self._chave()
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._livres, self._pid = [], os.getpid()  # sockets do pai não são nossos
+                item = self._livres.pop() if self._livres else None
+            if item is None:
+                return self._abrir(chave), False
+            if self._viva(item, chave):
+                self._contar("reusos")
+                return item, True
+            self._contar("descartadas")
+            self._fechar(item[0])
+
+    def _devolver_livre(self, item: list) -> bool:
+        with self._lock:
+            if len(self._livres) < EMAIL_SMTP_POOL:
+                self._livres.append(item)
+                return True
+        return False
+
+    def devolver(self, item: list, ok: bool) -> None:
+        item[3] = time.monotonic()
+        if ok:
+            item[4] += 1
+            if self._devolver_livre(item):
+                return
+        self._contar("descartadas")
+        self._fechar(item[0])
+
+    def enviar(self, msg: EmailMessage) -> None:
+        """Envia numa conexão do pool (já conferida com RSET). Falha no envio não reenvia."""
+        item, _ = self.obter()
+        try:
+            item[0].send_message(msg)
+        except Exception:
+            self.devolver(item, False)
+            raise
+        self.devolver(item, True)
+
+    def fechar_todas(self) -> None:
+        with self._lock:
+            livres, self._livres = (self._livres if self._pid == os.getpid() else []), []
+        for item in livres:
+            self._fechar(item[0])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, livres=len(self._livres))
+
+_SMTP_POOL = _SmtpPool()
+atexit.register(_SMTP_POOL.fechar_todas)
+
+def email_conexoes_status() -> dict:
+    return {"smtp": _SMTP_POOL.snapshot(),
+            "http": sorted(p for p, pid in _HTTP_SESSOES if pid == os.getpid())}
+
 def _send_via_resend(to: str, subject: str, html: str, text: Optional[str] = None) -> Tuple[bool, str]:
     """
     Envio via Resend HTTP (estável e sem duplicação).
@@ -155,7 +310,6 @@ def _send_via_resend(to: str, subject: str, html: str, text: Optional[str] = Non
         return False, "RESEND_API_KEY ausente"
 
     try:
-        import requests
         payload = {
             "from": _safe_from_address(),
             "to": [to],
@@ -166,7 +320,7 @@ def _send_via_resend(to: str, subject: str, html: str, text: Optional[str] = Non
         if REPLY_TO:
             payload["reply_to"] = REPLY_TO
 
-        r = requests.post(
+        r = _http_sessao("resend").post(
             "https://api.resend.com/emails",
             headers={"Authorization": f"Bearer {api}", "Content-Type": "application/json"},
             json=payload,
@@ -188,7 +342,6 @@ def _send_via_mailgun(to: str, subject: str, html: str, text: Optional[str] = No
 
     sender = os.getenv("MAILGUN_FROM") or f"AcheTece <no-reply@{domain}>"
     try:
-        import requests
         url = f"https://api.mailgun.net/v3/{domain}/messages"
         data = {
             "from": sender,
@@ -201,7 +354,7 @@ def _send_via_mailgun(to: str, subject: str, html: str, text: Optional[str] = No
         if REPLY_TO:
             data["h:Reply-To"] = REPLY_TO
 
-        r = requests.post(url, auth=("api", key), data=data, timeout=int(app.config.get("MAIL_TIMEOUT") or 8))
+        r = _http_sessao("mailgun").post(url, auth=("api", key), data=data, timeout=int(app.config.get("MAIL_TIMEOUT") or 8))
         if r.status_code in (200, 201, 202):
             return True, "OK"
         return False, f"Mailgun {r.status_code}: {r.text[:200]}"
@@ -215,7 +368,6 @@ def _send_via_sendgrid(to: str, subject: str, html: str, text: Optional[str] = N
 
     sender = os.getenv("SENDGRID_FROM") or _extract_email(_safe_from_address()) or "no-reply@achetece.com.br"
     try:
-        import requests
         url = "https://api.sendgrid.com/v3/mail/send"
         payload = {
             "personalizations": [{"to": [{"email": to}], "subject": subject}],
@@ -228,7 +380,7 @@ def _send_via_sendgrid(to: str, subject: str, html: str, text: Optional[str] = N
         if REPLY_TO:
             payload["reply_to"] = {"email": REPLY_TO}
 
-        r = requests.post(
+        r = _http_sessao("sendgrid").post(
             url,
             headers={"Authorization": f"Bearer {key}", "Content-Type": "application/json"},
             data=json.dumps(payload),
@@ -241,13 +393,10 @@ def _send_via_sendgrid(to: str, subject: str, html: str, text: Optional[str] = N
         return False, f"SendGrid erro: {e!s}"
 
 def _send_via_smtp(to: str, subject: str, html: str, text: Optional[str] = None) -> Tuple[bool, str]:
-    """Fallback via SMTP (SSL/TLS) — agora será usado de verdade."""
-    host = app.config.get("SMTP_HOST") or "smtp.gmail.com"
-    port = int(app.config.get("SMTP_PORT") or 465)
+    """Fallback via SMTP (SSL/TLS), reaproveitando sessões autenticadas do _SMTP_POOL."""
     user = app.config.get("SMTP_USER") or ""
     pwd  = app.config.get("SMTP_PASS") or ""
     sender = app.config.get("SMTP_FROM") or user
-    timeout = int(app.config.get("MAIL_TIMEOUT") or 8)
 
     if not (user and pwd and sender and to):
         return False, "SMTP não configurado."
@@ -264,29 +413,193 @@ def _send_via_smtp(to: str, subject: str, html: str, text: Optional[str] = None)
     msg.add_alternative(html or "", subtype="html")
 
     try:
-        if port == 465:
-            with smtplib.SMTP_SSL(host, port, timeout=timeout) as s:
-                s.login(user, pwd)
-                s.send_message(msg)
-        else:
-            ctx = ssl.create_default_context()
-            with smtplib.SMTP(host, port, timeout=timeout) as s:
-                s.ehlo()
-                s.starttls(context=ctx)
-                s.ehlo()
-                s.login(user, pwd)
-                s.send_message(msg)
+        _SMTP_POOL.enviar(msg)
         return True, "OK"
     except Exception as e:
         app.logger.exception(f"[EMAIL/SMTP] Falha ao enviar para {to}: {e}")
         return False, f"smtp_error: {e!s}"
 
-def send_email(to: str, subject: str, html: str, text: Optional[str] = None) -> bool:
+# --------------------------------------------------------------------
+# Disjuntor (circuit breaker) por provedor + roteamento por saúde.
+# Janela móvel dos últimos EMAIL_CB_JANELA envios (sucesso + latência),
+# descartando amostras com mais de EMAIL_CB_JANELA_SEG.
+# Taxa de falha >= EMAIL_CB_LIMIAR (com amostras mínimas) abre o circuito:
+# o provedor é pulado por EMAIL_CB_ABERTO_SEG (dobra a cada reabertura,
+# teto 15 min); depois uma única tentativa de prova (meio-aberto) decide.
+# Os contadores são por processo.
+# --------------------------------------------------------------------
+import threading
+from collections import deque
+
+EMAIL_CB_JANELA = int(os.getenv("EMAIL_CB_JANELA", "20"))
+EMAIL_CB_MIN_AMOSTRAS = int(os.getenv("EMAIL_CB_MIN_AMOSTRAS", "4"))
+EMAIL_CB_LIMIAR = float(os.getenv("EMAIL_CB_LIMIAR", "0.5"))
+EMAIL_CB_ABERTO_SEG = float(os.getenv("EMAIL_CB_ABERTO_SEG", "60"))
+EMAIL_CB_JANELA_SEG = float(os.getenv("EMAIL_CB_JANELA_SEG", "600"))  # amostras mais velhas expiram
+
+class _Disjuntor:
+    def __init__(self, nome: str):
+        self.nome = nome
+        self._lock = threading.Lock()
+        self._janela: deque = deque(maxlen=EMAIL_CB_JANELA)  # (t, ok, ms)
+        self.estado = "fechado"          # fechado | aberto | meio_aberto
+        self._aberto_ate = 0.0
+        self._aberturas_seguidas = 0
+        self._prova_em_curso = False
+        self.contadores = {"tentativas": 0, "sucessos": 0, "falhas": 0, "pulados": 0, "aberturas": 0}
+
+    def permite(self) -> bool:
+        with self._lock:
+            if self.estado == "aberto":
+                if time.monotonic() < self._aberto_ate:
+                    self.contadores["pulados"] += 1
+                    return False
+                self.estado = "meio_aberto"
+            if self.estado == "meio_aberto":
+                if self._prova_em_curso:
+                    self.contadores["pulados"] += 1
+                    return False
+                self._prova_em_curso = True
+            self.contadores["tentativas"] += 1
+            return True
+
+    def liberar(self) -> None:
+        """Desfaz um permite() que não virou tentativa (ex.: sem ficha no limite
+        de taxa); senão a prova do meio-aberto fica presa e o provedor some."""
+        with self._lock:
+            if self.estado == "meio_aberto":
+                self._prova_em_curso = False
+            self.contadores["tentativas"] -= 1
+
+    def _recentes(self) -> list:
+        limite = time.monotonic() - EMAIL_CB_JANELA_SEG
+        return [(ok, ms) for t, ok, ms in self._janela if t >= limite]
+
+    def registrar(self, ok: bool, ms: float) -> None:
+        with self._lock:
+            self._janela.append((time.monotonic(), ok, ms))
+            self.contadores["sucessos" if ok else "falhas"] += 1
+            if self.estado == "meio_aberto":
+                self._prova_em_curso = False
+                if ok:
+                    self.estado, self._aberturas_seguidas = "fechado", 0
+                    self._janela.clear()
+                    self._janela.append((time.monotonic(), ok, ms))
+                else:
+                    self._abrir()
+                return
+            recentes = self._recentes()
+            n = len(recentes)
+            falhas = sum(1 for r, _ in recentes if not r)
+            if n >= EMAIL_CB_MIN_AMOSTRAS and falhas / n >= EMAIL_CB_LIMIAR:
+                self._abrir()
+
+    def _abrir(self) -> None:
+        self._aberturas_seguidas += 1
+        espera = min(900.0, EMAIL_CB_ABERTO_SEG * (2 ** (self._aberturas_seguidas - 1)))
+        self.estado, self._aberto_ate = "aberto", time.monotonic() + espera
+        self.contadores["aberturas"] += 1
+        logging.warning(f"[EMAIL/CB] circuito ABERTO para {self.nome} por {espera:.0f}s")
+
+    def taxa_sucesso(self) -> float:
+        with self._lock:
+            recentes = self._recentes()
+            return (sum(1 for r, _ in recentes if r) / len(recentes)) if recentes else 1.0
+
+    def latencia_ms(self) -> float:
+        with self._lock:
+            oks = [ms for r, ms in self._recentes() if r]
+            return (sum(oks) / len(oks)) if oks else 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            "estado": self.estado,
+            "taxa_sucesso": round(self.taxa_sucesso(), 3),
+            "latencia_ms": round(self.latencia_ms(), 1),
+            "amostras": len(self._janela),  # inclui expiradas (até EMAIL_CB_JANELA)
+            "reabre_em_seg": max(0, round(self._aberto_ate - time.monotonic(), 1)) if self.estado == "aberto" else 0,
+            **self.contadores,
+        }
+
+def _provedor_configurado(nome: str) -> bool:
+    if nome == "resend":
+        return bool(RESEND_API_KEY)
+    if nome == "mailgun":
+        return bool(os.getenv("MAILGUN_DOMAIN") and os.getenv("MAILGUN_API_KEY"))
+    if nome == "sendgrid":
+        return bool(os.getenv("SENDGRID_API_KEY"))
+    if nome == "smtp":
+        user = app.config.get("SMTP_USER") or ""
+        return bool(user and app.config.get("SMTP_PASS") and (app.config.get("SMTP_FROM") or user))
+    return False
+
+EMAIL_PROVEDORES = (
+    ("resend", _send_via_resend),
+    ("mailgun", _send_via_mailgun),
+    ("sendgrid", _send_via_sendgrid),
+    ("smtp", _send_via_smtp),
+)
+_EMAIL_DISJUNTORES = {nome: _Disjuntor(nome) for nome, _ in EMAIL_PROVEDORES}
+
+# Limite de envio por provedor (token bucket, por processo): EMAIL_RL_<NOME>
+# mensagens/s, rajada = max(1, taxa). Sem ficha, o envio cai no próximo
+# provedor saudável; se todos estiverem no limite, espera a próxima ficha
+# (até EMAIL_RL_ESPERA_MAX_SEG). 0 desliga o limite do provedor.
+EMAIL_RL_PADRAO = {"resend": 2.0, "mailgun": 10.0, "sendgrid": 10.0, "smtp": 1.0}
+EMAIL_RL_ESPERA_MAX_SEG = float(os.getenv("EMAIL_RL_ESPERA_MAX_SEG", "30"))
+
+class _BaldeTokens:
+    def __init__(self, taxa: float, capacidade: float | None = None):
+        self.taxa = float(taxa)
+        self.capacidade = float(capacidade or max(1.0, self.taxa))
+        self._fichas = self.capacidade
+        self._t = time.monotonic()
+        self._lock = threading.Lock()
+        self.limitados = 0
+
+    def tentar(self) -> float:
+        """Consome uma ficha; retorna 0 se conseguiu ou os segundos até a próxima."""
+        if self.taxa <= 0:
+            return 0.0
+        with self._lock:
+            agora = time.monotonic()
+            self._fichas = min(self.capacidade, self._fichas + (agora - self._t) * self.taxa)
+            self._t = agora
+            if self._fichas >= 1:
+                self._fichas -= 1
+                return 0.0
+            self.limitados += 1
+            return (1 - self._fichas) / self.taxa
+
+_EMAIL_LIMITES = {nome: _BaldeTokens(float(os.getenv(f"EMAIL_RL_{nome.upper()}", EMAIL_RL_PADRAO[nome])))
+                  for nome, _ in EMAIL_PROVEDORES}
+
+def _provedores_por_saude() -> list:
+    """Configurados, com circuito fechado primeiro, por (taxa de sucesso, latência); empate mantém a ordem fixa."""
+    candidatos = []
+    for ordem, (nome, fn) in enumerate(EMAIL_PROVEDORES):
+        if not _provedor_configurado(nome):
+            continue
+        cb = _EMAIL_DISJUNTORES[nome]
+        candidatos.append(((cb.estado != "fechado", -round(cb.taxa_sucesso(), 2), cb.latencia_ms(), ordem), nome, fn))
+    candidatos.sort(key=lambda c: c[0])
+    return [(nome, fn) for _, nome, fn in candidatos]
+
+def email_provedores_status() -> dict:
+    return {nome: dict(_EMAIL_DISJUNTORES[nome].snapshot(), configurado=_provedor_configurado(nome),
+                       limite_por_seg=_EMAIL_LIMITES[nome].taxa, limitados=_EMAIL_LIMITES[nome].limitados)
+            for nome, _ in EMAIL_PROVEDORES}
+
+def _entregar_email(to: str, subject: str, html: str, text: Optional[str] = None) -> Tuple[bool, str, str]:
+    """
+    Entrega SÍNCRONA (usada pelo despachante da fila, fora do request).
+    Retorna (ok, via, motivo).
+    """
     from flask import current_app
 
     if current_app.config.get("MAIL_SUPPRESS_SEND"):
         current_app.logger.info(f"[send_email] MAIL_SUPPRESS_SEND=True — suprimido. to={to} subject={subject}")
-        return True
+        return True, "suprimido", "OK"
 
     # 1) Tenta Flask-Mail (se existir)
     try:
@@ -308,31 +621,59 @@ def send_email(to: str, subject: str, html: str, text: Optional[str] = None) ->
                 msg.reply_to = REPLY_TO
             mail_ext.send(msg)
             current_app.logger.info("[send_email] via Flask-Mail")
-            return True
+            return True, "flask_mail", "OK"
     except Exception:
         current_app.logger.exception("[send_email] Flask-Mail falhou")
 
-    # 2) Provedores HTTP
-    ok, why = _send_via_resend(to, subject, html, text)
-    if ok:
-        return True
-
-    ok, why = _send_via_mailgun(to, subject, html, text)
-    if ok:
-        return True
+    # 2) Provedores (HTTP + SMTP) na ordem de saúde; circuito aberto é pulado,
+    #    provedor sem ficha no limite de taxa cede a vez ao próximo
+    motivos = []
+    provedores = _provedores_por_saude()
+    prazo = time.monotonic() + EMAIL_RL_ESPERA_MAX_SEG
+    fila = provedores
+    while fila:
+        espera, limitados = None, []
+        for nome, fn in fila:
+            cb = _EMAIL_DISJUNTORES[nome]
+            if not cb.permite():
+                motivos.append(f"{nome}=circuito_aberto")
+                continue
+            falta = _EMAIL_LIMITES[nome].tentar()
+            if falta:
+                cb.liberar()
+                espera = falta if espera is None else min(espera, falta)
+                limitados.append((nome, fn))
+                continue
+            t0 = time.perf_counter()
+            try:
+                ok, why = fn(to, subject, html, text)
+            except Exception as e:
+                ok, why = False, f"{nome} erro: {e!s}"
+            cb.registrar(ok, (time.perf_counter() - t0) * 1000)
+            if ok:
+                current_app.logger.info(f"[send_email] via {nome}")
+                return True, nome, why
+            motivos.append(f"{nome}={why}")
+        if espera is None:
+            break
+        if time.monotonic() + espera > prazo:
+            motivos.append("limite_de_taxa")
+            break
+        time.sleep(espera)
+        fila = limitados
 
-    ok, why = _send_via_sendgrid(to, subject, html, text)
-    if ok:
-        return True
+    if not provedores:
+        motivos.append("nenhum provedor configurado")
+    current_app.logger.error(f"[send_email] nenhum backend aceitou. {' | '.join(motivos)}")
+    return False, "", " | ".join(motivos)[:500]
 
-    # 3) Fallback SMTP (AGORA SIM)
-    ok, why2 = _send_via_smtp(to, subject, html, text)
-    if ok:
-        current_app.logger.info("[send_email] via SMTP fallback")
-        return True
+def send_email_now(to: str, subject: str, html: str, text: Optional[str] = None) -> bool:
+    """Envio imediato (bloqueia). Prefira send_email(), que só enfileira."""
+    return _entregar_email(to, subject, html, text)[0]
 
-    current_app.logger.error(f"[send_email] nenhum backend aceitou. http_last={why} smtp_last={why2}")
-    return False
+def send_email(to: str, subject: str, html: str, text: Optional[str] = None, **kw) -> bool:
+    """Enfileira no outbox (email_outbox); o despachante entrega em segundo plano."""
+    return email_enfileirar(to, subject, html, text, **kw) is not None
 
 def _plano_label(p: str | None) -> str:
     p = (p or "").strip().lower()
@@ -342,12 +683,71 @@ def _plano_label(p: str | None) -> str:
 
 app.jinja_env.filters["plano_label"] = _plano_label
 
+# --------------------------------------------------------------------
+# Registro de templates de e-mail (templates/emails/*.html).
+# Cada arquivo define os blocos subject / html / text; o registro compila
+# o template uma vez (lazy, com cache por processo) e renderiza só os
+# blocos, sem passar pelo loader a cada envio. email_render_lote() reusa
+# o mesmo template compilado para muitos destinatários (campanhas).
+# --------------------------------------------------------------------
+from typing import NamedTuple, Iterable
+
+EMAIL_TPL_DIR = "emails"
+EMAIL_TPL_GLOBAIS = {"brand": "AcheTece • Portal de Malharias", "site_url": SITE_URL.rstrip("/")}
+
+class EmailRenderizado(NamedTuple):
+    subject: str
+    html: str
+    text: str
+
+_EMAIL_TPL_CACHE: dict = {}
+
+def _email_template(nome: str):
+    tpl = _EMAIL_TPL_CACHE.get(nome)
+    if tpl is None or (app.jinja_env.auto_reload and not tpl.is_up_to_date):
+        tpl = app.jinja_env.get_template(f"{EMAIL_TPL_DIR}/{nome}.html")
+        _EMAIL_TPL_CACHE[nome] = tpl
+    return tpl
+
+def _email_bloco(tpl, ctx, bloco: str) -> str:
+    fn = tpl.blocks.get(bloco)
+    return "".join(fn(ctx)).strip() if fn else ""
+
+def _email_render_tpl(tpl, contexto: dict) -> EmailRenderizado:
+    ctx = tpl.new_context({**EMAIL_TPL_GLOBAIS, **contexto})
+    html = _email_bloco(tpl, ctx, "html")
+    return EmailRenderizado(
+        subject=" ".join(_email_bloco(tpl, ctx, "subject").split()),
+        html=html,
+        text=_email_bloco(tpl, ctx, "text") or _fallback_text(html, None),
+    )
+
+def email_render(template: str, /, **contexto) -> EmailRenderizado:
+    """Renderiza assunto + HTML + texto de templates/emails/<template>.html."""
+    return _email_render_tpl(_email_template(template), contexto)
+
+def email_render_lote(template: str, contextos: Iterable[dict], /, **comum) -> list:
+    """Mesmo template para vários contextos (campos em `comum` valem para todos)."""
+    tpl = _email_template(template)
+    return [_email_render_tpl(tpl, {**comum, **c}) for c in contextos]
+
+def email_templates_precompilar() -> list:
+    """Compila todos os templates de e-mail (chamado no boot; erros de sintaxe aparecem cedo)."""
+    nomes = sorted(n[len(EMAIL_TPL_DIR) + 1:-5] for n in app.jinja_env.list_templates(
+        filter_func=lambda n: n.startswith(EMAIL_TPL_DIR + "/") and n.endswith(".html")))
+    for nome in nomes:
+        try:
+            _email_template(nome)
+        except Exception:
+            app.logger.exception(f"[EMAIL_TPL] falha ao compilar {nome}")
+    return nomes
+
+email_templates_precompilar()
+
 # --------------------------------------------------------------------
 # E-mail transacional: Pagamento confirmado (AcheTece)
 # --------------------------------------------------------------------
 def send_payment_confirmation_email(to_email: str, nome_empresa: str, plano: str) -> bool:
-    import html as _html
-
     # 1) Normaliza BASE URL (evita //login)
     base = (SITE_URL or "https://www.achetece.com.br").rstrip("/")
 
@@ -358,172 +758,15 @@ def send_payment_confirmation_email(to_email: str, nome_empresa: str, plano: str
 
     plano_label = "Plano Mensal" if plano_norm == "mensal" else "Plano Anual (15% OFF)"
 
-    # 3) Links
-    login_url = f"{base}/login"
-    painel_url = f"{base}/painel_malharia"
-
-    # 4) Assunto (neutro e bom p/ entrega)
-    subject = "Pagamento confirmado — AcheTece"
-
-    # 5) Texto puro (fallback)
-    nome_txt = (nome_empresa or "Sua malharia").strip()
-    text_body = f"""Olá, {nome_txt}!
-
-Seu pagamento foi confirmado e seu acesso ao AcheTece foi liberado.
-
-Plano: {plano_label}
-
-Login:
-{login_url}
-
-Painel:
-{painel_url}
-
-Se precisar de suporte, responda este e-mail.
-"""
-
-    # 6) HTML (sanitiza nome)
-    nome_html = _html.escape(nome_txt)
-
-    html_body = f"""
-    <div style="font-family:Inter,Arial,sans-serif;background:#f5f5f4;padding:24px;">
-      <div style="max-width:560px;margin:0 auto;background:#ffffff;border:1px solid #e5e7eb;border-radius:16px;overflow:hidden;">
-        <div style="padding:18px 18px 10px 18px;">
-          <h2 style="margin:0;color:#111;font-size:20px;">Pagamento confirmado ✅</h2>
-
-          <p style="margin:10px 0 0 0;color:#333;line-height:1.5;">
-            Olá, <strong>{nome_html}</strong>!<br>
-            Seu pagamento foi confirmado e seu acesso ao <strong>AcheTece</strong> foi liberado.
-          </p>
-
-          <div style="margin:14px 0;padding:12px;border-radius:12px;background:#f1f2e8;border:1px solid #bfbfa8;">
-            <div style="font-weight:800;color:#111;">{plano_label}</div>
-            <div style="color:#333;font-size:13px;margin-top:4px;">Você já pode acessar normalmente.</div>
-          </div>
-
-          <a href="{login_url}"
-             style="display:inline-block;background:#000;color:#b6f34d;text-decoration:none;font-weight:800;
-                    padding:12px 16px;border-radius:999px;margin-top:6px;">
-             Fazer login
-          </a>
-
-          <p style="margin:14px 0 0 0;color:#666;font-size:13px;line-height:1.5;">
-            Se o botão não abrir, copie e cole:<br>
-            <span style="color:#111;">{login_url}</span>
-          </p>
-
-          <p style="margin:10px 0 0 0;color:#666;font-size:13px;">
-            Ir para o painel: <a href="{painel_url}" style="color:#7B7424;font-weight:800;text-decoration:none;">{painel_url}</a>
-          </p>
-        </div>
-
-        <div style="border-top:1px solid #eee;padding:12px 18px;color:#666;font-size:12px;">
-          Se precisar de suporte, responda este e-mail.
-        </div>
-      </div>
-    </div>
-    """
-
-    return send_email(to_email, subject, html_body, text_body)
-
-def _otp_validate(email: str, codigo: str):
-    """
-    Valida o OTP de login considerando os dois formatos possíveis:
-      A) session['otp_login'] = { '<email>': { code, exp(timestamp), attempts, ... } }
-      B) session['otp']       = { 'email':..., 'code':..., 'expires': iso, 'attempts': ... }
-    Retorna (ok: bool, msg: str).
-    """
-    email = (email or "").strip().lower()
-    codigo = (codigo or "").strip()
-
-    # --- Formato A: otp_login por e-mail ------------------------------------
-    otp_login = session.get("otp_login")
-    if isinstance(otp_login, dict) and email in otp_login and isinstance(otp_login[email], dict):
-        rec = otp_login[email]
-
-        # Tentativas
-        rec["attempts"] = int(rec.get("attempts", 0)) + 1
-        # Persistir contador
-        otp_login[email] = rec
-        session["otp_login"] = otp_login
-        session.modified = True
-
-        # Expiração (timestamp UTC)
-        try:
-            exp_ts = float(rec.get("exp", 0))
-        except Exception:
-            exp_ts = 0.0
-        if exp_ts and datetime.utcnow().timestamp() > exp_ts:
-            # Limpa apenas este e-mail
-            try:
-                del otp_login[email]
-            except Exception:
-                pass
-            session["otp_login"] = otp_login
-            session.modified = True
-            return False, "Código expirado. Solicite um novo."
-
-        # Comparação
-        if str(rec.get("code", "")).strip() != str(codigo):
-            if rec["attempts"] > 5:
-                # Muitas tentativas -> invalida este OTP
-                try:
-                    del otp_login[email]
-                except Exception:
-                    pass
-                session["otp_login"] = otp_login
-                session.modified = True
-                return False, "Muitas tentativas. Solicite um novo código."
-            return False, "Código incorreto. Tente novamente."
-
-        # Sucesso -> limpar OTP deste e-mail
-        try:
-            del otp_login[email]
-        except Exception:
-            pass
-        session["otp_login"] = otp_login
-        session.modified = True
-        return True, "OK"
-
-    # --- Formato B: otp único com 'email'/'expires' ISO ---------------------
-    otp_blob = session.get("otp") or {}
-    if isinstance(otp_blob, dict):
-        rec = None
-        if otp_blob.get("email") == email:
-            rec = otp_blob
-        elif email in otp_blob and isinstance(otp_blob[email], dict):
-            rec = otp_blob[email]
-
-        if rec:
-            rec["attempts"] = int(rec.get("attempts", 0)) + 1
-            session["otp"] = otp_blob
-            session.modified = True
-
-            expires_iso = rec.get("expires")
-            if expires_iso:
-                try:
-                    exp_dt = datetime.fromisoformat(expires_iso)
-                    if datetime.utcnow() > exp_dt:
-                        session.pop("otp", None)
-                        session.modified = True
-                        return False, "Código expirado. Solicite um novo."
-                except Exception:
-                    session.pop("otp", None)
-                    session.modified = True
-                    return False, "Código inválido. Solicite um novo."
-
-            if str(rec.get("code", "")).strip() != str(codigo):
-                if rec["attempts"] > 5:
-                    session.pop("otp", None)
-                    session.modified = True
-                    return False, "Muitas tentativas. Solicite um novo código."
-                return False, "Código incorreto. Tente novamente."
-
-            session.pop("otp", None)
-            session.modified = True
-            return True, "OK"
-
-    return False, "Código não encontrado para este e-mail. Reenvie o código."
+    # 3) Renderiza (templates/emails/pagamento_confirmado.html; autoescape cuida do nome)
+    m = email_render(
+        "pagamento_confirmado",
+        nome=(nome_empresa or "Sua malharia").strip(),
+        plano_label=plano_label,
+        login_url=f"{base}/login",
+        painel_url=f"{base}/painel_malharia",
+    )
+    return send_email(to_email, m.subject, m.html, m.text, tipo="pagamento")
 
 # Mercado Pago (mantido para compat)
 MP_ACCESS_TOKEN = os.getenv("MP_ACCESS_TOKEN") or os.getenv("MERCADO_PAGO_TOKEN", "")
@@ -536,6 +779,70 @@ DEMO_MODE  = os.getenv("DEMO_MODE", "true").lower() == "true"
 DEMO_TOKEN = os.getenv("DEMO_TOKEN", "localdemo")
 SEED_TOKEN = os.getenv("SEED_TOKEN", "ACHETECE")
 
+# =====================[ ASSETS ESTÁTICOS (FINGERPRINT) ]=====================
+# build_assets.py copia os estáticos de static/ para static/dist/<nome>.<hash>.<ext>
+# (+ .br/.gz) e escreve manifest.json. asset_url() tem a mesma assinatura de
+# url_for e troca 'static' pela rota /assets quando o arquivo está no manifest;
+# a rota escolhe br > gzip > original pelo Accept-Encoding. Nome com hash nunca
+# muda de conteúdo: cache imutável de 1 ano. Sem manifest (dev), tudo segue
+# pelo static normal.
+import mimetypes
+
+ASSETS_DIR = os.path.join(app.static_folder, "dist")
+ASSETS_MANIFEST = os.path.join(ASSETS_DIR, "manifest.json")
+ASSETS_CACHE_CONTROL = "public, max-age=31536000, immutable"
+_ASSETS_SUFIXOS = {"br": ".br", "gzip": ".gz"}
+
+def _assets_carregar() -> dict:
+    try:
+        with open(ASSETS_MANIFEST, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        app.logger.warning(f"[assets] manifest inválido ({e}); usando static sem fingerprint")
+        return {}
+    app.logger.info({"assets": len(manifest), "manifest": ASSETS_MANIFEST})
+    return manifest
+
+_ASSETS = _assets_carregar()
+# arquivo gerado -> codificações disponíveis (a rota só serve o que o build gerou)
+_ASSETS_ARQUIVOS = {info["arquivo"]: tuple(info.get("codificacoes") or ()) for info in _ASSETS.values()}
+
+def asset_url(endpoint: str, **values) -> str:
+    """url_for com fingerprint: asset_url('static', filename='style.css')."""
+    if endpoint == "static":
+        info = _ASSETS.get(values.get("filename"))
+        if info:
+            values.pop("filename")
+            return url_for("asset", nome=info["arquivo"], **values)
+    return url_for(endpoint, **values)
+
+app.jinja_env.globals["asset_url"] = asset_url
+
+@app.route("/assets/<path:nome>", endpoint="asset")
+def asset(nome):
+    codificacoes = _ASSETS_ARQUIVOS.get(nome)
+    if codificacoes is None:
+        abort(404)
+    arquivo, codificacao = nome, None
+    aceitas = request.accept_encodings
+    for cod in codificacoes:  # o build grava em ordem de preferência (br, gzip)
+        if aceitas[cod]:
+            arquivo, codificacao = nome + _ASSETS_SUFIXOS[cod], cod
+            break
+    resp = send_from_directory(
+        ASSETS_DIR, arquivo,
+        mimetype=mimetypes.guess_type(nome)[0] or "application/octet-stream",
+        max_age=31536000,
+    )
+    if codificacao:
+        resp.headers["Content-Encoding"] = codificacao
+    if codificacoes:
+        resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Cache-Control"] = ASSETS_CACHE_CONTROL
+    return resp
+
 # ===== CONFIG AVATAR (definir uma única vez; sem duplicar BASE_DIR) =====
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5 MB
 
@@ -550,25 +857,344 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'webp', 'gif'}
 def _allowed_file(filename: str) -> bool:
     return ('.' in filename) and (filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS)
 
-def _save_square_webp(file_storage, dest_path: str, side: int = 400, quality: int = 85):
-    """Recorta para quadrado central, redimensiona e salva em WEBP."""
-    img = Image.open(file_storage.stream)
-    # converte p/ RGB (remove alpha) antes do WEBP
-    if img.mode not in ('RGB', 'L'):
-        img = img.convert('RGB')
+# Pipeline de avatar: decodifica UMA vez, corrige a orientação (EXIF), recorta o
+# quadrado central e gera as variantes AVATAR_TAMANHOS em WebP + um JPEG de
+# fallback. Nada de EXIF/ICC é copiado para as saídas. As variantes são
+# endereçadas por conteúdo: static/uploads/avatars/h/<hash>-<lado>.<ext>, onde
+# <hash> cobre o conjunto todo e vai para Empresa.foto_url. Arquivo nunca é
+# sobrescrito, então é servido com cache imutável de 1 ano; blobs que nenhuma
+# empresa referencia são apagados pela tarefa avatar_gc.
+#
+# A transformação (avatar_imagem.py) roda num ProcessPoolExecutor limitado: o
+# upload só valida o cabeçalho, grava o original (fsync + troca atômica) em
+# AVATAR_ORIGINAIS_DIR — fora de static/, o original ainda tem EXIF — e volta.
+# Uma thread por job espera uma vaga (no máximo AVATAR_WORKERS jobs dentro do
+# pool, então o prazo AVATAR_TIMEOUT_SEG conta da execução, não da fila), grava
+# as variantes e atualiza Empresa.foto_url. Job que estoura o prazo derruba só
+# o pool em que rodou; quem estava no mesmo pool (CancelledError /
+# BrokenProcessPool) é reenviado até AVATAR_TENTATIVAS vezes. Enquanto isso
+# avatar_fontes devolve o placeholder (neste worker; os demais seguem com a foto
+# anterior até a próxima varredura do índice). Original que sobrou de worker
+# morto é reprocessado pela tarefa avatar_scan.
+from PIL import UnidentifiedImageError
+from concurrent.futures import ProcessPoolExecutor, CancelledError, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import avatar_imagem
+from avatar_imagem import AVATAR_TAMANHOS, AVATAR_JPEG_LADO
+
+AVATAR_WORKERS = int(os.getenv("AVATAR_WORKERS", "2"))
+AVATAR_FILA_MAX = int(os.getenv("AVATAR_FILA_MAX", "8"))           # jobs em voo por worker
+AVATAR_TIMEOUT_SEG = float(os.getenv("AVATAR_TIMEOUT_SEG", "20"))
+AVATAR_TENTATIVAS = int(os.getenv("AVATAR_TENTATIVAS", "3"))       # por job, contando reenvios
+AVATAR_ORIGINAIS_DIR = os.getenv("AVATAR_ORIGINAIS_DIR") or os.path.join(BASE_DIR, "avatar_originais")
+AVATAR_PLACEHOLDER = "avatar_processando.svg"                      # relativo a static/
+AVATAR_ERROS_IMAGEM = (UnidentifiedImageError, OSError, ValueError, Image.DecompressionBombError)
+os.makedirs(AVATAR_ORIGINAIS_DIR, exist_ok=True)
+
+_AVATAR_POOL: ProcessPoolExecutor | None = None
+_AVATAR_POOL_PID = None
+_AVATAR_POOL_LOCK = threading.Lock()
+_AVATAR_VAGAS = threading.BoundedSemaphore(AVATAR_WORKERS)
+_AVATAR_JOBS: dict = {}     # empresa_id -> instante do envio (só deste processo)
+_AVATAR_TRANSFORMAR = avatar_imagem.transformar_arquivo  # roda no processo filho
+
+def _avatar_pool() -> ProcessPoolExecutor:
+    """Pool por pid (o gunicorn pode forkar depois do import). spawn: o filho
+    importa só avatar_imagem, sem herdar threads/conexões do worker."""
+    global _AVATAR_POOL, _AVATAR_POOL_PID
+    with _AVATAR_POOL_LOCK:
+        if _AVATAR_POOL is None or _AVATAR_POOL_PID != os.getpid():
+            _AVATAR_POOL = ProcessPoolExecutor(
+                max_workers=AVATAR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                max_tasks_per_child=200,
+            )
+            _AVATAR_POOL_PID = os.getpid()
+        return _AVATAR_POOL
+
+def _avatar_pool_reciclar(pool: ProcessPoolExecutor, motivo: str) -> None:
+    """Descarta `pool` (job travado ou processo morto) se ainda for o atual;
+    nunca mata um pool mais novo criado por outro job nesse meio tempo."""
+    global _AVATAR_POOL
+    with _AVATAR_POOL_LOCK:
+        if _AVATAR_POOL is not pool:
+            return
+        _AVATAR_POOL = None
+    app.logger.warning(f"[avatar] reciclando pool de imagens: {motivo}")
+    for proc in list((getattr(pool, "_processes", None) or {}).values()):
+        try:
+            proc.terminate()
+        except Exception:
+            pass
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _avatar_original(empresa_id: int) -> str:
+    return os.path.join(AVATAR_ORIGINAIS_DIR, f"empresa_{empresa_id}.img")
+
+def _avatar_pendente(empresa_id) -> bool:
+    return empresa_id in _AVATAR_JOBS
+
+# Falha no processamento fica marcada em disco (qualquer worker enxerga) até
+# o próximo upload ou um processamento bem-sucedido; o painel avisa o usuário,
+# que já tinha visto "agendado" e veria a foto antiga voltar sem explicação.
+def _avatar_falha_caminho(empresa_id: int) -> str:
+    return os.path.join(AVATAR_ORIGINAIS_DIR, f"empresa_{empresa_id}.falha")
 
-    # Compat de filtro (Pillow 10+ usa Image.Resampling)
+def _avatar_falha_marcar(empresa_id: int, motivo: str) -> None:
+    def escrever(tmp):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"motivo": motivo[:200], "em": time.time()}, f)
     try:
-        _LANCZOS = Image.Resampling.LANCZOS  # type: ignore[attr-defined]
-    except Exception:
-        _LANCZOS = Image.LANCZOS
+        _gravar_atomico(_avatar_falha_caminho(empresa_id), escrever)
+    except OSError:
+        app.logger.exception("[avatar] não foi possível registrar a falha da empresa %s", empresa_id)
+
+def _avatar_falha_limpar(empresa_id: int) -> None:
+    try:
+        os.remove(_avatar_falha_caminho(empresa_id))
+    except OSError:
+        pass
+
+def avatar_falha(empresa_id) -> str | None:
+    """Motivo da última falha ao processar a foto da empresa (None se não houve)."""
+    if not empresa_id:
+        return None
+    try:
+        with open(_avatar_falha_caminho(int(empresa_id)), encoding="utf-8") as f:
+            return json.load(f).get("motivo") or "erro"
+    except (OSError, ValueError):
+        return None
+
+def avatar_processar(empresa_id: int, dados: bytes | None = None) -> bool:
+    """Grava o original (se vier) e agenda a transformação. False = fila cheia."""
+    with _AVATAR_POOL_LOCK:
+        if empresa_id not in _AVATAR_JOBS and len(_AVATAR_JOBS) >= AVATAR_FILA_MAX:
+            return False
+
+    caminho = _avatar_original(empresa_id)
+    if dados is not None:
+        def escrever(tmp):
+            with open(tmp, "wb") as f:
+                f.write(dados)
+                f.flush()
+                os.fsync(f.fileno())
+        _gravar_atomico(caminho, escrever)
+        _avatar_falha_limpar(empresa_id)
+
+    # grava ANTES de olhar o job em voo: ao terminar ele vê o original novo e reprocessa
+    with _AVATAR_POOL_LOCK:
+        if empresa_id in _AVATAR_JOBS:
+            return True
+        _AVATAR_JOBS[empresa_id] = time.time()
+    try:
+        versao = os.stat(caminho).st_mtime_ns
+    except OSError:
+        with _AVATAR_POOL_LOCK:
+            _AVATAR_JOBS.pop(empresa_id, None)
+        raise
+    threading.Thread(target=_avatar_concluir, args=(empresa_id, versao),
+                     name=f"avatar-{empresa_id}", daemon=True).start()
+    return True
+
+def _avatar_transformar_no_pool(empresa_id: int, caminho: str) -> tuple[str, dict | None]:
+    """(status, saidas). Ocupa uma vaga durante a execução; reenvia quem foi
+    derrubado junto com o pool de outro job."""
+    for tentativa in range(1, AVATAR_TENTATIVAS + 1):
+        with _AVATAR_VAGAS:
+            pool = _avatar_pool()
+            try:
+                fut = pool.submit(_AVATAR_TRANSFORMAR, caminho)
+                return "ok", fut.result(timeout=AVATAR_TIMEOUT_SEG)
+            except FuturesTimeout:
+                _avatar_pool_reciclar(pool, f"empresa {empresa_id} passou de {AVATAR_TIMEOUT_SEG}s")
+                return "timeout", None
+            except (BrokenProcessPool, CancelledError, RuntimeError) as e:
+                # RuntimeError: submit num pool que outro job acabou de desligar
+                _avatar_pool_reciclar(pool, f"{e.__class__.__name__} na empresa {empresa_id}")
+                app.logger.info({"rota": "avatar_job", "empresa_id": empresa_id,
+                                 "reenvio": tentativa, "motivo": e.__class__.__name__})
+            except AVATAR_ERROS_IMAGEM as e:
+                return f"imagem_invalida: {e}", None
+    return "pool_quebrado", None
+
+def _avatar_concluir(empresa_id: int, versao: int) -> None:
+    t0 = time.perf_counter()
+    caminho = _avatar_original(empresa_id)
+    status = "erro"
+    try:
+        status, saidas = _avatar_transformar_no_pool(empresa_id, caminho)
+        if saidas is None:
+            return
+
+        try:
+            if os.stat(caminho).st_mtime_ns != versao:
+                status = "substituido"  # novo upload chegou durante o job
+                return
+        except OSError:
+            pass
+
+        with app.app_context():
+            try:
+                _avatar_finalizar(empresa_id, saidas)
+            except Exception as e:
+                db.session.rollback()
+                status = f"erro: {e}"
+                app.logger.exception("[avatar] falha ao finalizar empresa %s", empresa_id)
+            finally:
+                db.session.remove()
+    finally:
+        try:
+            if os.stat(caminho).st_mtime_ns == versao:
+                if status not in ("ok", "substituido"):
+                    _avatar_falha_marcar(empresa_id, status)  # antes de sair de "pendente"
+                os.remove(caminho)
+        except OSError:
+            pass
+        with _AVATAR_POOL_LOCK:
+            _AVATAR_JOBS.pop(empresa_id, None)
+        app.logger.info({"rota": "avatar_job", "empresa_id": empresa_id, "status": status,
+                         "ms": round((time.perf_counter() - t0) * 1000, 1)})
+        try:
+            reprocessar = os.stat(caminho).st_mtime_ns != versao
+        except OSError:
+            reprocessar = False
+        if reprocessar:
+            avatar_processar(empresa_id)
+
+def _avatar_finalizar(empresa_id: int, saidas: dict) -> None:
+    """Grava as variantes, limpa o legado e aponta Empresa.foto_url para o JPEG."""
+    os.makedirs(AVATAR_DIR, exist_ok=True)
+    rel_path = _avatar_gravar(empresa_id, saidas)
+
+    # Remove o original cru do fluxo antigo (static/avatars/empresa_<id>.ext)
+    for old_ext in (".jpg", ".jpeg", ".png", ".webp"):
+        old_rel = f"avatars/empresa_{empresa_id}{old_ext}"
+        if _AVATARES.versao(old_rel):
+            try:
+                os.remove(os.path.join(app.static_folder, old_rel))
+            except OSError:
+                pass
+            _AVATARES.remover(old_rel)
+
+    # ... e as variantes por empresa (nome fixo) de antes do endereçamento por conteúdo
+    for t in AVATAR_TAMANHOS:
+        for old_rel in (f"{_avatar_base(empresa_id)}-{t}.webp", f"{_avatar_base(empresa_id)}-{t}.jpg"):
+            if _AVATARES.versao(old_rel):
+                try:
+                    os.remove(os.path.join(app.static_folder, old_rel))
+                except OSError:
+                    pass
+                _AVATARES.remover(old_rel)
+
+    emp = db.session.get(Empresa, empresa_id)
+    if emp is not None:
+        anterior = avatar_hash(emp.foto_url)
+        # JPEG 400 = fallback universal; templates usam avatar_fontes/srcset
+        emp.foto_url = f"{app.static_url_path}/{rel_path}"  # thread sem request: nada de url_for
+        db.session.commit()
+        _avatar_falha_limpar(empresa_id)
+        novo = avatar_hash(emp.foto_url)
+        _AVATARES.definir_hash(empresa_id, novo)
+        if anterior and anterior != novo:
+            _avatar_tocar(anterior)
+
+def _avatar_tocar(h: str) -> None:
+    """Renova o mtime das variantes de `h`: a carência do GC conta da troca, não da criação."""
+    pasta = os.path.join(app.static_folder, AVATAR_CAS_PASTA)
+    try:
+        entradas = list(os.scandir(pasta))
+    except OSError:
+        return
+    for e in entradas:
+        if e.name.startswith(f"{h}-"):
+            try:
+                os.utime(e.path)
+            except OSError:
+                pass
+
+def avatar_originais_pendentes() -> list:
+    """Originais órfãos (worker reiniciado no meio do job) -> reenfileira."""
+    limite = time.time() - AVATAR_TIMEOUT_SEG * 2  # dá tempo ao worker que recebeu o upload
+    retomados = []
+    try:
+        nomes = os.listdir(AVATAR_ORIGINAIS_DIR)
+    except OSError:
+        return retomados
+    for nome in nomes:
+        m = re.fullmatch(r"empresa_(\d+)\.img", nome)
+        if not m or _avatar_pendente(int(m.group(1))):
+            continue
+        try:
+            if os.path.getmtime(os.path.join(AVATAR_ORIGINAIS_DIR, nome)) > limite:
+                continue
+        except OSError:
+            continue
+        if avatar_processar(int(m.group(1))):
+            retomados.append(int(m.group(1)))
+    return retomados
+
+AVATAR_CAS_PASTA = "uploads/avatars/h"                             # relativo a static/
+_AVATAR_HASH_RE = re.compile(r"/uploads/avatars/h/([0-9a-f]{20})-")
+
+def avatar_hash(foto_url: str | None) -> str | None:
+    m = _AVATAR_HASH_RE.search(foto_url or "")
+    return m.group(1) if m else None
+
+def _avatar_base(empresa_id: int) -> str:
+    """Nome legado (por empresa, sobrescrito a cada upload)."""
+    return f"uploads/avatars/empresa_{empresa_id}"
+
+def _avatar_gravar(empresa_id: int, saidas: dict) -> str:
+    """Grava as variantes endereçadas por conteúdo; retorna o rel do JPEG."""
+    h = hashlib.sha256()
+    for sufixo in sorted(saidas):
+        h.update(sufixo.encode())
+        h.update(saidas[sufixo])
+    h = h.hexdigest()[:20]
+    pasta = os.path.join(app.static_folder, AVATAR_CAS_PASTA)
+    os.makedirs(pasta, exist_ok=True)
+    for sufixo, conteudo in saidas.items():
+        caminho = os.path.join(pasta, f"{h}-{sufixo}")
+        if os.path.exists(caminho):
+            os.utime(caminho)  # mesmo conteúdo: só renova a carência do GC
+            continue
+        def escrever(tmp, conteudo=conteudo):
+            with open(tmp, "wb") as f:
+                f.write(conteudo)
+        _gravar_atomico(caminho, escrever)
+    return f"{AVATAR_CAS_PASTA}/{h}-{AVATAR_JPEG_LADO}.jpg"
+
+def avatar_fontes(empresa_id, foto_url: str | None = None) -> dict | None:
+    """
+    src/srcset das variantes da empresa, sem tocar no disco. Com `foto_url`
+    (quem já tem a Empresa carregada) o hash sai dela; sem, do índice
+    empresa -> hash. None se não houver foto.
+    """
+    if not empresa_id:
+        return None
+    if _avatar_pendente(empresa_id):
+        return {"srcset": "", "src": asset_url("static", filename=AVATAR_PLACEHOLDER), "pendente": True}
+    h = avatar_hash(foto_url) if foto_url else _AVATARES.hash_de(empresa_id)
+    if h:
+        base = url_for("static", filename=f"{AVATAR_CAS_PASTA}/{h}")
+        return {
+            "srcset": ", ".join(f"{base}-{t}.webp {t}w" for t in AVATAR_TAMANHOS),
+            "src": f"{base}-{AVATAR_JPEG_LADO}.jpg",
+        }
+
+    # variantes gravadas antes do endereçamento por conteúdo (versão via ?v)
+    base = _avatar_base(empresa_id)
+    webp = [(t, f"{base}-{t}.webp") for t in AVATAR_TAMANHOS if _AVATARES.versao(f"{base}-{t}.webp")]
+    if not webp:
+        return None
+    jpg = f"{base}-{AVATAR_JPEG_LADO}.jpg"
+    return {
+        "srcset": ", ".join(f"{_AVATARES.url(rel)} {t}w" for t, rel in webp),
+        "src": _AVATARES.url(jpg if _AVATARES.versao(jpg) else webp[-1][1]),
+    }
 
-    w, h = img.size
-    m = min(w, h)
-    left = (w - m) // 2
-    top = (h - m) // 2
-    img = img.crop((left, top, left + m, top + m)).resize((side, side), _LANCZOS)
-    img.save(dest_path, 'WEBP', quality=quality, method=6)
+app.jinja_env.globals["avatar_fontes"] = avatar_fontes
 
 # --------------------------------------------------------------------
 # Helpers
@@ -654,6 +1280,14 @@ def calc_vencimento_mensal_br(empresa, last_paid_at: datetime | date | None = No
 
     due = _proximo_dia_util_br(nominal)
     return due, (due - hoje).days
+
+def _dias_ciclo_plano(plano: str | None) -> int:
+    # mesma janela do painel: anual = 365; mensal = 35 (com folga)
+    return 365 if "anual" in (plano or "mensal").strip().lower() else 35
+
+def _vencimento_assinatura(base_dt: date, plano: str | None) -> date:
+    """Vencimento do ciclo: base + dias do plano, ajustado p/ o próximo dia útil BR."""
+    return _proximo_dia_util_br(base_dt + timedelta(days=_dias_ciclo_plano(plano)))
 # ===========================================================================
 
 def _public_base_url() -> str:
@@ -713,53 +1347,10 @@ def gerar_token(email):
 def enviar_email_recuperacao(email, nome_empresa=""):
     token = gerar_token(email)
     link = url_for('redefinir_senha', token=token, _external=True)
-    html = render_template_string("""
-<!doctype html>
-<html lang="pt-br">
-  <body style="margin:0;padding:0;background:#F7F7FA;font-family:-apple-system,Segoe UI,Roboto,Helvetica,Arial,sans-serif;color:#1e1b2b;">
-    <table role="presentation" width="100%" cellspacing="0" cellpadding="0" style="background:#F7F7FA;padding:24px 0;">
-      <tr><td align="center">
-        <table role="presentation" width="600" cellspacing="0" cellpadding="0" style="max-width:600px;width:100%;background:#fff;border:1px solid #eee;border-radius:12px;">
-          <tr><td style="padding:22px 24px;border-bottom:1px solid #f0f0f0;">
-            <h2 style="margin:0;font-size:20px;line-height:1.25;font-weight:800;">Redefinição de Senha</h2>
-          </td></tr>
-          <tr><td style="padding:22px 24px;">
-            <p style="margin:0 0 10px 0;line-height:1.55;">Olá <strong>{{ nome }}</strong>,</p>
-            <p style="margin:0 0 16px 0;line-height:1.55;">
-              Clique no botão abaixo para criar uma nova senha. Este link é válido por <strong>1 hora</strong>.
-            </p>
-            <table role="presentation" cellspacing="0" cellpadding="0" style="margin:18px 0 10px 0;">
-              <tr><td align="center" bgcolor="#8A00FF" style="border-radius:9999px;">
-                <a href="{{ link }}" target="_blank"
-                   style="display:inline-block;padding:12px 24px;border-radius:9999px;background:#8A00FF;color:#fff;text-decoration:none;font-weight:800;font-size:16px;line-height:1;">
-                  Redefinir senha
-                </a>
-              </td></tr>
-            </table>
-            <p style="margin:14px 0 0 0;font-size:13px;color:#6b6b6b;line-height:1.5;">
-              Se o botão não funcionar, copie e cole este link no navegador:<br>
-              <a href="{{ link }}" target="_blank" style="color:#5b2fff;word-break:break-all;">{{ link }}</a>
-            </p>
-          </td></tr>
-          <tr><td style="padding:16px 24px;border-top:1px solid #f0f0f0;color:#6b6b6b;font-size:12px;">
-            Você recebeu este e-mail porque solicitou redefinição de senha no AcheTece.
-            Se não foi você, ignore esta mensagem.
-          </td></tr>
-        </table>
-      </td></tr>
-    </table>
-  </body>
-</html>
-    """, nome=(nome_empresa or email), link=link)
-
-    ok, _ = _smtp_send_direct(
-        to=email,
-        subject="Redefinição de Senha - AcheTece",
-        html=html,
-        text=f"Para redefinir sua senha (válido por 1h), acesse: {link}",
-    )
-    if not ok:
-        raise RuntimeError("Falha ao enviar e-mail de recuperação.")
+    m = email_render("recuperacao_senha", nome=(nome_empresa or email), link=link)
+    msg_id = email_enfileirar(email, m.subject, m.html, m.text, tipo="reset", prioridade=10)
+    if msg_id is None:
+        raise RuntimeError("Falha ao enfileirar e-mail de recuperação.")
 
 def login_admin_requerido(f):
     @wraps(f)
@@ -827,6 +1418,42 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_opts
 db.init_app(app)
 
+# --- Contador de SQL por request (guarda contra N+1) --------------------------
+# Conta os statements executados enquanto a VIEW roda (o before_request zera o
+# contador depois dos checks de DB/bootstrap). Endpoints com orçamento em
+# SQL_BUDGETS geram warning quando estouram; com SQL_BUDGET_STRICT=1 (dev/CI)
+# o estouro vira erro 500 para a regressão não passar despercebida.
+# Desligado por padrão: listener e hooks só são registrados com SQL_CONTAR=1
+# (ligado junto com SQL_BUDGET_STRICT ou SQL_COUNT_HEADER). Os testes em
+# tests/test_sql_budgets.py conferem os orçamentos.
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from flask import has_app_context
+
+SQL_BUDGETS: dict[str, int] = {
+    "index": 8,        # versão do catálogo + (rebuild) | count + página + facetas (SQL)
+    "api_teares": 8,   # idem; 304 custa no máximo a leitura da versão
+    "analytics_beacon": 0,  # só enfileira (gravação é em lote, fora do request)
+    "painel_malharia": 6,   # empresa + usuário (memo em g) + teares; folga p/ rebaixar status vencido
+}
+SQL_BUDGET_STRICT = _env_bool("SQL_BUDGET_STRICT", False)
+SQL_COUNT_HEADER = _env_bool("SQL_COUNT_HEADER", False)
+SQL_CONTAR = _env_bool("SQL_CONTAR", SQL_BUDGET_STRICT or SQL_COUNT_HEADER)
+
+class SqlBudgetExceeded(RuntimeError):
+    pass
+
+def _sql_contar(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g._sql_count = getattr(g, "_sql_count", 0) + 1
+
+if SQL_CONTAR:
+    event.listen(Engine, "before_cursor_execute", _sql_contar)
+
+def sql_contador() -> int:
+    """Quantidade de statements SQL executados no request atual (desde a view)."""
+    return getattr(g, "_sql_count", 0) if has_app_context() else 0
+
 # --- DB status + offline page (checa DB por request) -------------------------
 _DB_READY = None
 _DB_LAST_CHECK = 0
@@ -884,7 +1511,7 @@ def _offline_guard():
     if getattr(g, "db_up", True):
         return
     p = request.path or "/"
-    if p.startswith("/static/") or p in {"/favicon.ico", "/robots.txt", "/sitemap.xml"}:
+    if p.startswith(("/static/", "/assets/")) or p in {"/favicon.ico", "/robots.txt", "/sitemap.xml"}:
         return
     return _render_offline()
 
@@ -896,79 +1523,1019 @@ ALLOWED_EVENTS = {
     'TEAR_DETAIL_VIEW',
 }
 
-def track_event(event: str, company_id: int, tear_id: int | None = None, meta: dict | None = None):
-    if event not in ALLOWED_EVENTS:
-        return
-    try:
-        with db.engine.begin() as conn:
-            conn.execute(
-                text("""
-                    INSERT INTO analytics_events (company_id, tear_id, event, session_id, meta)
-                    VALUES (:cid, :tid, :evt, :sid, :meta)
-                """),
-                {
-                    "cid": company_id,
-                    "tid": tear_id,
-                    "evt": event,
-                    "sid": session.get("_sid") or request.cookies.get("session") or "",
-                    "meta": json.dumps(meta or {}),
-                },
-            )
-    except Exception:
-        app.logger.exception("[analytics] falha ao registrar evento")
+# ---------------------------------------------------------------------
+# Gravação em lote: os eventos vão para um buffer em memória (por processo)
+# e uma thread descarrega a cada ANALYTICS_BATCH eventos ou ANALYTICS_FLUSH_MS
+# (INSERT multi-linha; COPY no Postgres). O request não espera commit.
+# Buffer cheio -> espera curta (backpressure) e depois descarta com contador.
+# ---------------------------------------------------------------------
+import atexit
+import threading
+from collections import deque
+
+ANALYTICS_ASYNC = _env_bool("ANALYTICS_ASYNC", True)
+ANALYTICS_BATCH = int(os.getenv("ANALYTICS_BATCH", "200"))
+ANALYTICS_FLUSH_MS = int(os.getenv("ANALYTICS_FLUSH_MS", "1000"))
+ANALYTICS_BUFFER_MAX = int(os.getenv("ANALYTICS_BUFFER_MAX", "20000"))
+ANALYTICS_BACKPRESSURE_MS = int(os.getenv("ANALYTICS_BACKPRESSURE_MS", "5"))
+
+_ANALYTICS_COLS = ("ts", "company_id", "tear_id", "event", "session_id", "meta")
+_ANALYTICS_AO_GRAVAR: list = []
+_ANALYTICS_ID_MAX = 2**31 - 1  # company_id/tear_id são INTEGER no Postgres
+
+def _analytics_id(valor, obrigatorio: bool = False) -> int | None:
+    """Id válido (1..INTEGER) ou ValueError: evento ruim nunca chega ao lote."""
+    if valor in (None, "", 0) and not obrigatorio:
+        return None
+    n = int(valor)
+    if not 0 < n <= _ANALYTICS_ID_MAX:
+        raise ValueError(f"id fora da faixa: {valor!r}")
+    return n
+
+def analytics_ao_gravar(fn):
+    """Decorator: fn(company_ids) roda após cada lote gravado (ex.: invalidar caches)."""
+    _ANALYTICS_AO_GRAVAR.append(fn)
+    return fn
+
+class _AnalyticsWriter:
+    def __init__(self):
+        self._buf: deque = deque()
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+        self._pid = None
+        self._fechando = False
+        self.stats = {"enfileirados": 0, "gravados": 0, "descartados": 0,
+                      "falhas": 0, "lotes": 0, "ultimo_lote_ms": 0.0}
+
+    # ---- produtor (request) ----
+    def put(self, linha: tuple) -> bool:
+        if not ANALYTICS_ASYNC:
+            self._gravar([linha])
+            return True
+        self._garantir_thread()
+        with self._cond:
+            if len(self._buf) >= ANALYTICS_BUFFER_MAX:
+                self._cond.notify_all()
+                self._cond.wait(ANALYTICS_BACKPRESSURE_MS / 1000.0)
+                if len(self._buf) >= ANALYTICS_BUFFER_MAX:
+                    self.stats["descartados"] += 1
+                    return False
+            self._buf.append(linha)
+            self.stats["enfileirados"] += 1
+            if len(self._buf) >= ANALYTICS_BATCH:
+                self._cond.notify_all()
+        return True
+
+    # ---- consumidor (thread) ----
+    def _garantir_thread(self):
+        # após fork (gunicorn) a thread do processo pai não existe no filho
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="analytics-writer", daemon=True)
+            self._thread.start()
+
+    def _retirar_lote(self) -> list:
+        lote = []
+        while self._buf and len(lote) < ANALYTICS_BATCH:
+            lote.append(self._buf.popleft())
+        return lote
+
+    def _loop(self):
+        intervalo = ANALYTICS_FLUSH_MS / 1000.0
+        while True:
+            with self._cond:
+                if not self._fechando and len(self._buf) < ANALYTICS_BATCH:
+                    self._cond.wait(intervalo)  # acorda por lote cheio, prazo ou close()
+                lote = self._retirar_lote()
+                self._cond.notify_all()         # libera produtores em backpressure
+            if lote:
+                self._descarregar(lote)
+            if self._fechando and not self._buf:
+                return
+
+    def _descarregar(self, lote: list):
+        try:
+            with app.app_context():
+                self._gravar(lote)
+            return
+        except (OperationalError, InterfaceError):
+            self._devolver(lote, "banco indisponível")
+            return
+        except Exception:
+            self.stats["falhas"] += 1
+            app.logger.exception("[analytics] falha ao gravar lote (%d eventos); tentando um a um", len(lote))
+
+        # Erro de dado (overflow, tipo...): um evento ruim não pode travar o lote
+        # inteiro para sempre. Grava linha a linha e descarta só as que falham.
+        for i, linha in enumerate(lote):
+            try:
+                with app.app_context():
+                    self._gravar([linha])
+            except (OperationalError, InterfaceError):
+                self._devolver(lote[i:], "banco indisponível")
+                return
+            except Exception as e:
+                self.stats["descartados"] += 1
+                app.logger.warning(f"[analytics] evento descartado ({e.__class__.__name__}): {linha[1:4]}")
+
+    def _devolver(self, lote: list, motivo: str):
+        """Falha transitória: devolve para a frente da fila se couber; senão descarta."""
+        self.stats["falhas"] += 1
+        app.logger.warning("[analytics] %s; %d eventos voltam para a fila", motivo, len(lote))
+        with self._cond:
+            espaco = max(0, ANALYTICS_BUFFER_MAX - len(self._buf))
+            volta = lote[:espaco]
+            self._buf.extendleft(reversed(volta))
+            self.stats["descartados"] += len(lote) - len(volta)
+        time.sleep(min(5.0, ANALYTICS_FLUSH_MS / 1000.0))
+
+    def _gravar(self, lote: list):
+        t0 = time.perf_counter()
+        with db.engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                try:
+                    raw = conn.connection.driver_connection
+                    with raw.cursor() as cur:
+                        with cur.copy(f"COPY analytics_events ({', '.join(_ANALYTICS_COLS)}) FROM STDIN") as cp:
+                            for linha in lote:
+                                cp.write_row(linha)
+                    lote_ok = True
+                except AttributeError:
+                    lote_ok = False  # driver sem COPY (ex.: psycopg2) -> INSERT multi-linha
+            else:
+                lote_ok = False
+            if not lote_ok:
+                conn.execute(
+                    text("""
+                        INSERT INTO analytics_events (ts, company_id, tear_id, event, session_id, meta)
+                        VALUES (:ts, :cid, :tid, :evt, :sid, :meta)
+                    """),
+                    [dict(zip(("ts", "cid", "tid", "evt", "sid", "meta"), linha)) for linha in lote],
+                )
+        self.stats["gravados"] += len(lote)
+        self.stats["lotes"] += 1
+        self.stats["ultimo_lote_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        empresas = {linha[1] for linha in lote}
+        for fn in _ANALYTICS_AO_GRAVAR:
+            try:
+                fn(empresas)
+            except Exception:
+                app.logger.exception("[analytics] hook pós-gravação falhou")
+
+    def flush(self, timeout: float = 10.0):
+        """Descarrega tudo de forma síncrona (shutdown / scripts)."""
+        fim = time.monotonic() + timeout
+        while time.monotonic() < fim:
+            with self._cond:
+                lote = self._retirar_lote()
+            if not lote:
+                return
+            self._descarregar(lote)
+
+    def close(self):
+        with self._cond:
+            self._fechando = True
+            self._cond.notify_all()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout=5.0)
+        self.flush()
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return dict(self.stats, pendentes=len(self._buf))
+
+_ANALYTICS_WRITER = _AnalyticsWriter()
+atexit.register(_ANALYTICS_WRITER.close)
+
+def analytics_enqueue(event: str, company_id: int, tear_id: int | None = None,
+                      session_id: str = "", meta: dict | None = None) -> bool:
+    """Enfileira um evento (não toca no banco no caminho do request)."""
+    if event not in ALLOWED_EVENTS:
+        return False
+    return _ANALYTICS_WRITER.put((
+        datetime.utcnow(), _analytics_id(company_id, obrigatorio=True), _analytics_id(tear_id),
+        event, (session_id or "")[:255], json.dumps(meta or {}),
+    ))
+
+def _analytics_sid() -> str:
+    """Id aleatório do visitante, criado uma vez e guardado na sessão (base do HLL)."""
+    sid = session.get("_sid")
+    if not sid:
+        sid = session["_sid"] = uuid.uuid4().hex
+    return sid
+
+def track_event(event: str, company_id: int, tear_id: int | None = None, meta: dict | None = None):
+    if event not in ALLOWED_EVENTS:
+        return
+    try:
+        analytics_enqueue(event, company_id, tear_id, session_id=_analytics_sid(), meta=meta)
+    except Exception:
+        app.logger.exception("[analytics] falha ao registrar evento")
+
+def _init_analytics_table():
+    dialect = db.engine.url.get_backend_name()
+    if dialect == "sqlite":
+        pk = "INTEGER PRIMARY KEY AUTOINCREMENT"
+        ts_default = "CURRENT_TIMESTAMP"
+        ins_default = "CURRENT_TIMESTAMP"  # já é UTC no SQLite
+    else:
+        pk = "BIGSERIAL PRIMARY KEY"
+        ts_default = "CURRENT_TIMESTAMP"
+        ins_default = "(now() AT TIME ZONE 'utc')"
+
+    # Postgres: instalação nova já nasce particionada por mês (ts)
+    particionar = dialect == "postgresql" and ANALYTICS_PARTICIONAR
+    pk_composta, particao = "", ""
+    if particionar:
+        pk = "BIGSERIAL"
+        pk_composta = ",\n            PRIMARY KEY (id, ts)"
+        particao = " PARTITION BY RANGE (ts)"
+    ddl = f"""
+        CREATE TABLE IF NOT EXISTS analytics_events (
+            id {pk},
+            ts TIMESTAMP NOT NULL DEFAULT {ts_default},
+            company_id INTEGER NOT NULL,
+            tear_id INTEGER,
+            event TEXT NOT NULL,
+            session_id TEXT,
+            meta TEXT,
+            inserted_at TIMESTAMP DEFAULT {ins_default}{pk_composta}
+        ){particao}
+    """
+    idx1 = "CREATE INDEX IF NOT EXISTS idx_ae_company_ts ON analytics_events(company_id, ts)"
+    idx2 = "CREATE INDEX IF NOT EXISTS idx_ae_event_ts   ON analytics_events(event, ts)"
+
+    # Rollup diário (mantido pela compactação) + marcas d'água dos jobs
+    ddl_daily = """
+        CREATE TABLE IF NOT EXISTS analytics_daily (
+            company_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            event TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            unique_sessions INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (company_id, day, event)
+        )
+    """
+    # Mesmo rollup por tear (funil impressão -> perfil -> WhatsApp)
+    ddl_daily_tear = """
+        CREATE TABLE IF NOT EXISTS analytics_daily_tear (
+            company_id INTEGER NOT NULL,
+            tear_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            event TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (company_id, tear_id, day, event)
+        )
+    """
+    ddl_state = """
+        CREATE TABLE IF NOT EXISTS analytics_state (
+            nome TEXT PRIMARY KEY,
+            valor BIGINT NOT NULL DEFAULT 0,
+            atualizado_em TIMESTAMP
+        )
+    """
+
+    with db.engine.begin() as conn:
+        conn.execute(text(ddl))
+        if particionar:
+            _pg_migrar_para_particoes(conn)
+        conn.execute(text(idx1))
+        conn.execute(text(idx2))
+        conn.execute(text(ddl_daily))
+        conn.execute(text(ddl_state))
+        novo_por_tear = not inspect(conn).has_table("analytics_daily_tear")
+        conn.execute(text(ddl_daily_tear))
+        if novo_por_tear:
+            # o bruto já consolidado (id <= marca) entra aos poucos pelo
+            # analytics_backfill_por_tear; a marca do rollup não muda
+            _analytics_state_set(conn, _BACKFILL_TEAR, 0)
+            _analytics_state_set(conn, _BACKFILL_TEAR_ATE, _analytics_state_get(conn, _ROLLUP_WM))
+
+    if particionar:
+        # transação própria: problema com partição não impede o analytics de
+        # subir (a DEFAULT segura os eventos; o ciclo de vida tenta de novo)
+        try:
+            with db.engine.begin() as conn:
+                _pg_garantir_particoes(conn)
+        except Exception:
+            app.logger.exception("[analytics] falha ao criar partições; nova tentativa no ciclo de vida")
+
+    # hora em que o BANCO gravou a linha (ts é a hora do enfileiramento, que
+    # pode ser antiga quando o writer devolve um lote à fila). SQLite não aceita
+    # ADD COLUMN com default não constante: linhas sem valor usam ts.
+    if "inserted_at" not in {c["name"] for c in inspect(db.engine).get_columns("analytics_events")}:
+        default = "" if dialect == "sqlite" else f" DEFAULT {ins_default}"
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f"ALTER TABLE analytics_events ADD COLUMN inserted_at TIMESTAMP{default}")
+
+    cols = {c["name"] for c in inspect(db.engine).get_columns("analytics_daily")}
+    if "sketch" not in cols:
+        tipo = "BLOB" if dialect == "sqlite" else "BYTEA"
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f"ALTER TABLE analytics_daily ADD COLUMN sketch {tipo}")
+
+# ---------------------------------------------------------------------
+# Tarefas periódicas (thread por processo). Em vários workers, quem precisa
+# de exclusividade usa _lock_global() dentro da transação.
+# ---------------------------------------------------------------------
+_TAREFAS: dict[str, tuple[float, object]] = {}
+_TAREFAS_PID = None
+
+def tarefa_periodica(nome: str, intervalo_seg: float):
+    """Decorator: registra fn() para rodar a cada `intervalo_seg` (0 desliga)."""
+    def deco(fn):
+        if intervalo_seg and intervalo_seg > 0:
+            _TAREFAS[nome] = (float(intervalo_seg), fn)
+        return fn
+    return deco
+
+def _iniciar_tarefas_periodicas():
+    global _TAREFAS_PID
+    if _TAREFAS_PID == os.getpid():
+        return
+    _TAREFAS_PID = os.getpid()
+
+    def loop(nome, intervalo, fn):
+        time.sleep(random.uniform(0, min(intervalo, 30)))  # espalha os workers
+        while True:
+            try:
+                with app.app_context():
+                    fn()
+            except Exception:
+                app.logger.exception("[TAREFA] %s falhou", nome)
+            time.sleep(intervalo)
+
+    for nome, (intervalo, fn) in _TAREFAS.items():
+        threading.Thread(target=loop, args=(nome, intervalo, fn), name=f"tarefa-{nome}", daemon=True).start()
+
+def _lock_global(conn, nome: str) -> bool:
+    """Lock exclusivo até o fim da transação (advisory lock no Postgres)."""
+    if conn.dialect.name != "postgresql":
+        return True
+    return bool(conn.execute(text("SELECT pg_try_advisory_xact_lock(hashtext(:n))"), {"n": nome}).scalar())
+
+def _analytics_state_get(conn, nome: str) -> int:
+    v = conn.execute(text("SELECT valor FROM analytics_state WHERE nome = :n"), {"n": nome}).scalar()
+    return int(v or 0)
+
+def _analytics_state_set(conn, nome: str, valor: int) -> None:
+    upd = conn.execute(
+        text("UPDATE analytics_state SET valor = :v, atualizado_em = :t WHERE nome = :n"),
+        {"n": nome, "v": int(valor), "t": datetime.utcnow()},
+    )
+    if not upd.rowcount:
+        conn.execute(
+            text("INSERT INTO analytics_state (nome, valor, atualizado_em) VALUES (:n, :v, :t)"),
+            {"n": nome, "v": int(valor), "t": datetime.utcnow()},
+        )
+
+def _as_date(v):
+    if isinstance(v, datetime):
+        return v.date()
+    if isinstance(v, str):
+        return datetime.strptime(v[:10], "%Y-%m-%d").date()
+    return v
+
+def _as_datetime(v):
+    # SQLite devolve DATETIME como texto em SQL cru
+    if isinstance(v, str):
+        return datetime.fromisoformat(v)
+    return v
+
+# ---------------------------------------------------------------------
+# HyperLogLog: visitantes únicos aproximados (p=11 -> erro ~2,3%), um sketch
+# por (empresa, dia, evento) guardado em analytics_daily.sketch. Sketches
+# se combinam (max por registrador), então qualquer período sai do rollup
+# sem COUNT(DISTINCT) no bruto. Serialização: b"S" + (idx,val) esparso para
+# poucos registradores ocupados; b"D" + registradores densos no resto.
+# ---------------------------------------------------------------------
+import math
+import struct
+
+class HyperLogLog:
+    P = 11
+    M = 1 << P
+    __slots__ = ("reg",)
+
+    def __init__(self, reg: bytes | bytearray | None = None):
+        self.reg = bytearray(reg) if reg is not None else bytearray(self.M)
+
+    def add(self, valor: str) -> None:
+        h = int.from_bytes(hashlib.blake2b(str(valor).encode("utf-8"), digest_size=8).digest(), "big")
+        idx = h >> (64 - self.P)
+        w = h & ((1 << (64 - self.P)) - 1)
+        rank = (64 - self.P) - w.bit_length() + 1
+        if rank > self.reg[idx]:
+            self.reg[idx] = rank
+
+    def merge(self, outro: "HyperLogLog") -> "HyperLogLog":
+        self.reg = bytearray(map(max, self.reg, outro.reg))
+        return self
+
+    def estimativa(self) -> int:
+        m = self.M
+        zeros = self.reg.count(0)
+        if zeros == m:
+            return 0
+        alpha = 0.7213 / (1 + 1.079 / m)
+        e = alpha * m * m / sum(2.0 ** -r for r in self.reg)
+        if e <= 2.5 * m and zeros:
+            e = m * math.log(m / zeros)  # linear counting (cardinalidade baixa)
+        return int(round(e))
+
+    def to_bytes(self) -> bytes:
+        ocupados = [(i, v) for i, v in enumerate(self.reg) if v]
+        if len(ocupados) * 3 < self.M:
+            return b"S" + b"".join(struct.pack(">HB", i, v) for i, v in ocupados)
+        return b"D" + bytes(self.reg)
+
+    @classmethod
+    def from_bytes(cls, dados) -> "HyperLogLog":
+        h = cls()
+        dados = bytes(dados or b"")
+        if dados[:1] == b"D" and len(dados) == cls.M + 1:
+            h.reg = bytearray(dados[1:])
+        elif dados[:1] == b"S":
+            for i, v in struct.iter_unpack(">HB", dados[1:]):
+                h.reg[i] = v
+        return h
+
+# ---------------------------------------------------------------------
+# Compactação: analytics_events -> analytics_daily
+# Marca d'água = maior analytics_events.id já consolidado. Cada rodada pega
+# só os ids novos (marca, ate] e SOMA as contagens deles nos rollups (sketch
+# HLL combinado). Nada é recalculado a partir do bruto: depois que um mês é
+# rotacionado/arquivado, um evento atrasado daquele dia só acrescenta. O
+# painel soma rollup + bruto com id > marca sem duplicar.
+# ---------------------------------------------------------------------
+ANALYTICS_ROLLUP_SEG = float(os.getenv("ANALYTICS_ROLLUP_SEG", "300"))
+ANALYTICS_ROLLUP_LAG_SEG = int(os.getenv("ANALYTICS_ROLLUP_LAG_SEG", "60"))
+# Ids são reservados no INSERT, mas a linha só aparece no COMMIT: um writer
+# pode publicar 500-999 enquanto outro ainda segura 400-499. A marca para
+# antes de buraco recente na sequência; buraco mais velho que isto é rollback.
+ANALYTICS_ROLLUP_LACUNA_SEG = int(os.getenv("ANALYTICS_ROLLUP_LACUNA_SEG", "600"))
+_ROLLUP_WM = "rollup_daily"
+
+def _rollup_somar_diario(conn, ini_id: int, ate_id: int) -> int:
+    """Soma os eventos com ini_id < id <= ate_id em analytics_daily. Devolve nº de grupos."""
+    faixa = {"ini": ini_id, "ate": ate_id}
+    novos = conn.execute(
+        text("""
+            SELECT company_id, DATE(ts), event, COUNT(*)
+              FROM analytics_events
+             WHERE id > :ini AND id <= :ate
+             GROUP BY company_id, DATE(ts), event
+        """),
+        faixa,
+    ).all()
+    sketches: dict[tuple, HyperLogLog] = {}
+    for company_id, dia, event, sid in conn.execute(
+        text("""
+            SELECT DISTINCT company_id, DATE(ts), event, session_id
+              FROM analytics_events
+             WHERE id > :ini AND id <= :ate
+               AND session_id IS NOT NULL AND session_id <> ''
+        """),
+        faixa,
+    ):
+        sketches.setdefault((int(company_id), _as_date(dia), event), HyperLogLog()).add(sid)
+
+    for company_id, dia, event, n in novos:
+        chave = {"c": int(company_id), "d": _as_date(dia), "e": event}
+        hll = sketches.get((chave["c"], chave["d"], event)) or HyperLogLog()
+        atual = conn.execute(
+            text("SELECT unique_sessions, sketch FROM analytics_daily WHERE company_id = :c AND day = :d AND event = :e"),
+            chave,
+        ).first()
+        if atual is None:
+            conn.execute(
+                text("""
+                    INSERT INTO analytics_daily (company_id, day, event, count, unique_sessions, sketch)
+                    VALUES (:c, :d, :e, :n, :u, :sk)
+                """),
+                {**chave, "n": int(n), "u": hll.estimativa(), "sk": hll.to_bytes()},
+            )
+            continue
+        if atual[1] is not None:
+            hll.merge(HyperLogLog.from_bytes(atual[1]))
+        conn.execute(
+            text("""
+                UPDATE analytics_daily SET count = count + :n, unique_sessions = :u, sketch = :sk
+                 WHERE company_id = :c AND day = :d AND event = :e
+            """),
+            {**chave, "n": int(n), "u": max(int(atual[0] or 0), hll.estimativa()), "sk": hll.to_bytes()},
+        )
+    return len(novos)
+
+def _rollup_somar_por_tear(conn, ini_id: int, ate_id: int) -> int:
+    """Soma os eventos com tear (ini_id < id <= ate_id) em analytics_daily_tear."""
+    novos = conn.execute(
+        text("""
+            SELECT company_id, tear_id, DATE(ts), event, COUNT(*)
+              FROM analytics_events
+             WHERE id > :ini AND id <= :ate AND tear_id IS NOT NULL
+             GROUP BY company_id, tear_id, DATE(ts), event
+        """),
+        {"ini": ini_id, "ate": ate_id},
+    ).all()
+    for company_id, tear_id, dia, event, n in novos:
+        chave = {"c": int(company_id), "t": int(tear_id), "d": _as_date(dia), "e": event, "n": int(n)}
+        upd = conn.execute(
+            text("""
+                UPDATE analytics_daily_tear SET count = count + :n
+                 WHERE company_id = :c AND tear_id = :t AND day = :d AND event = :e
+            """),
+            chave,
+        )
+        if not upd.rowcount:
+            conn.execute(
+                text("""
+                    INSERT INTO analytics_daily_tear (company_id, tear_id, day, event, count)
+                    VALUES (:c, :t, :d, :e, :n)
+                """),
+                chave,
+            )
+    return len(novos)
+
+@tarefa_periodica("rollup_daily", ANALYTICS_ROLLUP_SEG)
+def analytics_compactar() -> dict:
+    """Consolida eventos novos em analytics_daily. Idempotente; seguro em vários workers."""
+    t0 = time.perf_counter()
+    with db.engine.begin() as conn:
+        if not _lock_global(conn, "analytics_rollup"):
+            return {"ok": True, "pulado": "lock"}
+        wm = _analytics_state_get(conn, _ROLLUP_WM)
+        agora = datetime.utcnow()
+        corte = agora - timedelta(seconds=ANALYTICS_ROLLUP_LAG_SEG)
+        ate = conn.execute(
+            text("SELECT MAX(id) FROM analytics_events WHERE id > :wm AND COALESCE(inserted_at, ts) < :corte"),
+            {"wm": wm, "corte": corte},
+        ).scalar()
+        if ate:
+            lacuna = conn.execute(
+                text("""
+                    SELECT COALESCE(anterior, :wm) FROM (
+                        SELECT id, COALESCE(inserted_at, ts) AS gravado,
+                               LAG(id) OVER (ORDER BY id) AS anterior
+                          FROM analytics_events
+                         WHERE id > :wm AND id <= :ate
+                    ) t
+                     WHERE id - COALESCE(anterior, :wm) > 1 AND gravado >= :recente
+                     ORDER BY id
+                     LIMIT 1
+                """),
+                {"wm": wm, "ate": int(ate),
+                 "recente": agora - timedelta(seconds=ANALYTICS_ROLLUP_LACUNA_SEG)},
+            ).scalar()
+            if lacuna is not None:
+                ate = int(lacuna)  # para antes do buraco: pode ser transação ainda aberta
+        if not ate or int(ate) <= wm:
+            return {"ok": True, "grupos": 0, "marca": wm}
+        grupos = _rollup_somar_diario(conn, wm, int(ate))
+        _rollup_somar_por_tear(conn, wm, int(ate))
+        _analytics_state_set(conn, _ROLLUP_WM, int(ate))
+
+    res = {"ok": True, "grupos": grupos, "marca": int(ate),
+           "ms": round((time.perf_counter() - t0) * 1000, 1)}
+    app.logger.info({"rota": "analytics_compactar", **res})
+    return res
+
+# Backfill de analytics_daily_tear (tabela criada depois do rollup diário):
+# soma, em lotes de ids, o bruto que já estava consolidado quando a tabela
+# nasceu, sem mexer na marca do rollup (que o painel usa para não somar o
+# bruto duas vezes). Ids acima dessa marca entram pelo rollup normal.
+ANALYTICS_BACKFILL_LOTE = int(os.getenv("ANALYTICS_BACKFILL_LOTE", "20000"))
+_BACKFILL_TEAR = "backfill_daily_tear"          # último id já reprocessado
+_BACKFILL_TEAR_ATE = "backfill_daily_tear_ate"  # marca do rollup quando a tabela nasceu
+
+@tarefa_periodica("backfill_daily_tear", ANALYTICS_ROLLUP_SEG)
+def analytics_backfill_por_tear() -> dict:
+    """Um lote do backfill por tear (cada chamada é uma transação curta)."""
+    with db.engine.begin() as conn:
+        if not _lock_global(conn, "analytics_rollup"):
+            return {"ok": True, "pulado": "lock"}
+        feito = _analytics_state_get(conn, _BACKFILL_TEAR)
+        ate = _analytics_state_get(conn, _BACKFILL_TEAR_ATE)
+        if feito >= ate:
+            return {"ok": True, "grupos": 0, "pendente": 0}
+        fim = min(ate, feito + ANALYTICS_BACKFILL_LOTE)
+        grupos = _rollup_somar_por_tear(conn, feito, fim)
+        _analytics_state_set(conn, _BACKFILL_TEAR, fim)
+
+    res = {"ok": True, "grupos": grupos, "feito": fim, "pendente": ate - fim}
+    app.logger.info({"rota": "analytics_backfill_por_tear", **res})
+    return res
+
+def _analytics_marca_consolidada(conn) -> int:
+    """Até onde o bruto já pode sair da tabela quente (rollup e backfill por tear)."""
+    wm = _analytics_state_get(conn, _ROLLUP_WM)
+    feito = _analytics_state_get(conn, _BACKFILL_TEAR)
+    if feito < _analytics_state_get(conn, _BACKFILL_TEAR_ATE):
+        return min(wm, feito)
+    return wm
+
+EVENTOS_VISITA = ("CARD_IMPRESSION", "COMPANY_PROFILE_VIEW", "TEAR_DETAIL_VIEW")
+EVENTOS_CONTATO = ("CONTACT_CLICK_WHATSAPP",)
+
+def get_performance(company_id, dt_ini=None, dt_fim=None):
+    """
+    Série diária (visitas/contatos) da empresa: dias consolidados vêm de
+    analytics_daily; o bruto só é lido para o que ainda está acima da marca
+    d'água (na prática, as últimas horas).
+    """
+    por_dia: dict = {}
+
+    def somar(dia, event, n):
+        d = por_dia.setdefault(_as_date(dia), {"visitas": 0, "contatos": 0})
+        if event in EVENTOS_VISITA:
+            d["visitas"] += int(n)
+        elif event in EVENTOS_CONTATO:
+            d["contatos"] += int(n)
+
+    params = {"cid": company_id}
+    where_d, where_r = ["company_id = :cid"], ["company_id = :cid", "id > :wm"]
+    if dt_ini:
+        params["dt_ini"] = dt_ini
+        params["d_ini"] = _as_date(dt_ini)
+        where_d.append("day >= :d_ini"); where_r.append("ts >= :dt_ini")
+    if dt_fim:
+        params["dt_fim"] = dt_fim
+        params["d_fim"] = _as_date(dt_fim)
+        where_d.append("day < :d_fim"); where_r.append("ts < :dt_fim")
+
+    with db.engine.connect() as conn:
+        params["wm"] = _analytics_state_get(conn, _ROLLUP_WM)
+        for r in conn.execute(text(f"""
+                SELECT day, event, count FROM analytics_daily WHERE {" AND ".join(where_d)}
+            """), params):
+            somar(r[0], r[1], r[2])
+        for r in conn.execute(text(f"""
+                SELECT DATE(ts), event, COUNT(*) FROM analytics_events
+                 WHERE {" AND ".join(where_r)}
+                 GROUP BY DATE(ts), event
+            """), params):
+            somar(r[0], r[1], r[2])
+
+    series = [{"data": d, "visitas": v["visitas"], "contatos": v["contatos"]}
+              for d, v in sorted(por_dia.items())]
+    total_visitas  = sum(p["visitas"]  for p in series)
+    total_contatos = sum(p["contatos"] for p in series)
+    return total_visitas, total_contatos, series
+
+def get_visitantes_unicos(company_id, dt_ini=None, dt_fim=None, eventos=EVENTOS_VISITA) -> int:
+    """
+    Visitantes únicos (estimativa HLL) no período: combina os sketches diários
+    e acrescenta as sessões do bruto ainda acima da marca d'água.
+    """
+    params = {"cid": company_id, **{f"e{i}": e for i, e in enumerate(eventos)}}
+    em = ", ".join(f":e{i}" for i in range(len(eventos)))
+    where_d, where_r = ["company_id = :cid", f"event IN ({em})"], ["company_id = :cid", "id > :wm", f"event IN ({em})"]
+    if dt_ini:
+        params["dt_ini"], params["d_ini"] = dt_ini, _as_date(dt_ini)
+        where_d.append("day >= :d_ini"); where_r.append("ts >= :dt_ini")
+    if dt_fim:
+        params["dt_fim"], params["d_fim"] = dt_fim, _as_date(dt_fim)
+        where_d.append("day < :d_fim"); where_r.append("ts < :dt_fim")
+
+    hll = HyperLogLog()
+    with db.engine.connect() as conn:
+        params["wm"] = _analytics_state_get(conn, _ROLLUP_WM)
+        for (sk,) in conn.execute(text(f"""
+                SELECT sketch FROM analytics_daily WHERE {" AND ".join(where_d)} AND sketch IS NOT NULL
+            """), params):
+            hll.merge(HyperLogLog.from_bytes(sk))
+        for (sid,) in conn.execute(text(f"""
+                SELECT DISTINCT session_id FROM analytics_events
+                 WHERE {" AND ".join(where_r)} AND session_id IS NOT NULL AND session_id <> ''
+            """), params):
+            hll.add(sid)
+    return hll.estimativa()
+
+EVENTOS_FUNIL = ("CARD_IMPRESSION", "COMPANY_PROFILE_VIEW", "CONTACT_CLICK_WHATSAPP")
+
+def get_funil_teares(company_id, dt_ini=None, dt_fim=None) -> list[dict]:
+    """Impressão -> visita ao perfil -> clique no WhatsApp, por tear."""
+    params = {"cid": company_id, "e0": EVENTOS_FUNIL[0], "e1": EVENTOS_FUNIL[1], "e2": EVENTOS_FUNIL[2]}
+    where_d = ["company_id = :cid", "event IN (:e0, :e1, :e2)"]
+    where_r = ["company_id = :cid", "id > :wm", "tear_id IS NOT NULL", "event IN (:e0, :e1, :e2)"]
+    if dt_ini:
+        params["dt_ini"], params["d_ini"] = dt_ini, _as_date(dt_ini)
+        where_d.append("day >= :d_ini"); where_r.append("ts >= :dt_ini")
+    if dt_fim:
+        params["dt_fim"], params["d_fim"] = dt_fim, _as_date(dt_fim)
+        where_d.append("day < :d_fim"); where_r.append("ts < :dt_fim")
+
+    funil: dict[int, dict] = {}
+    with db.engine.connect() as conn:
+        params["wm"] = _analytics_state_get(conn, _ROLLUP_WM)
+        linhas = list(conn.execute(text(f"""
+            SELECT tear_id, event, SUM(count) FROM analytics_daily_tear
+             WHERE {" AND ".join(where_d)} GROUP BY tear_id, event
+        """), params))
+        linhas += list(conn.execute(text(f"""
+            SELECT tear_id, event, COUNT(*) FROM analytics_events
+             WHERE {" AND ".join(where_r)} GROUP BY tear_id, event
+        """), params))
+    for tear_id, event, n in linhas:
+        f = funil.setdefault(int(tear_id), {"impressoes": 0, "perfil": 0, "whatsapp": 0})
+        f[{"CARD_IMPRESSION": "impressoes", "COMPANY_PROFILE_VIEW": "perfil",
+           "CONTACT_CLICK_WHATSAPP": "whatsapp"}[event]] += int(n or 0)
+    if not funil:
+        return []
+
+    nomes = {t.id: " ".join(str(x) for x in (t.tipo, t.marca, t.modelo) if x)
+             for t in Tear.query.with_entities(Tear.id, Tear.tipo, Tear.marca, Tear.modelo)
+                                .filter(Tear.id.in_(list(funil))).all()}
+    saida = []
+    for tear_id, f in funil.items():
+        base = f["impressoes"] or 0
+        saida.append({
+            "tear_id": tear_id,
+            "tear": nomes.get(tear_id) or f"Tear #{tear_id} (removido)",
+            **f,
+            "taxa_perfil": round(100.0 * f["perfil"] / base, 1) if base else None,
+            "taxa_whatsapp": round(100.0 * f["whatsapp"] / base, 1) if base else None,
+        })
+    saida.sort(key=lambda x: (-x["impressoes"], -x["whatsapp"], x["tear_id"]))
+    return saida
+
+# Cache do painel por (empresa, período): TTL curto e invalidado quando um
+# lote de eventos da empresa é gravado neste processo.
+PERF_CACHE_TTL = float(os.getenv("PERF_CACHE_TTL", "300"))
+_PERF_CACHE: dict = {}
+_PERF_CACHE_LOCK = threading.Lock()
+
+@analytics_ao_gravar
+def _perf_cache_invalidar(company_ids) -> None:
+    with _PERF_CACHE_LOCK:
+        for chave in [k for k in _PERF_CACHE if k[0] in company_ids]:
+            _PERF_CACHE.pop(chave, None)
+
+def _variacao(atual: int, anterior: int):
+    if not anterior:
+        return None
+    return round(100.0 * (atual - anterior) / anterior, 1)
+
+def performance_periodo(company_id: int, ini, fim, comparar: bool = True) -> dict:
+    """
+    Painel de /performance para [ini, fim] (datas, inclusivo): totais, série
+    diária completa, visitantes únicos, funil por tear e o período anterior
+    de mesmo tamanho para comparação.
+    """
+    chave = (company_id, ini, fim, comparar)
+    agora = time.time()
+    with _PERF_CACHE_LOCK:
+        hit = _PERF_CACHE.get(chave)
+    if hit and agora - hit[0] < PERF_CACHE_TTL:
+        return hit[1]
+
+    dt_ini = datetime.combine(ini, datetime.min.time())
+    dt_fim = datetime.combine(fim, datetime.min.time()) + timedelta(days=1)
+    visitas, contatos, series = get_performance(company_id, dt_ini, dt_fim)
+
+    por_dia = {p["data"]: p for p in series}
+    completa, d = [], ini
+    while d <= fim:
+        completa.append(por_dia.get(d) or {"data": d, "visitas": 0, "contatos": 0})
+        d += timedelta(days=1)
+
+    res = {
+        "ini": ini, "fim": fim,
+        "total_visitas": visitas,
+        "total_contatos": contatos,
+        "conversao": round(100.0 * contatos / visitas, 1) if visitas else 0.0,
+        "visitantes_unicos": get_visitantes_unicos(company_id, dt_ini, dt_fim),
+        "series": completa,
+        "funil": get_funil_teares(company_id, dt_ini, dt_fim),
+        "anterior": None,
+    }
+    if comparar:
+        dias = (fim - ini).days + 1
+        a_ini, a_fim = ini - timedelta(days=dias), ini - timedelta(days=1)
+        dta_ini = datetime.combine(a_ini, datetime.min.time())
+        a_vis, a_con, _ = get_performance(company_id, dta_ini, dt_ini)
+        a_uni = get_visitantes_unicos(company_id, dta_ini, dt_ini)
+        res["anterior"] = {
+            "ini": a_ini, "fim": a_fim,
+            "total_visitas": a_vis,
+            "total_contatos": a_con,
+            "visitantes_unicos": a_uni,
+            "conversao": round(100.0 * a_con / a_vis, 1) if a_vis else 0.0,
+            "var_visitas": _variacao(visitas, a_vis),
+            "var_contatos": _variacao(contatos, a_con),
+            "var_unicos": _variacao(res["visitantes_unicos"], a_uni),
+        }
 
-def _init_analytics_table():
-    dialect = db.engine.url.get_backend_name()
-    if dialect == "sqlite":
-        pk = "INTEGER PRIMARY KEY AUTOINCREMENT"
-        ts_default = "CURRENT_TIMESTAMP"
-    else:
-        pk = "BIGSERIAL PRIMARY KEY"
-        ts_default = "CURRENT_TIMESTAMP"
+    with _PERF_CACHE_LOCK:
+        if len(_PERF_CACHE) > 2048:
+            _PERF_CACHE.clear()
+        _PERF_CACHE[chave] = (agora, res)
+    return res
+
+# ---------------------------------------------------------------------
+# Ciclo de vida do bruto (analytics_events)
+#  - Postgres: partições mensais por ts (analytics_events_pYYYYMM) + DEFAULT;
+#    as próximas ANALYTICS_PARTICOES_FUTURAS são criadas com antecedência.
+#  - SQLite: a tabela quente guarda só o mês corrente; meses fechados e já
+#    consolidados são movidos para analytics_events_YYYYMM (rotação).
+# Meses além de ANALYTICS_RETENCAO_MESES, desde que inteiramente abaixo da
+# marca d'água do rollup, são exportados para ANALYTICS_ARQUIVO_DIR
+# (.csv.gz) e descartados (DROP). Tabela e índices quentes ficam pequenos.
+# ---------------------------------------------------------------------
+import gzip
+
+ANALYTICS_PARTICIONAR = _env_bool("ANALYTICS_PARTICIONAR", True)
+ANALYTICS_MIGRAR_PARTICOES = _env_bool("ANALYTICS_MIGRAR_PARTICOES", False)
+ANALYTICS_PARTICOES_FUTURAS = int(os.getenv("ANALYTICS_PARTICOES_FUTURAS", "2"))
+ANALYTICS_RETENCAO_MESES = int(os.getenv("ANALYTICS_RETENCAO_MESES", "6"))
+ANALYTICS_ARQUIVAR = _env_bool("ANALYTICS_ARQUIVAR", True)
+ANALYTICS_ARQUIVO_DIR = os.getenv("ANALYTICS_ARQUIVO_DIR") or os.path.join(BASE_DIR, "analytics_arquivo")
+ANALYTICS_CICLO_VIDA_SEG = float(os.getenv("ANALYTICS_CICLO_VIDA_SEG", "3600"))
+
+def _mes_inicio(d, delta: int = 0) -> datetime:
+    """1º dia do mês de `d`, deslocado `delta` meses."""
+    n = d.year * 12 + (d.month - 1) + delta
+    return datetime(n // 12, n % 12 + 1, 1)
+
+def _pg_particionada(conn) -> bool:
+    kind = conn.execute(text("SELECT relkind FROM pg_class WHERE relname = 'analytics_events'")).scalar()
+    return kind == "p"
+
+def _pg_particoes(conn) -> list[str]:
+    return [r[0] for r in conn.execute(text("""
+        SELECT c.relname
+          FROM pg_inherits i
+          JOIN pg_class c ON c.oid = i.inhrelid
+          JOIN pg_class p ON p.oid = i.inhparent
+         WHERE p.relname = 'analytics_events'
+         ORDER BY c.relname
+    """))]
+
+def _pg_criar_particao(conn, nome: str, ini: datetime, fim: datetime, tem_default: bool) -> None:
+    faixa = f"FROM ('{ini:%Y-%m-%d}') TO ('{fim:%Y-%m-%d}')"
+    presos = tem_default and conn.execute(text(
+        "SELECT 1 FROM analytics_events_default WHERE ts >= :ini AND ts < :fim LIMIT 1"),
+        {"ini": ini, "fim": fim}).first()
+    if not presos:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {nome} PARTITION OF analytics_events FOR VALUES {faixa}"))
+        return
+    # eventos do mês caíram na DEFAULT antes da partição existir: o Postgres
+    # recusa o CREATE ... PARTITION OF; move as linhas e anexa a tabela pronta
+    conn.execute(text(f"CREATE TABLE {nome} (LIKE analytics_events INCLUDING DEFAULTS)"))
+    conn.execute(text(f"""
+        WITH movidos AS (
+            DELETE FROM analytics_events_default WHERE ts >= :ini AND ts < :fim RETURNING *
+        )
+        INSERT INTO {nome} SELECT * FROM movidos
+    """), {"ini": ini, "fim": fim})
+    conn.execute(text(f"ALTER TABLE analytics_events ATTACH PARTITION {nome} FOR VALUES {faixa}"))
+
+def _pg_garantir_particoes(conn) -> list[str]:
+    if not _pg_particionada(conn):
+        return []
+    # rede de segurança: evento fora de qualquer faixa não derruba o lote
+    conn.execute(text("CREATE TABLE IF NOT EXISTS analytics_events_default PARTITION OF analytics_events DEFAULT"))
+    existentes = set(_pg_particoes(conn))
+    criadas = []
+    hoje = datetime.utcnow()
+    for k in range(0, ANALYTICS_PARTICOES_FUTURAS + 1):
+        ini, fim = _mes_inicio(hoje, k), _mes_inicio(hoje, k + 1)
+        nome = f"analytics_events_p{ini:%Y%m}"
+        if nome in existentes:
+            continue
+        try:
+            with conn.begin_nested():  # um mês com problema não derruba os outros
+                _pg_criar_particao(conn, nome, ini, fim, "analytics_events_default" in existentes)
+        except Exception:
+            app.logger.exception("[analytics] falha ao criar partição %s", nome)
+            continue
+        criadas.append(nome)
+    return criadas
 
-    ddl = f"""
-        CREATE TABLE IF NOT EXISTS analytics_events (
-            id {pk},
-            ts TIMESTAMP NOT NULL DEFAULT {ts_default},
+def _pg_migrar_para_particoes(conn) -> None:
+    """Converte a tabela antiga (não particionada). Só com ANALYTICS_MIGRAR_PARTICOES=1."""
+    if _pg_particionada(conn) or not ANALYTICS_MIGRAR_PARTICOES:
+        return
+    app.logger.warning("[analytics] migrando analytics_events para partições mensais")
+    conn.execute(text("ALTER TABLE analytics_events RENAME TO analytics_events_legado"))
+    conn.execute(text("ALTER INDEX IF EXISTS idx_ae_company_ts RENAME TO idx_ae_company_ts_legado"))
+    conn.execute(text("ALTER INDEX IF EXISTS idx_ae_event_ts RENAME TO idx_ae_event_ts_legado"))
+    conn.execute(text("""
+        CREATE TABLE analytics_events (
+            id BIGSERIAL,
+            ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
             company_id INTEGER NOT NULL,
             tear_id INTEGER,
             event TEXT NOT NULL,
             session_id TEXT,
-            meta TEXT
-        )
-    """
-    idx1 = "CREATE INDEX IF NOT EXISTS idx_ae_company_ts ON analytics_events(company_id, ts)"
-    idx2 = "CREATE INDEX IF NOT EXISTS idx_ae_event_ts   ON analytics_events(event, ts)"
+            meta TEXT,
+            PRIMARY KEY (id, ts)
+        ) PARTITION BY RANGE (ts)
+    """))
+    menor = conn.execute(text("SELECT MIN(ts) FROM analytics_events_legado")).scalar()
+    if menor:
+        mes, fim = _mes_inicio(menor), _mes_inicio(datetime.utcnow())
+        while mes < fim:
+            prox = _mes_inicio(mes, 1)
+            conn.execute(text(
+                f"CREATE TABLE analytics_events_p{mes:%Y%m} PARTITION OF analytics_events "
+                f"FOR VALUES FROM ('{mes:%Y-%m-%d}') TO ('{prox:%Y-%m-%d}')"
+            ))
+            mes = prox
+    _pg_garantir_particoes(conn)
+    conn.execute(text("""
+        INSERT INTO analytics_events (id, ts, company_id, tear_id, event, session_id, meta)
+        SELECT id, ts, company_id, tear_id, event, session_id, meta FROM analytics_events_legado
+    """))
+    conn.execute(text("""
+        SELECT setval(pg_get_serial_sequence('analytics_events', 'id'),
+                      GREATEST((SELECT COALESCE(MAX(id), 0) FROM analytics_events), 1))
+    """))
+    conn.execute(text("DROP TABLE analytics_events_legado"))
+
+def _arquivar_tabela(conn, tabela: str) -> str | None:
+    """Exporta `tabela` para ANALYTICS_ARQUIVO_DIR/<tabela>.csv.gz (streaming)."""
+    if not ANALYTICS_ARQUIVAR:
+        return None
+    os.makedirs(ANALYTICS_ARQUIVO_DIR, exist_ok=True)
+    destino = os.path.join(ANALYTICS_ARQUIVO_DIR, f"{tabela}.csv.gz")
+    cols = ("id", "ts", "company_id", "tear_id", "event", "session_id", "meta")
 
+    def escrever(tmp):
+        res = conn.execution_options(stream_results=True, yield_per=5000).execute(
+            text(f"SELECT {', '.join(cols)} FROM {tabela} ORDER BY id")
+        )
+        with gzip.open(tmp, "wt", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            w.writerow(cols)
+            for r in res:
+                w.writerow(r)
+    _gravar_atomico(destino, escrever)
+    return destino
+
+def _consolidado(conn, tabela: str, wm: int) -> bool:
+    maior = conn.execute(text(f"SELECT MAX(id) FROM {tabela}")).scalar()
+    return maior is None or int(maior) <= wm
+
+def _sqlite_rotacionar(conn, wm: int) -> list[str]:
+    """Move meses fechados (e já consolidados) da tabela quente para analytics_events_YYYYMM."""
+    corte = _mes_inicio(datetime.utcnow())
+    movidas = []
+    meses = [r[0] for r in conn.execute(text(
+        "SELECT DISTINCT strftime('%Y%m', ts) FROM analytics_events WHERE ts < :c"), {"c": corte})]
+    for ym in meses:
+        ini = datetime(int(ym[:4]), int(ym[4:]), 1)
+        faixa = {"ini": ini, "fim": _mes_inicio(ini, 1)}
+        maior = conn.execute(text(
+            "SELECT MAX(id) FROM analytics_events WHERE ts >= :ini AND ts < :fim"), faixa).scalar()
+        if maior is not None and int(maior) > wm:
+            continue  # ainda não consolidado; tenta na próxima rodada
+        nome = f"analytics_events_{ym}"
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {nome} AS SELECT * FROM analytics_events WHERE 0"))
+        colunas = ", ".join(("id",) + _ANALYTICS_COLS)  # meses antigos não têm inserted_at
+        conn.execute(text(f"INSERT INTO {nome} ({colunas}) SELECT {colunas} FROM analytics_events "
+                          f"WHERE ts >= :ini AND ts < :fim"), faixa)
+        conn.execute(text("DELETE FROM analytics_events WHERE ts >= :ini AND ts < :fim"), faixa)
+        movidas.append(nome)
+    return movidas
+
+@tarefa_periodica("analytics_ciclo_vida", ANALYTICS_CICLO_VIDA_SEG)
+def analytics_ciclo_vida() -> dict:
+    """Cria partições futuras, rotaciona e arquiva/descarta meses além da retenção."""
+    res = {"ok": True, "criadas": [], "rotacionadas": [], "arquivadas": [], "pendentes": []}
+    limite = _mes_inicio(datetime.utcnow(), -ANALYTICS_RETENCAO_MESES)
     with db.engine.begin() as conn:
-        conn.execute(text(ddl))
-        conn.execute(text(idx1))
-        conn.execute(text(idx2))
+        if not _lock_global(conn, "analytics_ciclo_vida"):
+            return {"ok": True, "pulado": "lock"}
+        wm = _analytics_marca_consolidada(conn)
+
+        if conn.dialect.name == "postgresql":
+            if not _pg_particionada(conn):
+                return {"ok": True, "pulado": "tabela não particionada"}
+            res["criadas"] = _pg_garantir_particoes(conn)
+            candidatas = [(n, n.rsplit("_p", 1)[-1]) for n in _pg_particoes(conn)
+                          if re.fullmatch(r"analytics_events_p\d{6}", n)]
+        else:
+            res["rotacionadas"] = _sqlite_rotacionar(conn, wm)
+            candidatas = [(r[0], r[0][-6:]) for r in conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'analytics_events_[0-9][0-9][0-9][0-9][0-9][0-9]'"))]
 
-def get_performance(company_id, dt_ini=None, dt_fim=None):
-    params = {"cid": company_id}
-    where = ["company_id = :cid"]
-    if dt_ini:
-        where.append("ts >= :dt_ini"); params["dt_ini"] = dt_ini
-    if dt_fim:
-        where.append("ts < :dt_fim");  params["dt_fim"]  = dt_fim
-
-    sql = f"""
-      SELECT DATE(ts) AS d,
-             SUM(CASE WHEN event IN ('CARD_IMPRESSION','COMPANY_PROFILE_VIEW','TEAR_DETAIL_VIEW') THEN 1 ELSE 0 END) AS visitas,
-             SUM(CASE WHEN event IN ('CONTACT_CLICK_WHATSAPP') THEN 1 ELSE 0 END) AS contatos
-        FROM analytics_events
-       WHERE {" AND ".join(where)}
-       GROUP BY DATE(ts)
-       ORDER BY DATE(ts)
-    """
-    with db.engine.begin() as conn:
-        rows = conn.execute(text(sql), params).mappings().all()
+        for tabela, ym in candidatas:
+            if datetime(int(ym[:4]), int(ym[4:]), 1) >= limite:
+                continue
+            if not _consolidado(conn, tabela, wm):
+                res["pendentes"].append(tabela)
+                continue
+            _arquivar_tabela(conn, tabela)
+            conn.execute(text(f"DROP TABLE {tabela}"))
+            res["arquivadas"].append(tabela)
 
-    series = [{"data": r["d"], "visitas": r["visitas"], "contatos": r["contatos"]} for r in rows]
-    total_visitas  = sum(r["visitas"]  for r in rows)
-    total_contatos = sum(r["contatos"] for r in rows)
-    return total_visitas, total_contatos, series
+    app.logger.info({"rota": "analytics_ciclo_vida", **res})
+    return res
 
 # Executa migrações/ajustes e a criação do analytics apenas quando o DB responder
 _BOOTSTRAP_DONE   = False
@@ -978,9 +2545,9 @@ _ANALYTICS_READY  = False
 # Modelos
 # --------------------------------------------------------------------
 # --- IMPORTS necessários no topo do main.py ---
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy import and_, or_, func, text
+from sqlalchemy import and_, or_, func, text, case
 # ----------------------------------------------
 
 # Prazo de validade por plano (dias)
@@ -1079,24 +2646,25 @@ class Empresa(db.Model):
     @assinatura_ativa.expression
     def assinatura_ativa(cls):
         """
-        Versão SQL (Postgres):
-        status ok AND (data_pagamento IS NULL OR now() <= data_pagamento + intervalo(plano))
+        Versão SQL (portável Postgres/SQLite):
+        status ok AND (data_pagamento IS NULL OR data_pagamento >= agora - prazo(plano))
+        O "agora" vai como parâmetro (utcnow do Python), igual à versão em Python;
+        então é avaliado a cada query montada, não congelado no import.
         """
         status_lower = func.lower(func.coalesce(cls.status_pagamento, ''))
         plano_lower  = func.lower(func.coalesce(cls.plano, 'mensal'))
 
-        # dias por plano via CASE
-        dias = func.case(
-            (plano_lower == "anual", ASSINATURA_DIAS_ANUAL),
-            else_=ASSINATURA_DIAS_MENSAL
+        agora = datetime.utcnow()
+        limite = case(
+            (plano_lower == "anual", agora - timedelta(days=ASSINATURA_DIAS_ANUAL)),
+            else_=agora - timedelta(days=ASSINATURA_DIAS_MENSAL),
         )
 
-        # make_interval(days => CASE...) no Postgres
         return and_(
             status_lower.in_(list(STATUS_ATIVO_EQUIV)),
             or_(
                 cls.data_pagamento.is_(None),
-                func.now() <= (cls.data_pagamento + func.make_interval(days=dias))
+                cls.data_pagamento >= limite
             )
         )
 
@@ -1150,6 +2718,10 @@ class OtpToken(db.Model):
     ip = db.Column(db.String(64))
     user_agent = db.Column(db.String(255))
 
+    __table_args__ = (
+        db.Index("ix_otp_token_email_criado", "email", "created_at"),
+    )
+
 class TrainingProgress(db.Model):
     __tablename__ = "training_progress"
 
@@ -1183,6 +2755,357 @@ class ProgressoAula(db.Model):
         db.UniqueConstraint("empresa_id", "modulo", "aula", name="uq_prog_aula_empresa_modulo_aula"),
     )
 
+class EmailOutbox(db.Model):
+    """Fila persistente de e-mails (o request só enfileira)."""
+    __tablename__ = "email_outbox"
+    id = db.Column(db.Integer, primary_key=True)
+    to_email = db.Column(db.String(255), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text)
+    text = db.Column(db.Text)
+    tipo = db.Column(db.String(32), index=True)                     # otp | reset | pagamento | ativacao | contato ...
+    prioridade = db.Column(db.Integer, default=0, nullable=False)   # maior = antes
+    status = db.Column(db.String(16), default="pendente", nullable=False)  # pendente | enviando | enviado | falhou
+    tentativas = db.Column(db.Integer, default=0, nullable=False)
+    max_tentativas = db.Column(db.Integer, default=6, nullable=False)
+    proxima_tentativa = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.utcnow)
+    enviado_em = db.Column(db.DateTime)
+    provedor = db.Column(db.String(32))
+    ultimo_erro = db.Column(db.String(500))
+    chave = db.Column(db.String(120), unique=True)                  # idempotência (opcional)
+
+    __table_args__ = (
+        db.Index("ix_email_outbox_fila", "status", "proxima_tentativa"),
+    )
+
+# =====================[ E-MAIL - FILA (OUTBOX) + DESPACHANTE ]=====================
+# Handlers chamam email_enfileirar()/send_email() e retornam. Uma thread por
+# processo reivindica lotes (FOR UPDATE SKIP LOCKED no Postgres), entrega pela
+# cadeia de provedores e grava o status. Falha -> nova tentativa com backoff
+# exponencial (EMAIL_BACKOFF_BASE_SEG * 2^n, teto EMAIL_BACKOFF_MAX_SEG).
+# Mensagem "enviando" com lease vencido (worker morreu) volta para a fila. O
+# lease é renovado antes de CADA envio (e só vale se ainda for o nosso): o lote
+# todo pode passar de EMAIL_LEASE_SEG, um envio sozinho não.
+EMAIL_OUTBOX_LOTE = int(os.getenv("EMAIL_OUTBOX_LOTE", "20"))
+EMAIL_OUTBOX_POLL_SEG = float(os.getenv("EMAIL_OUTBOX_POLL_SEG", "5"))
+EMAIL_LEASE_SEG = int(os.getenv("EMAIL_LEASE_SEG", "120"))
+EMAIL_MAX_TENTATIVAS = int(os.getenv("EMAIL_MAX_TENTATIVAS", "6"))
+EMAIL_BACKOFF_BASE_SEG = float(os.getenv("EMAIL_BACKOFF_BASE_SEG", "30"))
+EMAIL_BACKOFF_MAX_SEG = float(os.getenv("EMAIL_BACKOFF_MAX_SEG", "3600"))
+
+def email_enfileirar(to: str, subject: str, html: str, texto: Optional[str] = None, *,
+                     tipo: str = "", prioridade: int = 0, chave: str | None = None,
+                     conn=None) -> int | None:
+    """
+    Grava a mensagem no outbox (transação própria, não mexe na db.session do
+    chamador) e acorda o despachante. Com `chave`, repetição vira no-op.
+    Retorna o id (ou o id já existente para a mesma chave); None se falhar.
+    """
+    to = (to or "").strip()
+    if not to:
+        return None
+    agora = datetime.utcnow()
+    params = {
+        "to": to[:255], "subject": (subject or "")[:255], "html": html or "", "text": texto,
+        "tipo": (tipo or "")[:32], "prio": int(prioridade), "max": EMAIL_MAX_TENTATIVAS,
+        "agora": agora, "chave": chave,
+    }
+    sql_ins = text("""
+        INSERT INTO email_outbox (to_email, subject, html, text, tipo, prioridade, status,
+                                  tentativas, max_tentativas, proxima_tentativa, criado_em, chave)
+        VALUES (:to, :subject, :html, :text, :tipo, :prio, 'pendente', 0, :max, :agora, :agora, :chave)
+        RETURNING id
+    """)
+
+    def inserir(c):
+        if chave:
+            existente = c.execute(text("SELECT id FROM email_outbox WHERE chave = :chave"), params).scalar()
+            if existente:
+                return int(existente)
+        return int(c.execute(sql_ins, params).scalar())
+
+    try:
+        if conn is not None:
+            msg_id = inserir(conn)
+        else:
+            with db.engine.begin() as c:
+                msg_id = inserir(c)
+    except Exception:
+        app.logger.exception("[OUTBOX] falha ao enfileirar para %s", to)
+        return None
+    _EMAIL_DESPACHANTE.acordar()
+    return msg_id
+
+def email_enfileirar_lote(mensagens: list, *, tipo: str = "", prioridade: int = 0) -> dict:
+    """
+    Enfileira muitas mensagens de uma vez: dicts com to/subject/html/texto/chave.
+    Chaves já existentes no outbox são puladas (1 SELECT ... IN por bloco) e o
+    resto entra num único executemany. Retorna {"enfileirados", "duplicados"}.
+    """
+    res = {"enfileirados": 0, "duplicados": 0}
+    agora = datetime.utcnow()
+    for i in range(0, len(mensagens), 500):
+        bloco = [m for m in mensagens[i:i + 500] if (m.get("to") or "").strip()]
+        chaves = [m["chave"] for m in bloco if m.get("chave")]
+        with db.engine.begin() as conn:
+            existentes = set()
+            if chaves:
+                existentes = set(conn.execute(
+                    text("SELECT chave FROM email_outbox WHERE chave IN :chaves").bindparams(
+                        bindparam("chaves", expanding=True)), {"chaves": chaves}).scalars())
+            novos = [m for m in bloco if not m.get("chave") or m["chave"] not in existentes]
+            res["duplicados"] += len(bloco) - len(novos)
+            if novos:
+                conn.execute(text("""
+                    INSERT INTO email_outbox (to_email, subject, html, text, tipo, prioridade, status,
+                                              tentativas, max_tentativas, proxima_tentativa, criado_em, chave)
+                    VALUES (:to, :subject, :html, :text, :tipo, :prio, 'pendente', 0, :max, :agora, :agora, :chave)
+                """), [{"to": m["to"].strip()[:255], "subject": (m.get("subject") or "")[:255],
+                        "html": m.get("html") or "", "text": m.get("texto"), "tipo": (tipo or "")[:32],
+                        "prio": int(prioridade), "max": EMAIL_MAX_TENTATIVAS, "agora": agora,
+                        "chave": m.get("chave")} for m in novos])
+            res["enfileirados"] += len(novos)
+    if res["enfileirados"]:
+        _EMAIL_DESPACHANTE.acordar()
+    return res
+
+def _email_backoff(tentativas: int) -> float:
+    base = EMAIL_BACKOFF_BASE_SEG * (2 ** max(0, tentativas - 1))
+    return min(EMAIL_BACKOFF_MAX_SEG, base) * random.uniform(0.8, 1.2)
+
+class _EmailDespachante:
+    def __init__(self):
+        self._evento = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {"enviados": 0, "falhas": 0, "desistencias": 0, "ciclos": 0, "perdidos": 0}
+
+    def acordar(self):
+        self.garantir()
+        self._evento.set()
+
+    def garantir(self):
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="email-outbox", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            self._evento.wait(EMAIL_OUTBOX_POLL_SEG)
+            self._evento.clear()
+            try:
+                with app.app_context():
+                    while self.processar_lote():
+                        pass
+            except Exception:
+                app.logger.exception("[OUTBOX] ciclo do despachante falhou")
+                time.sleep(EMAIL_OUTBOX_POLL_SEG)
+
+    def _reivindicar(self, conn) -> list:
+        agora = datetime.utcnow()
+        trava = " FOR UPDATE SKIP LOCKED" if conn.dialect.name == "postgresql" else ""
+        linhas = conn.execute(text(f"""
+            SELECT id, to_email, subject, html, text, tentativas, max_tentativas
+              FROM email_outbox
+             WHERE status IN ('pendente', 'enviando') AND proxima_tentativa <= :agora
+             ORDER BY prioridade DESC, id
+             LIMIT :lote{trava}
+        """), {"agora": agora, "lote": EMAIL_OUTBOX_LOTE}).all()
+        pegas = []
+        lease = agora + timedelta(seconds=EMAIL_LEASE_SEG)
+        for r in linhas:
+            upd = conn.execute(text("""
+                UPDATE email_outbox SET status = 'enviando', proxima_tentativa = :lease
+                 WHERE id = :id AND status IN ('pendente', 'enviando') AND proxima_tentativa <= :agora
+            """), {"id": r[0], "lease": lease, "agora": agora})
+            if upd.rowcount:
+                pegas.append((r, lease))
+        return pegas
+
+    def _renovar(self, msg_id: int, lease) -> datetime | None:
+        """Estende o lease se ainda for nosso; None = outro worker reivindicou."""
+        novo = datetime.utcnow() + timedelta(seconds=EMAIL_LEASE_SEG)
+        with db.engine.begin() as conn:
+            upd = conn.execute(text("""
+                UPDATE email_outbox SET proxima_tentativa = :novo
+                 WHERE id = :id AND status = 'enviando' AND proxima_tentativa = :lease
+            """), {"id": msg_id, "lease": lease, "novo": novo})
+        return novo if upd.rowcount else None
+
+    def processar_lote(self) -> int:
+        """Entrega um lote; retorna quantas mensagens foram reivindicadas."""
+        with db.engine.begin() as conn:
+            lote = self._reivindicar(conn)
+        self.stats["ciclos"] += 1
+        for (msg_id, to, subject, html, txt, tentativas, max_t), lease in lote:
+            lease = self._renovar(msg_id, lease)
+            if lease is None:
+                self.stats["perdidos"] += 1
+                continue
+            t0 = time.perf_counter()
+            try:
+                ok, via, motivo = _entregar_email(to, subject, html or "", txt)
+            except Exception as e:
+                ok, via, motivo = False, "", f"erro: {e!s}"
+            tentativas = int(tentativas or 0) + 1
+            agora = datetime.utcnow()
+            if ok:
+                campos = {"status": "enviado", "enviado_em": agora, "provedor": via[:32], "ultimo_erro": None}
+                self.stats["enviados"] += 1
+            elif tentativas >= int(max_t or EMAIL_MAX_TENTATIVAS):
+                campos = {"status": "falhou", "ultimo_erro": (motivo or "")[:500]}
+                self.stats["desistencias"] += 1
+            else:
+                campos = {"status": "pendente", "ultimo_erro": (motivo or "")[:500],
+                          "proxima_tentativa": agora + timedelta(seconds=_email_backoff(tentativas))}
+                self.stats["falhas"] += 1
+            sets = ", ".join(f"{k} = :{k}" for k in campos)
+            with db.engine.begin() as conn:
+                conn.execute(text(f"""
+                    UPDATE email_outbox SET {sets}, tentativas = :t
+                     WHERE id = :id AND status = 'enviando' AND proxima_tentativa = :lease
+                """), {**campos, "t": tentativas, "id": msg_id, "lease": lease})
+            app.logger.info({"rota": "email_outbox", "id": msg_id, "status": campos["status"],
+                             "via": via, "tentativa": tentativas,
+                             "ms": round((time.perf_counter() - t0) * 1000, 1)})
+        return len(lote)
+
+_EMAIL_DESPACHANTE = _EmailDespachante()
+
+@app.get("/admin/email/outbox")
+def admin_email_outbox():
+    if not _seed_ok():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    with db.engine.connect() as conn:
+        por_status = {r[0]: int(r[1]) for r in conn.execute(
+            text("SELECT status, COUNT(*) FROM email_outbox GROUP BY status"))}
+        falhas = [dict(r._mapping) for r in conn.execute(text("""
+            SELECT id, to_email, tipo, tentativas, ultimo_erro, proxima_tentativa
+              FROM email_outbox WHERE ultimo_erro IS NOT NULL AND status <> 'enviado'
+             ORDER BY id DESC LIMIT 20
+        """))]
+    return jsonify({"ok": True, "pid": os.getpid(), "por_status": por_status,
+                    "despachante": _EMAIL_DESPACHANTE.stats, "falhas_recentes": falhas,
+                    "provedores": email_provedores_status()})
+
+@app.get("/admin/email/provedores")
+def admin_email_provedores():
+    if not _seed_ok():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    ordem = [nome for nome, _ in _provedores_por_saude()]
+    return jsonify({"ok": True, "pid": os.getpid(), "ordem": ordem, "provedores": email_provedores_status(),
+                    "conexoes": email_conexoes_status()})
+
+# =====================[ E-MAIL - LEMBRETES DE RENOVAÇÃO ]=====================
+# Lote periódico: UMA consulta pega as empresas ativas cujo ciclo (data_pagamento
+# + dias do plano, próximo dia útil) vence nos próximos LEMBRETE_DIAS dias; os
+# e-mails saem do registro de templates em lote e entram no outbox com chave
+# lembrete:<empresa>:<vencimento> (um lembrete por ciclo, reexecução é no-op).
+# O despachante entrega respeitando o limite de taxa de cada provedor.
+LEMBRETE_DIAS = int(os.getenv("LEMBRETE_DIAS", "7"))
+LEMBRETE_INTERVALO_SEG = float(os.getenv("LEMBRETE_INTERVALO_SEG", str(6 * 3600)))
+
+def _empresas_a_vencer(hoje: date, dias: int) -> list:
+    """[(empresa, vencimento, dias_restantes)] com 0 <= dias_restantes <= dias."""
+    plano_lower = func.lower(func.coalesce(Empresa.plano, "mensal"))
+    anual = plano_lower.like("%anual%")
+    faixas = []
+    for cond, ciclo in ((anual, _dias_ciclo_plano("anual")), (~anual, _dias_ciclo_plano("mensal"))):
+        # o ajuste p/ dia útil empurra no máximo alguns dias: folga de 5 na borda inferior
+        ini = datetime.combine(hoje - timedelta(days=ciclo + 5), datetime.min.time())
+        fim = datetime.combine(hoje + timedelta(days=dias - ciclo + 1), datetime.min.time())
+        faixas.append(and_(cond, Empresa.data_pagamento >= ini, Empresa.data_pagamento < fim))
+    linhas = (
+        db.session.query(Empresa.id, Empresa.nome, Empresa.apelido, Empresa.email,
+                         Empresa.plano, Empresa.data_pagamento)
+        .filter(func.lower(func.coalesce(Empresa.status_pagamento, "")).in_(list(STATUS_ATIVO_EQUIV)))
+        .filter(or_(*faixas))
+        .all()
+    )
+    saida = []
+    for r in linhas:
+        venc = _vencimento_assinatura(r.data_pagamento.date(), r.plano)
+        restantes = (venc - hoje).days
+        if 0 <= restantes <= dias:
+            saida.append((r, venc, restantes))
+    return saida
+
+@tarefa_periodica("lembretes_renovacao", LEMBRETE_INTERVALO_SEG)
+def lembretes_renovacao(dias: int | None = None) -> dict:
+    """Enfileira lembretes de renovação (idempotente por ciclo)."""
+    dias = LEMBRETE_DIAS if dias is None else int(dias)
+    hoje = datetime.now(ZoneInfo("America/Sao_Paulo")).date() if ZoneInfo else date.today()
+    t0 = time.perf_counter()
+    with db.engine.begin() as conn:
+        if not _lock_global(conn, "lembretes_renovacao"):
+            return {"ok": True, "pulado": "lock"}
+        alvos = _empresas_a_vencer(hoje, dias)
+        t1 = time.perf_counter()
+
+        base = _public_base_url()
+        renderizados = email_render_lote("lembrete_renovacao", [
+            {"nome": (r.apelido or r.nome or "sua malharia").strip(), "dias": restantes,
+             "vencimento": venc.strftime("%d/%m/%Y"),
+             "plano_label": "Plano Anual" if "anual" in (r.plano or "").lower() else "Plano Mensal",
+             "renovar_url": f"{base}/checkout?plano={'anual' if 'anual' in (r.plano or '').lower() else 'mensal'}"}
+            for r, venc, restantes in alvos
+        ])
+        t2 = time.perf_counter()
+
+        fila = email_enfileirar_lote([
+            {"to": r.email, "subject": msg.subject, "html": msg.html, "texto": msg.text,
+             "chave": f"lembrete:{r.id}:{venc.isoformat()}"}
+            for (r, venc, _), msg in zip(alvos, renderizados)
+        ], tipo="lembrete")
+    t3 = time.perf_counter()
+
+    res = {
+        "ok": True, "hoje": hoje.isoformat(), "dias": dias, "candidatos": len(alvos), **fila,
+        "ms": {"consulta": round((t1 - t0) * 1000, 1), "render": round((t2 - t1) * 1000, 1),
+               "enfileirar": round((t3 - t2) * 1000, 1), "total": round((t3 - t0) * 1000, 1)},
+        "render_por_seg": round(len(alvos) / (t2 - t1)) if alvos and t2 > t1 else None,
+    }
+    app.logger.info({"rota": "lembretes_renovacao", **res})
+    return res
+
+def lembretes_entrega_status(horas: int = 24) -> dict:
+    """Vazão de entrega dos lembretes (outbox) nas últimas `horas`."""
+    desde = datetime.utcnow() - timedelta(hours=horas)
+    with db.engine.connect() as conn:
+        por_status = {r[0]: int(r[1]) for r in conn.execute(text("""
+            SELECT status, COUNT(*) FROM email_outbox
+             WHERE tipo = 'lembrete' AND criado_em >= :desde GROUP BY status
+        """), {"desde": desde})}
+        ini, fim, n = conn.execute(text("""
+            SELECT MIN(enviado_em), MAX(enviado_em), COUNT(*) FROM email_outbox
+             WHERE tipo = 'lembrete' AND status = 'enviado' AND criado_em >= :desde
+        """), {"desde": desde}).one()
+        por_provedor = {r[0] or "?": int(r[1]) for r in conn.execute(text("""
+            SELECT provedor, COUNT(*) FROM email_outbox
+             WHERE tipo = 'lembrete' AND status = 'enviado' AND criado_em >= :desde GROUP BY provedor
+        """), {"desde": desde})}
+    ini, fim = _as_datetime(ini), _as_datetime(fim)
+    seg = (fim - ini).total_seconds() if ini and fim else 0
+    return {"horas": horas, "por_status": por_status, "por_provedor": por_provedor,
+            "enviados_por_min": round(n / seg * 60, 1) if seg > 0 else None}
+
+@app.route("/admin/email/lembretes", methods=["GET", "POST"])
+def admin_email_lembretes():
+    """GET: vazão de entrega; POST (ou ?rodar=1): roda o lote agora (?dias=N)."""
+    if not _seed_ok():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    lote = None
+    if request.method == "POST" or request.args.get("rodar") == "1":
+        lote = lembretes_renovacao(request.args.get("dias", type=int))
+    return jsonify({"ok": True, "lote": lote, "entrega": lembretes_entrega_status()})
+
 # === Helpers de autenticação/empresa =========================================
 # flask_login é opcional no projeto; faça import seguro
 try:
@@ -1213,6 +3136,23 @@ def _whoami():
     return uid, email
 
 def _get_empresa_usuario_da_sessao():
+    """
+    (empresa, usuario) do request atual, resolvidos UMA vez e memorizados em
+    flask.g (a view e os context processors compartilham o resultado). A memo
+    vale enquanto session['empresa_id'] não mudar; handlers que apagam ou
+    trocam a empresa chamam empresa_sessao_invalidar().
+    """
+    memo = g.get("_empresa_usuario")
+    if memo is not None and memo[0] == session.get("empresa_id"):
+        return memo[1], memo[2]
+    emp, u = _resolver_empresa_usuario()
+    g._empresa_usuario = (session.get("empresa_id"), emp, u)
+    return emp, u
+
+def empresa_sessao_invalidar():
+    g.pop("_empresa_usuario", None)
+
+def _resolver_empresa_usuario():
     """
     Caminho feliz:
       1) Usa session['empresa_id'] se existir.
@@ -1485,6 +3425,8 @@ def _run_bootstrap_once():
         _ensure_empresa_address_columns()
         _ensure_empresa_foto_column()
         _ensure_teares_pistas_cols()
+        _ensure_catalogo_versao_table()
+        _ensure_otp_token_index()
 
         # 3) auth + vinculação user_id (pode fazer SELECT minimalista)
         _ensure_auth_layer_and_link()
@@ -1512,31 +3454,41 @@ def _bootstrap_and_analytics_lazy():
             try:
                 _init_analytics_table()
                 _ANALYTICS_READY = True
+                _iniciar_tarefas_periodicas()
             except Exception as e:
                 app.logger.error("Falha ao garantir tabela de analytics (adiado): %s", e)
+        if _BOOTSTRAP_DONE:
+            _EMAIL_DESPACHANTE.garantir()  # drena o outbox pendente de execuções anteriores
+            _AVATARES.garantir_hashes()
+
+def _sql_contador_reset():
+    # registrado depois do bootstrap/ping: só conta o que a view executar
+    g._sql_count = 0
+
+def _sql_budget_guard(resp):
+    ep = request.endpoint or ""
+    n = sql_contador()
+    if SQL_COUNT_HEADER:
+        resp.headers["X-SQL-Count"] = str(n)
+    limite = SQL_BUDGETS.get(ep)
+    if limite is not None and n > limite:
+        app.logger.warning({"rota": ep, "sql_budget": limite, "sql_executados": n, "path": request.path})
+        if SQL_BUDGET_STRICT:
+            raise SqlBudgetExceeded(f"{ep}: {n} statements SQL (orçamento {limite})")
+    return resp
+
+if SQL_CONTAR:
+    app.before_request(_sql_contador_reset)
+    app.after_request(_sql_budget_guard)
 
 @app.after_request
-def _no_cache_on_panel(resp):
-    """
-    Evita que o navegador exiba versão em cache do painel após trocar a foto.
-    Não mexe em estáticos; atua só nas páginas/redirects do painel.
-    """
-    try:
-        # mais robusto: usa o endpoint quando disponível
-        ep = (request.endpoint or "").lower()
-        p  = request.path or "/"
-
-        # páginas do painel (ajuste a lista se seu endpoint tiver outro nome)
-        panel_endpoints = {""}
-        # também forçamos no-store no POST de upload (o response é um redirect 302)
-        upload_endpoints = {"perfil_foto_upload"}
-
-        if ep in panel_endpoints or ep in upload_endpoints or p.endswith("/"):
-            resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-            resp.headers["Pragma"] = "no-cache"
-            resp.headers["Expires"] = "0"
-    except Exception:
-        pass
+def _cache_avatar_imutavel(resp):
+    """Avatares endereçados por conteúdo nunca mudam: cache de 1 ano, sem revalidar."""
+    if request.endpoint == "static" and resp.status_code in (200, 206, 304):
+        nome = (request.view_args or {}).get("filename") or ""
+        if nome.startswith(AVATAR_CAS_PASTA + "/"):
+            resp.headers["Cache-Control"] = ASSETS_CACHE_CONTROL
+            resp.headers.pop("Expires", None)
     return resp
 
 # =====================[ ANALYTICS - FIM ]=====================
@@ -1550,30 +3502,186 @@ def parse_bool(val):
     s = str(val).strip().lower()
     return s in {'1','true','t','on','sim','s','yes','y'}
 
+# ---------------------------------------------------------------------
+# Índice de avatares em memória: caminho relativo a static/ -> versão (mtime).
+# Preenchido por varredura (no 1º uso e quando o mtime de uma das pastas muda,
+# checado pela tarefa periódica) e atualizado direto no upload. Render só
+# consulta o dicionário: nenhum exists/getmtime por template.
+# ---------------------------------------------------------------------
+AVATAR_SCAN_SEG = float(os.getenv("AVATAR_SCAN_SEG", "30"))
+AVATAR_HASHES_RETRY_SEG = float(os.getenv("AVATAR_HASHES_RETRY_SEG", "60"))  # espera após falha
+AVATAR_EXTS = (".webp", ".jpg", ".jpeg", ".png")
+
+class _AvatarIndice:
+    PASTAS = ("avatars", "uploads/avatars", "uploads/perfil")  # relativas a static/
+
+    def __init__(self):
+        self._versoes: dict = {}
+        self._hashes: dict = {}     # empresa_id -> hash do avatar (endereçado por conteúdo)
+        self._hashes_prontos = False
+        self._hashes_falhou_em = None  # monotonic da última falha (backoff)
+        self._mtimes_pastas: dict = {}
+        self._lock = threading.Lock()
+        self._pronto = False
+        self.varreduras = 0
+
+    def escanear(self, forcar: bool = False) -> bool:
+        """Revarre se alguma pasta mudou (arquivo criado/removido/renomeado)."""
+        mtimes = {}
+        for rel in self.PASTAS:
+            try:
+                mtimes[rel] = os.stat(os.path.join(app.static_folder, rel)).st_mtime_ns
+            except OSError:
+                mtimes[rel] = None
+        if not forcar and self._pronto and mtimes == self._mtimes_pastas:
+            return False
+        versoes = {}
+        for rel in self.PASTAS:
+            if mtimes[rel] is None:
+                continue
+            try:
+                with os.scandir(os.path.join(app.static_folder, rel)) as it:
+                    for e in it:
+                        if e.is_file() and os.path.splitext(e.name)[1].lower() in AVATAR_EXTS:
+                            versoes[f"{rel}/{e.name}"] = int(e.stat().st_mtime)
+            except OSError as ex:
+                app.logger.warning(f"[avatar] varredura de {rel} falhou: {ex}")
+        with self._lock:
+            self._versoes, self._mtimes_pastas, self._pronto = versoes, mtimes, True
+        self.varreduras += 1
+        return True
+
+    def _garantir(self):
+        if not self._pronto:
+            self.escanear()
+
+    def registrar(self, rel_path: str, versao: int | None = None) -> None:
+        with self._lock:
+            self._versoes[rel_path] = int(versao or time.time())
+
+    def remover(self, rel_path: str) -> None:
+        with self._lock:
+            self._versoes.pop(rel_path, None)
+
+    def versao(self, rel_path: str) -> int | None:
+        self._garantir()
+        return self._versoes.get(rel_path)
+
+    def procurar(self, bases, exts=AVATAR_EXTS) -> str | None:
+        """Primeiro `base + ext` existente, na ordem dada."""
+        self._garantir()
+        for base in bases:
+            for ext in exts:
+                if base + ext in self._versoes:
+                    return base + ext
+        return None
+
+    def carregar_hashes(self) -> int:
+        """empresa_id -> hash a partir de Empresa.foto_url (1 SELECT; tarefa/bootstrap)."""
+        with db.engine.connect() as conn:
+            linhas = conn.execute(
+                text("SELECT id, foto_url FROM empresa WHERE foto_url LIKE :p"),
+                {"p": f"%/{AVATAR_CAS_PASTA}/%"},
+            ).fetchall()
+        hashes = {int(i): h for i, u in linhas if (h := avatar_hash(u))}
+        with self._lock:
+            self._hashes, self._hashes_prontos, self._hashes_falhou_em = hashes, True, None
+        return len(hashes)
+
+    @property
+    def hashes_prontos(self) -> bool:
+        return self._hashes_prontos
+
+    def garantir_hashes(self) -> bool:
+        """Carrega os hashes uma vez (bootstrap/request). Depois de uma falha
+        espera AVATAR_HASHES_RETRY_SEG antes de tentar (e logar) de novo."""
+        if self._hashes_prontos:
+            return True
+        with self._lock:
+            falhou = self._hashes_falhou_em
+            if falhou is not None and time.monotonic() - falhou < AVATAR_HASHES_RETRY_SEG:
+                return False
+            self._hashes_falhou_em = time.monotonic()  # outros requests não tentam junto
+        try:
+            self.carregar_hashes()
+            return True
+        except Exception as e:
+            app.logger.warning(f"[avatar] não foi possível carregar hashes (nova tentativa em "
+                               f"{AVATAR_HASHES_RETRY_SEG:.0f}s): {e}")
+            return False
+
+    def definir_hash(self, empresa_id: int, h: str | None) -> None:
+        with self._lock:
+            if h:
+                self._hashes[int(empresa_id)] = h
+            else:
+                self._hashes.pop(int(empresa_id), None)
+
+    def hash_de(self, empresa_id) -> str | None:
+        return self._hashes.get(int(empresa_id))
+
+    def url(self, rel_path: str) -> str:
+        v = self.versao(rel_path)
+        u = url_for("static", filename=rel_path)
+        return f"{u}?v={v}" if v else u
+
+_AVATARES = _AvatarIndice()
+
+@tarefa_periodica("avatar_scan", AVATAR_SCAN_SEG)
+def avatar_scan() -> dict:
+    return {"ok": True, "mudou": _AVATARES.escanear(), "arquivos": len(_AVATARES._versoes),
+            "hashes": _AVATARES.carregar_hashes(), "retomados": avatar_originais_pendentes()}
+
+# GC dos blobs endereçados por conteúdo: apaga o que nenhuma Empresa.foto_url
+# referencia. A carência cobre o job que gravou as variantes e ainda não fez
+# commit, e páginas recém-servidas que apontam para a foto anterior (ao trocar
+# a foto, _avatar_finalizar renova o mtime da anterior: a carência conta dali).
+AVATAR_GC_SEG = float(os.getenv("AVATAR_GC_SEG", "3600"))
+AVATAR_GC_CARENCIA_SEG = int(os.getenv("AVATAR_GC_CARENCIA_SEG", "86400"))
+
+@tarefa_periodica("avatar_gc", AVATAR_GC_SEG)
+def avatar_gc() -> dict:
+    pasta = os.path.join(app.static_folder, AVATAR_CAS_PASTA)
+    with db.engine.begin() as conn:
+        if not _lock_global(conn, "avatar_gc"):
+            return {"ok": True, "pulado": "lock"}
+        usados = {
+            h for (u,) in conn.execute(
+                text("SELECT foto_url FROM empresa WHERE foto_url LIKE :p"),
+                {"p": f"%/{AVATAR_CAS_PASTA}/%"},
+            )
+            if (h := avatar_hash(u))
+        }
+        limite = time.time() - AVATAR_GC_CARENCIA_SEG
+        apagados = mantidos = 0
+        try:
+            entradas = list(os.scandir(pasta))
+        except OSError:
+            entradas = []
+        for e in entradas:
+            h = e.name.split("-", 1)[0]
+            try:
+                if not e.is_file() or h in usados or e.stat().st_mtime > limite:
+                    mantidos += 1
+                    continue
+                os.remove(e.path)
+                apagados += 1
+            except OSError:
+                pass
+    if apagados:
+        app.logger.info({"rota": "avatar_gc", "apagados": apagados, "mantidos": mantidos, "referenciados": len(usados)})
+    return {"ok": True, "apagados": apagados, "mantidos": mantidos, "referenciados": len(usados)}
+
 def _foto_url_runtime(empresa_id: int | None):
     """
-    Devolve a URL da foto da empresa com base em arquivos na pasta static/avatars.
-    Não depende de coluna no banco. Se não houver arquivo, retorna None.
+    Devolve a URL da foto da empresa (arquivo empresa_<id>.ext em static/avatars),
+    consultando o índice em memória. Se não houver arquivo, retorna None.
     """
     if not empresa_id:
         return None
-
-    try:
-        base_name = f"empresa_{empresa_id}"
-        avatars_dir = os.path.join(app.static_folder, "avatars")
-
-        # verifica se existe algum arquivo empresa_<id>.ext
-        for ext in (".jpg", ".jpeg", ".png", ".webp"):
-            rel_path = f"avatars/{base_name}{ext}"
-            abs_path = os.path.join(app.static_folder, rel_path)
-            if os.path.exists(abs_path):
-                # encontrou o arquivo: monta a URL pública
-                return url_for("static", filename=rel_path)
-    except Exception as e:
-        app.logger.warning(f"[avatar] _foto_url_runtime erro: {e}")
-
+    rel_path = _AVATARES.procurar([f"avatars/empresa_{empresa_id}"], (".jpg", ".jpeg", ".png", ".webp"))
     # nenhum arquivo encontrado -> deixa o template usar o avatar padrão
-    return None
+    return url_for("static", filename=rel_path) if rel_path else None
 
 @app.context_processor
 def inject_avatar_url():
@@ -1616,13 +3724,11 @@ def inject_avatar_url():
             if cu is not None:
                 url = getattr(cu, 'avatar_url', None) or getattr(cu, 'photo_url', None)
 
-    # Cache-buster para arquivos locais sem querystring
+    # Cache-buster para arquivos locais sem querystring (versão vem do índice)
     if url and url.startswith('/static/') and ('?' not in url):
-        try:
-            fs_path = os.path.join(app.root_path, url.lstrip('/'))
-            url = f"{url}?v={int(os.path.getmtime(fs_path))}"
-        except Exception:
-            pass
+        v = _AVATARES.versao(url[len('/static/'):])
+        if v:
+            url = f"{url}?v={v}"
 
     return {'avatar_url': url}
 
@@ -1685,69 +3791,721 @@ def _render_or_fallback(name: str, **ctx):
             </div>
             """, email=email)
 
-        return render_template_string("<h2>Página</h2><p>Template '{{name}}' não encontrado.</p>", name=name, **ctx)
+        return render_template_string("<h2>Página</h2><p>Template '{{name}}' não encontrado.</p>", name=name, **ctx)
+
+def _render_try(candidatos: list[str], **ctx):
+    """Tenta renderizar o primeiro template existente na lista.
+       Se nenhum existir, cai num HTML mínimo para não 500."""
+    for nome in candidatos:
+        try:
+            return render_template(nome, **ctx)
+        except TemplateNotFound:
+            continue
+    return render_template_string("<h2>Página temporária</h2><p>Conteúdo indisponível.</p>")
+
+def _get_notificacoes(empresa_id):
+    # Troque por consulta real quando tiver o banco
+    items = []  # ex.: [{"titulo":"Novo contato","mensagem":"João enviou msg"}]
+    return len(items), items
+
+# --------------------------------------------------------------------
+# INDEX
+# --------------------------------------------------------------------
+def _num_key(x):
+    try:
+        return float(str(x).replace(",", "."))
+    except Exception:
+        return 0.0
+
+def _to_int(s):
+    try:
+        return int(float(str(s).replace(",", ".")))
+    except Exception:
+        return None
+
+@app.post("/api/track")
+def api_track():
+    data = request.get_json(silent=True) or {}
+    event      = data.get("event")
+    company_id = data.get("company_id")
+    tear_id    = data.get("tear_id")
+    session_id = data.get("session_id") or _analytics_sid()
+    meta       = data.get("meta") or {}
+
+    if event not in ALLOWED_EVENTS or not company_id:
+        return jsonify({"ok": False, "error": "bad event/company"}), 400
+
+    try:
+        aceito = analytics_enqueue(event, company_id, tear_id, session_id=session_id, meta=meta)
+        return jsonify({"ok": True, "queued": aceito}), (202 if aceito else 503)
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "bad event/company"}), 400
+    except Exception as e:
+        app.logger.exception("[analytics] falha ao registrar evento: %s", e)
+        return jsonify({"ok": False}), 500
+
+# Beacon da home (navigator.sendBeacon): tipos curtos do front -> eventos.
+# Aceita um objeto, uma lista ou {"events": [...]}; responde 204 na hora.
+BEACON_TIPOS = {
+    "view_company": "COMPANY_PROFILE_VIEW",
+    "wa_click": "CONTACT_CLICK_WHATSAPP",
+    "impression": "CARD_IMPRESSION",
+    "tear_detail": "TEAR_DETAIL_VIEW",
+}
+BEACON_MAX_EVENTOS = int(os.getenv("BEACON_MAX_EVENTOS", "100"))
+
+@app.post("/analytics/event")
+def analytics_beacon():
+    data = request.get_json(silent=True, force=True)
+    if isinstance(data, dict):
+        data = data.get("events", [data])
+    if not isinstance(data, list):
+        return "", 204
+
+    sid = _analytics_sid()
+    for item in data[:BEACON_MAX_EVENTOS]:
+        if not isinstance(item, dict):
+            continue
+        tipo = str(item.get("type") or item.get("event") or "")
+        event = BEACON_TIPOS.get(tipo, tipo)
+        company_id = _to_int(item.get("company_id"))
+        if event not in ALLOWED_EVENTS or not company_id:
+            continue
+        meta = {"source": item["source"]} if item.get("source") else None
+        try:
+            analytics_enqueue(event, company_id, _to_int(item.get("tear_id")), session_id=sid, meta=meta)
+        except ValueError:
+            continue  # id fora da faixa: ignora só este item
+    return "", 204
+
+@app.route("/admin/analytics/rollup", methods=["GET", "POST"])
+def analytics_rollup_agora():
+    if not _seed_ok():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    _ANALYTICS_WRITER.flush()
+    return jsonify(analytics_compactar())
+
+@app.route("/admin/analytics/ciclo_vida", methods=["GET", "POST"])
+def analytics_ciclo_vida_agora():
+    if not _seed_ok():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    return jsonify(analytics_ciclo_vida())
+
+@app.get("/admin/analytics/writer")
+def analytics_writer_stats():
+    if not _seed_ok():
+        return jsonify({"ok": False, "error": "forbidden"}), 403
+    return jsonify({"ok": True, "pid": os.getpid(), **_ANALYTICS_WRITER.snapshot()})
+
+# --------------------------------------------------------------------
+# Paginação por cursor (keyset) + contagens cacheadas/aproximadas
+# --------------------------------------------------------------------
+import base64
+from bisect import bisect_left, bisect_right
+
+def cursor_encode(dados: dict) -> str:
+    """Cursor opaco para a URL (base64 urlsafe de um JSON curto)."""
+    raw = json.dumps(dados, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _cursor_posicao_ok(valor, formato) -> bool:
+    if isinstance(formato, tuple):
+        return (isinstance(valor, list) and len(valor) == len(formato)
+                and all(_cursor_posicao_ok(v, f) for v, f in zip(valor, formato)))
+    return isinstance(valor, formato) and not isinstance(valor, bool)
+
+def cursor_decode(token: str | None, formato=int) -> dict | None:
+    """
+    Cursor válido = exatamente uma chave: {"a": pos}, {"b": pos} ou {"fim": 1}.
+    `formato` é o tipo da posição: int (Tear.id) ou tupla de tipos, ex.
+    (str, int) para [nome, id]. Token forjado/truncado/fora do formato -> None.
+    """
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        dados = json.loads(raw.decode("utf-8"))
+    except Exception:
+        return None
+    if not isinstance(dados, dict) or len(dados) != 1:
+        return None
+    chave, valor = next(iter(dados.items()))
+    if chave == "fim":
+        return dados if valor == 1 else None
+    if chave in ("a", "b") and _cursor_posicao_ok(valor, formato):
+        return dados
+    return None
+
+CONTAGEM_CACHE_TTL = float(os.getenv("CONTAGEM_CACHE_TTL", "30"))
+CONTAGEM_APROX_MIN = int(os.getenv("CONTAGEM_APROX_MIN", "50000"))
+_CONTAGEM_CACHE: dict = {}
+
+def contagem_cacheada(chave, query, tabela_aprox: str | None = None) -> int:
+    """
+    count() com cache curto por processo (CONTAGEM_CACHE_TTL segundos).
+    Se `tabela_aprox` for informado (query SEM filtros) e o banco for Postgres,
+    usa a estimativa do planner (pg_class.reltuples) quando a tabela é grande.
+    """
+    now = time.time()
+    hit = _CONTAGEM_CACHE.get(chave)
+    if hit and (now - hit[1]) < CONTAGEM_CACHE_TTL:
+        return hit[0]
+
+    n = None
+    if tabela_aprox and db.engine.url.get_backend_name() == "postgresql":
+        try:
+            with db.engine.connect() as conn:
+                est = conn.execute(
+                    text("SELECT reltuples::bigint FROM pg_class WHERE relname = :t"),
+                    {"t": tabela_aprox},
+                ).scalar()
+            if est is not None and est >= CONTAGEM_APROX_MIN:
+                n = int(est)
+        except Exception:
+            n = None
+    if n is None:
+        n = query.order_by(None).count()
+
+    if len(_CONTAGEM_CACHE) > 1024:
+        _CONTAGEM_CACHE.clear()
+    _CONTAGEM_CACHE[chave] = (n, now)
+    return n
+
+# =====================[ BUSCA - ÍNDICE EM MEMÓRIA ]=====================
+# Índice local (por processo) dos teares visíveis na busca da home.
+# - Colunas compactas (array) + dicionário de strings + posting lists por faceta.
+# - Versão global na tabela `catalogo_versao`: toda alteração de catálogo
+#   incrementa a versão; cada worker confere a versão a cada poucos segundos
+#   e reconstrói (ou já foi remendado localmente pelo próprio worker).
+# Desligue com BUSCA_INDICE_MEMORIA=0 para voltar ao caminho SQL antigo.
+import threading
+from array import array
+
+BUSCA_INDICE_MEMORIA = _env_bool("BUSCA_INDICE_MEMORIA", True)
+BUSCA_INDICE_CHECK_SEG = float(os.getenv("BUSCA_INDICE_CHECK_SEG", "3"))
+
+def _teares_query_base():
+    """Query base da busca pública: Tear ⨝ Empresa com as regras de visibilidade."""
+    q_base = Tear.query.join(Empresa, Tear.empresa_id == Empresa.id)
+    # Se a coluna 'ativo' não existir, ignora silenciosamente
+    try:
+        q_base = q_base.filter(Tear.ativo.is_(True))
+    except Exception:
+        pass
+
+    # 🔒 Regra de negócio: só empresas com pagamento/assinatura ativa
+    # 1) Se você tiver a propriedade híbrida Empresa.assinatura_ativa (recomendado)
+    try:
+        q_base = q_base.filter(Empresa.assinatura_ativa)
+    except Exception:
+        # 2) Fallback por data "pago até"
+        try:
+            q_base = q_base.filter(Empresa.pago_ate >= db.func.now())
+        except Exception:
+            # 3) Fallback por status textual
+            try:
+                q_base = q_base.filter(Empresa.assinatura_status.in_(["active", "approved", "trial"]))
+            except Exception:
+                # Se nada disso existir, segue sem o filtro (legado)
+                pass
+    return q_base
+
+def _wa_link(telefone) -> str | None:
+    numero = re.sub(r"\D", "", (telefone or ""))
+    if not numero:
+        return None
+    return f"https://wa.me/{'55' + numero if not numero.startswith('55') else numero}"
+
+def _empresa_apelido(apelido, nome, email) -> str:
+    return apelido or nome or (email.split("@")[0] if email else None) or "—"
+
+def _ensure_catalogo_versao_table():
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS catalogo_versao (
+                id INTEGER PRIMARY KEY,
+                versao BIGINT NOT NULL DEFAULT 0
+            )
+        """))
+        existe = conn.execute(text("SELECT 1 FROM catalogo_versao WHERE id = 1")).first()
+        if not existe:
+            conn.execute(text("INSERT INTO catalogo_versao (id, versao) VALUES (1, 1)"))
+
+def _ensure_otp_token_index():
+    # create_all não cria índice novo em tabela que já existe
+    with db.engine.begin() as conn:
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_otp_token_email_criado ON otp_token (email, created_at)"))
+
+def _catalogo_versao_db() -> int:
+    with db.engine.connect() as conn:
+        v = conn.execute(text("SELECT versao FROM catalogo_versao WHERE id = 1")).scalar()
+    return int(v or 0)
+
+def _catalogo_bump() -> int:
+    with db.engine.begin() as conn:
+        conn.execute(text("UPDATE catalogo_versao SET versao = versao + 1 WHERE id = 1"))
+        v = conn.execute(text("SELECT versao FROM catalogo_versao WHERE id = 1")).scalar()
+    return int(v or 0)
+
+# Assinaturas vencem sozinhas (data_pagamento + prazo do plano), sem nenhum
+# UPDATE que incremente a versão. Guardamos, por versão, o próximo vencimento
+# entre as empresas hoje visíveis; ao passar dele, incrementa a versão (uma vez
+# só: UPDATE condicional), e índice, ETag e jobs de exportação acompanham.
+_CATALOGO_VENCE: tuple[int, float] | None = None  # (versao, epoch do próximo vencimento)
+
+def _catalogo_proximo_vencimento() -> float:
+    """Epoch (UTC) do primeiro vencimento entre as empresas visíveis; inf se nenhum."""
+    rows = (db.session.query(Empresa.plano, func.min(Empresa.data_pagamento))
+            .filter(Empresa.assinatura_ativa, Empresa.data_pagamento.isnot(None))
+            .group_by(Empresa.plano)
+            .all())
+    vence = float("inf")
+    for plano, pago_em in rows:
+        fim = pago_em + timedelta(days=Empresa._dias_por_plano(plano))
+        vence = min(vence, fim.replace(tzinfo=timezone.utc).timestamp())
+    return vence
+
+def _catalogo_versao_vigente() -> int:
+    """Versão do catálogo, já incrementada se alguma assinatura visível venceu."""
+    global _CATALOGO_VENCE
+    versao = _catalogo_versao_db()
+    vence = _CATALOGO_VENCE
+    if vence is None or vence[0] != versao:
+        vence = _CATALOGO_VENCE = (versao, _catalogo_proximo_vencimento())
+    if time.time() >= vence[1]:
+        with db.engine.begin() as conn:
+            conn.execute(text("UPDATE catalogo_versao SET versao = versao + 1 WHERE id = 1 AND versao = :v"),
+                         {"v": versao})
+        versao = _catalogo_versao_db()
+        _CATALOGO_VENCE = (versao, _catalogo_proximo_vencimento())
+        app.logger.info({"rota": "busca_indice", "acao": "assinatura_vencida", "versao": versao})
+    return versao
+
+class _Dicionario:
+    """Codifica strings em inteiros pequenos (0 = vazio/None)."""
+    __slots__ = ("valores", "codigos")
+
+    def __init__(self):
+        self.valores = [None]
+        self.codigos = {None: 0}
+
+    def codigo(self, valor) -> int:
+        c = self.codigos.get(valor)
+        if c is None:
+            c = len(self.valores)
+            self.valores.append(valor)
+            self.codigos[valor] = c
+        return c
+
+class _IndiceTeares:
+    """
+    Índice colunar dos teares visíveis.
+    As linhas ficam em ordem crescente de Tear.id; a busca devolve posições
+    em ordem decrescente (= Tear.id DESC, igual à ordenação da home).
+    """
+    FACETAS = ("tipo", "diametro", "galga", "estado", "cidade")
+
+    def __init__(self, versao: int):
+        self.versao = versao
+        self.ids = array("l")
+        self.empresa_ids = array("l")
+        self.diametro = array("l")       # -1 = sem valor
+        self.finura = array("l")
+        self.alimentadores = array("l")
+        self.tipo = array("l")           # códigos em self.strings
+        self.elastano = array("l")
+        self.vivo = bytearray()
+        self.strings = _Dicionario()
+        self.pos_por_id: dict[int, int] = {}
+        self.max_id = 0
+        self.postings: dict[str, dict] = {f: {} for f in self.FACETAS}
+        self.rotulos: dict[str, dict] = {f: {} for f in self.FACETAS}
+        self.empresas: dict[int, dict] = {}
+        self._cache: dict = {}
+
+    # ---------- carga ----------
+    @staticmethod
+    def _colunas():
+        return (
+            Tear.id, Tear.tipo, Tear.diametro, Tear.finura, Tear.alimentadores, Tear.elastano,
+            Empresa.id, Empresa.apelido, Empresa.nome, Empresa.email,
+            Empresa.telefone, Empresa.estado, Empresa.cidade,
+        )
+
+    @classmethod
+    def construir(cls, versao: int) -> "_IndiceTeares":
+        idx = cls(versao)
+        rows = (_teares_query_base()
+                .with_entities(*cls._colunas())
+                .order_by(Tear.id.asc())
+                .all())
+        for r in rows:
+            idx._append(r)
+        return idx
+
+    def _chaves(self, pos: int) -> dict:
+        emp = self.empresas.get(self.empresa_ids[pos]) or {}
+        d = self.diametro[pos]
+        f = self.finura[pos]
+        return {
+            "tipo": (self.strings.valores[self.tipo[pos]] or "").lower() or None,
+            "diametro": d if d >= 0 else None,
+            "galga": f if f >= 0 else None,
+            "estado": (emp.get("uf") or "").lower() or None,
+            "cidade": (emp.get("cidade") or "").lower() or None,
+        }
+
+    def _indexar(self, pos: int, tear_tipo, emp: dict):
+        rotulos_brutos = {
+            "tipo": tear_tipo,
+            "diametro": self.diametro[pos] if self.diametro[pos] >= 0 else None,
+            "galga": self.finura[pos] if self.finura[pos] >= 0 else None,
+            "estado": emp.get("uf"),
+            "cidade": emp.get("cidade"),
+        }
+        for faceta, chave in self._chaves(pos).items():
+            if chave is None:
+                continue
+            self.postings[faceta].setdefault(chave, set()).add(pos)
+            self.rotulos[faceta].setdefault(chave, rotulos_brutos[faceta])
+
+    def _desindexar(self, pos: int):
+        for faceta, chave in self._chaves(pos).items():
+            if chave is None:
+                continue
+            s = self.postings[faceta].get(chave)
+            if s is not None:
+                s.discard(pos)
+                if not s:
+                    del self.postings[faceta][chave]
+                    self.rotulos[faceta].pop(chave, None)
+
+    def _set_empresa(self, r):
+        self.empresas[r[6]] = {
+            "apelido": _empresa_apelido(r[7], r[8], r[9]),
+            "contato": _wa_link(r[10]),
+            "uf": r[11],
+            "cidade": r[12],
+        }
+        return self.empresas[r[6]]
+
+    def _append(self, r):
+        emp = self._set_empresa(r)
+        pos = len(self.ids)
+        self.ids.append(r[0])
+        self.empresa_ids.append(r[6])
+        self.tipo.append(self.strings.codigo(r[1]))
+        self.diametro.append(r[2] if r[2] is not None else -1)
+        self.finura.append(r[3] if r[3] is not None else -1)
+        self.alimentadores.append(r[4] if r[4] is not None else -1)
+        self.elastano.append(self.strings.codigo(r[5]))
+        self.vivo.append(1)
+        self.pos_por_id[r[0]] = pos
+        self.max_id = max(self.max_id, r[0])
+        self._indexar(pos, r[1], emp)
+
+    # ---------- remendos incrementais ----------
+    def remover(self, tear_id: int):
+        pos = self.pos_por_id.pop(tear_id, None)
+        if pos is None:
+            return
+        self._desindexar(pos)
+        self.vivo[pos] = 0
+        self._cache.clear()
+
+    def upsert(self, r) -> bool:
+        """Insere/atualiza uma linha. Retorna False se exigir reconstrução."""
+        pos = self.pos_por_id.get(r[0])
+        if pos is None:
+            if r[0] < self.max_id:
+                return False  # fora de ordem: mais simples reconstruir
+            self._append(r)
+        else:
+            self._desindexar(pos)
+            emp = self._set_empresa(r)
+            self.tipo[pos] = self.strings.codigo(r[1])
+            self.diametro[pos] = r[2] if r[2] is not None else -1
+            self.finura[pos] = r[3] if r[3] is not None else -1
+            self.alimentadores[pos] = r[4] if r[4] is not None else -1
+            self.elastano[pos] = self.strings.codigo(r[5])
+            self._indexar(pos, r[1], emp)
+        self._cache.clear()
+        return True
 
-def _render_try(candidatos: list[str], **ctx):
-    """Tenta renderizar o primeiro template existente na lista.
-       Se nenhum existir, cai num HTML mínimo para não 500."""
-    for nome in candidatos:
-        try:
-            return render_template(nome, **ctx)
-        except TemplateNotFound:
-            continue
-    return render_template_string("<h2>Página temporária</h2><p>Conteúdo indisponível.</p>")
+    # ---------- consulta ----------
+    @staticmethod
+    def chaves_filtro(filtros: dict) -> dict:
+        return {
+            "tipo": (filtros.get("tipo") or "").lower() or None,
+            "diametro": _to_int(filtros.get("diâmetro")) if filtros.get("diâmetro") else None,
+            "galga": _to_int(filtros.get("galga")) if filtros.get("galga") else None,
+            "estado": (filtros.get("estado") or "").lower() or None,
+            "cidade": (filtros.get("cidade") or "").lower() or None,
+        }
 
-def _get_notificacoes(empresa_id):
-    # Troque por consulta real quando tiver o banco
-    items = []  # ex.: [{"titulo":"Novo contato","mensagem":"João enviou msg"}]
-    return len(items), items
+    def _conjunto(self, chaves: dict) -> set | None:
+        """Interseção das posting lists dos filtros ativos (None = sem filtro)."""
+        conjuntos = []
+        for faceta, chave in chaves.items():
+            if chave is None:
+                continue
+            s = self.postings[faceta].get(chave)
+            if not s:
+                return set()
+            conjuntos.append(s)
+        if not conjuntos:
+            return None
+        conjuntos.sort(key=len)
+        res = set(conjuntos[0])
+        for s in conjuntos[1:]:
+            res &= s
+            if not res:
+                break
+        return res
+
+    def _posicoes(self, chaves: dict) -> list[int]:
+        res = self._conjunto(chaves)
+        if res is None:
+            return [p for p in range(len(self.ids) - 1, -1, -1) if self.vivo[p]]
+        return sorted(res, reverse=True)
+
+    def buscar(self, filtros: dict) -> list[int]:
+        chaves = self.chaves_filtro(filtros)
+        k = tuple(sorted(chaves.items()))
+        hit = self._cache.get(k)
+        if hit is None:
+            if len(self._cache) > 256:
+                self._cache.clear()
+            hit = self._cache[k] = self._posicoes(chaves)
+        return hit
+
+    def inicio_cursor(self, posicoes: list[int], cursor: dict, por_pagina: int) -> int:
+        """
+        Posição inicial da página em `posicoes` (ordem Tear.id DESC) para o cursor:
+          {"a": id} -> depois do tear `id`; {"b": id} -> página anterior a `id`;
+          {"fim": 1} -> última página.
+        """
+        total = len(posicoes)
+        if cursor.get("fim"):
+            return max(0, total - (total % por_pagina or por_pagina))
+        neg = lambda p: -p
+        if "a" in cursor:
+            corte = bisect_left(self.ids, int(cursor["a"]))       # ids < a
+            return bisect_right(posicoes, -corte, key=neg)
+        if "b" in cursor:
+            corte = bisect_right(self.ids, int(cursor["b"]))      # ids > b
+            fim = bisect_right(posicoes, -corte, key=neg)
+            return max(0, fim - por_pagina)
+        return 0
 
-# --------------------------------------------------------------------
-# INDEX
-# --------------------------------------------------------------------
-def _num_key(x):
-    try:
-        return float(str(x).replace(",", "."))
-    except Exception:
-        return 0.0
+    def facetas(self, filtros: dict) -> dict:
+        """
+        Contagem por opção de cada faceta, condicionada aos DEMAIS filtros ativos
+        (drill-down): {"tipo": {"MONO": 12, ...}, "diâmetro": {...}, ...}.
+        """
+        chaves = self.chaves_filtro(filtros)
+        k = ("facetas",) + tuple(sorted(chaves.items()))
+        hit = self._cache.get(k)
+        if hit is not None:
+            return hit
+
+        res = {}
+        for faceta, nome in zip(self.FACETAS, FACETAS_NOMES):
+            outras = dict(chaves)
+            outras[faceta] = None
+            base = self._conjunto(outras)
+            rotulos = self.rotulos[faceta]
+            contagens = {}
+            for chave, s in self.postings[faceta].items():
+                n = len(s) if base is None else len(s.intersection(base) if len(s) < len(base) else base.intersection(s))
+                if n:
+                    contagens[str(rotulos[chave])] = n
+            res[nome] = contagens
+
+        if len(self._cache) > 256:
+            self._cache.clear()
+        self._cache[k] = res
+        return res
+
+    def opcoes(self, filtros: dict) -> dict:
+        def _ordenados(faceta, key=None):
+            return sorted((str(v) for v in self.rotulos[faceta].values()), key=key)
+
+        opcoes = {
+            "tipo": _ordenados("tipo"),
+            "diâmetro": _ordenados("diametro", key=_num_key),
+            "galga": _ordenados("galga", key=_num_key),
+            "estado": _ordenados("estado"),
+            "cidade": [],
+        }
+        uf = (filtros.get("estado") or "").lower()
+        if uf:
+            cidades = set()
+            for pos in self.postings["estado"].get(uf, ()):
+                c = self.empresas.get(self.empresa_ids[pos], {}).get("cidade")
+                if c:
+                    cidades.add(c)
+            opcoes["cidade"] = sorted(cidades)
+        return opcoes
+
+    def card(self, pos: int) -> dict:
+        emp = self.empresas.get(self.empresa_ids[pos]) or {}
+        tipo = self.strings.valores[self.tipo[pos]]
+        fin = self.finura[pos] if self.finura[pos] >= 0 else None
+        diam = self.diametro[pos] if self.diametro[pos] >= 0 else None
+        alim = self.alimentadores[pos] if self.alimentadores[pos] >= 0 else None
+        return _montar_card(
+            tear_id=self.ids[pos], empresa_id=self.empresa_ids[pos], apelido=emp.get("apelido") or "—",
+            tipo=tipo, finura=fin, diametro=diam, alimentadores=alim,
+            elastano=self.strings.valores[self.elastano[pos]],
+            uf=emp.get("uf"), cidade=emp.get("cidade"), contato=emp.get("contato"),
+        )
 
-def _to_int(s):
-    try:
-        return int(float(str(s).replace(",", ".")))
-    except Exception:
-        return None
+# nomes das facetas como chegam no template (mesmas chaves de `opcoes`)
+FACETAS_NOMES = ("tipo", "diâmetro", "galga", "estado", "cidade")
 
-@app.post("/api/track")
-def api_track():
-    data = request.get_json(silent=True) or {}
-    event      = data.get("event")
-    company_id = data.get("company_id")
-    tear_id    = data.get("tear_id")
-    session_id = data.get("session_id") or (session.get("_sid") or request.cookies.get("session") or "")
-    meta       = data.get("meta") or {}
+def _facetas_de_grupos(grupos, filtros: dict) -> dict:
+    """
+    Mesmo resultado de _IndiceTeares.facetas() a partir de UM SELECT ... GROUP BY
+    (tipo, diametro, finura, estado, cidade) — usado pelo caminho SQL.
+    """
+    chaves = _IndiceTeares.chaves_filtro(filtros)
+    normalizados = []
+    for t_tipo, t_diam, t_fin, e_uf, e_cid, n in grupos:
+        normalizados.append(((
+            (t_tipo or "").lower() or None,
+            t_diam,
+            t_fin,
+            (e_uf or "").lower() or None,
+            (e_cid or "").lower() or None,
+        ), (t_tipo, t_diam, t_fin, e_uf, e_cid), int(n or 0)))
+
+    res = {}
+    for i, nome in enumerate(FACETAS_NOMES):
+        contagens = {}
+        for norm, bruto, n in normalizados:
+            if bruto[i] in (None, ""):
+                continue
+            ok = all(
+                chaves[f] is None or norm[j] == chaves[f]
+                for j, f in enumerate(_IndiceTeares.FACETAS) if j != i
+            )
+            if ok:
+                rot = str(bruto[i])
+                contagens[rot] = contagens.get(rot, 0) + n
+        res[nome] = contagens
+    return res
+
+def _card_de_linha(r) -> dict:
+    """Card a partir de uma linha projetada com _IndiceTeares._colunas()."""
+    return _montar_card(
+        tear_id=r[0], empresa_id=r[6], apelido=_empresa_apelido(r[7], r[8], r[9]),
+        tipo=r[1], finura=r[3], diametro=r[2], alimentadores=r[4], elastano=r[5],
+        uf=r[11], cidade=r[12], contato=_wa_link(r[10]),
+    )
 
-    if event not in ALLOWED_EVENTS or not company_id:
-        return jsonify({"ok": False, "error": "bad event/company"}), 400
+def _montar_card(*, tear_id, empresa_id, apelido, tipo, finura, diametro, alimentadores,
+                 elastano, uf, cidade, contato) -> dict:
+    """Dicionário consumido pelos cards/tabela do index.html (+ aliases do CSV antigo)."""
+    return {
+        "id": tear_id,
+        "empresa_id": empresa_id,  # 👈 ID da malharia
+        "empresa": apelido,
+        "tipo": tipo or "—",
+        "galga": finura if finura is not None else "—",
+        "diametro": diametro if diametro is not None else "—",
+        "alimentadores": alimentadores if alimentadores is not None else "—",
+        "elastano": elastano,          # 👈 agora vai para o template
+        "kit_elastano": elastano,      # 👈 alias para compatibilidade
+        "uf": uf or "—",
+        "cidade": cidade or "—",
+        "contato": contato,
+
+        # Aliases para CSV antigo (opcional manter)
+        "Empresa": apelido,
+        "Tipo": tipo or "—",
+        "Galga": finura if finura is not None else "—",
+        "Diâmetro": diametro if diametro is not None else "—",
+        "Alimentadores": alimentadores if alimentadores is not None else "—",
+        "Elastano": elastano,          # 👈 alias CSV
+        "UF": uf or "—",
+        "Cidade": cidade or "—",
+        "Contato": contato,
+    }
+
+_BUSCA_IDX: _IndiceTeares | None = None
+_BUSCA_IDX_LOCK = threading.RLock()
+_BUSCA_IDX_LAST_CHECK = 0.0
 
+def _busca_indice() -> _IndiceTeares:
+    """Retorna o índice atual; reconstrói se a versão global mudou (ou uma assinatura venceu)."""
+    global _BUSCA_IDX, _BUSCA_IDX_LAST_CHECK
+    now = time.time()
+    idx = _BUSCA_IDX
+    if idx is not None and (now - _BUSCA_IDX_LAST_CHECK) < BUSCA_INDICE_CHECK_SEG:
+        return idx
+
+    with _BUSCA_IDX_LOCK:
+        versao = _catalogo_versao_vigente()
+        _BUSCA_IDX_LAST_CHECK = time.time()
+        if _BUSCA_IDX is None or _BUSCA_IDX.versao != versao:
+            t0 = time.perf_counter()
+            _BUSCA_IDX = _IndiceTeares.construir(versao)
+            app.logger.info({
+                "rota": "busca_indice",
+                "acao": "rebuild",
+                "versao": versao,
+                "linhas": len(_BUSCA_IDX.pos_por_id),
+                "ms": round((time.perf_counter() - t0) * 1000, 1),
+            })
+        return _BUSCA_IDX
+
+def catalogo_alterado(tear_ids=(), removidos=(), reconstruir: bool = False):
+    """
+    Avise aqui TODA alteração que afete a busca (após o commit).
+    - tear_ids: teares criados/editados (remenda o índice local)
+    - removidos: teares excluídos
+    - reconstruir: mudança em empresa (status de pagamento, cidade, seed...)
+    Sempre incrementa a versão global para os demais workers.
+    """
+    global _BUSCA_IDX
     try:
-        with db.engine.begin() as conn:
-            conn.execute(
-                text("""
-                    INSERT INTO analytics_events (company_id, tear_id, event, session_id, meta)
-                    VALUES (:cid, :tid, :evt, :sid, :meta)
-                """),
-                {
-                    "cid": int(company_id),
-                    "tid": int(tear_id) if tear_id else None,
-                    "evt": event,
-                    "sid": session_id,
-                    "meta": json.dumps(meta),
-                },
-            )
-        return jsonify({"ok": True})
-    except Exception as e:
-        app.logger.exception("[analytics] falha ao registrar evento: %s", e)
-        return jsonify({"ok": False}), 500
+        nova = _catalogo_bump()
+    except Exception:
+        app.logger.exception("[busca] falha ao incrementar versão do catálogo")
+        with _BUSCA_IDX_LOCK:
+            _BUSCA_IDX = None
+        return
+
+    with _BUSCA_IDX_LOCK:
+        idx = _BUSCA_IDX
+        if idx is None:
+            return
+        if reconstruir or idx.versao != nova - 1:
+            _BUSCA_IDX = None  # outro worker também mexeu: reconstrói na próxima busca
+            return
+        try:
+            for tid in removidos:
+                idx.remover(int(tid))
+            if tear_ids:
+                rows = (_teares_query_base()
+                        .with_entities(*_IndiceTeares._colunas())
+                        .filter(Tear.id.in_([int(t) for t in tear_ids]))
+                        .order_by(Tear.id.asc())
+                        .all())
+                vistos = set()
+                for r in rows:
+                    vistos.add(r[0])
+                    if not idx.upsert(r):
+                        _BUSCA_IDX = None
+                        return
+                for tid in tear_ids:
+                    if int(tid) not in vistos:
+                        idx.remover(int(tid))  # deixou de ser visível
+            idx.versao = nova
+        except Exception:
+            app.logger.exception("[busca] falha ao remendar índice; reconstrução agendada")
+            _BUSCA_IDX = None
 
 # ================================================================
 
@@ -1758,133 +4516,31 @@ def index():
         return _render_offline()
 
     try:
-        v = request.args
-        filtros = {
-            "tipo":     (v.get("tipo") or "").strip(),
-            "diâmetro": (v.get("diâmetro") or v.get("diametro") or "").strip(),
-            "galga":    (v.get("galga") or "").strip(),
-            "estado":   (v.get("estado") or "").strip(),
-            "cidade":   (v.get("cidade") or "").strip(),
-        }
-
-        q_base = Tear.query.join(Empresa, Tear.empresa_id == Empresa.id)
-        # Se a coluna 'ativo' não existir, ignora silenciosamente
-        try:
-            q_base = q_base.filter(Tear.ativo.is_(True))
-        except Exception:
-            pass
-
-        # 🔒 Regra de negócio: só empresas com pagamento/assinatura ativa
-        # 1) Se você tiver a propriedade híbrida Empresa.assinatura_ativa (recomendado)
-        try:
-            q_base = q_base.filter(Empresa.assinatura_ativa)
-        except Exception:
-            # 2) Fallback por data "pago até"
-            try:
-                q_base = q_base.filter(Empresa.pago_ate >= db.func.now())
-            except Exception:
-                # 3) Fallback por status textual
-                try:
-                    q_base = q_base.filter(Empresa.assinatura_status.in_(["active", "approved", "trial"]))
-                except Exception:
-                    # Se nada disso existir, segue sem o filtro (legado)
-                    pass
-        # ---- FIM: nova query base ----
-        
-        opcoes = {"tipo": [], "diâmetro": [], "galga": [], "estado": [], "cidade": []}
-        from collections import defaultdict
-        cidades_por_uf = defaultdict(set)
-        tipos_set, diam_set, galga_set, estados_set = set(), set(), set(), set()
-
-        for t_tipo, t_diam, t_fin, e_uf, e_cid in q_base.with_entities(
-            Tear.tipo, Tear.diametro, Tear.finura, Empresa.estado, Empresa.cidade
-        ).all():
-            if t_tipo:
-                tipos_set.add(t_tipo)
-            if t_diam is not None:
-                diam_set.add(str(t_diam))
-            if t_fin is not None:
-                galga_set.add(str(t_fin))
-            if e_uf:
-                estados_set.add(e_uf)
-                if e_cid:
-                    cidades_por_uf[e_uf].add(e_cid)
-
-        opcoes["tipo"] = sorted(tipos_set)
-        opcoes["diâmetro"] = sorted(diam_set, key=_num_key)
-        opcoes["galga"] = sorted(galga_set, key=_num_key)
-        opcoes["estado"] = sorted(estados_set)
-        opcoes["cidade"] = sorted(cidades_por_uf.get(filtros["estado"], set())) if filtros["estado"] else []
-
-        q = q_base
-        if filtros["tipo"]:
-            q = q.filter(db.func.lower(Tear.tipo) == filtros["tipo"].lower())
-        di = _to_int(filtros["diâmetro"])
-        if di is not None:
-            q = q.filter(Tear.diametro == di)
-        ga = _to_int(filtros["galga"])
-        if ga is not None:
-            q = q.filter(Tear.finura == ga)
-        if filtros["estado"]:
-            q = q.filter(db.func.lower(Empresa.estado) == filtros["estado"].lower())
-        if filtros["cidade"]:
-            q = q.filter(db.func.lower(Empresa.cidade) == filtros["cidade"].lower())
+        filtros = _filtros_busca(request.args)
 
         pagina = max(1, int(request.args.get("pagina", 1) or 1))
         por_pagina = int(request.args.get("pp", 20) or 20)
         por_pagina = max(1, min(100, por_pagina))
+        cursor = cursor_decode(request.args.get("cursor"))
+        incluir_total = (request.args.get("total") or "1") != "0"
 
-        total = q.count()
-        q = q.order_by(Tear.id.desc())
-        teares_page = q.offset((pagina - 1) * por_pagina).limit(por_pagina).all()
-        total_paginas = max(1, (total + por_pagina - 1) // por_pagina)
-
-        resultados = []
-        for tear in teares_page:
-            emp = getattr(tear, "empresa", None)
-            apelido = (
-                (emp.apelido if emp else None)
-                or (getattr(emp, "nome_fantasia", None) if emp else None)
-                or (getattr(emp, "nome", None) if emp else None)
-                or ((emp.email.split("@")[0]) if emp and getattr(emp, "email", None) else None)
-                or "—"
-            )
-            numero = re.sub(r"\D", "", (emp.telefone or "")) if emp else ""
-            contato_link = f"https://wa.me/{'55' + numero if numero and not numero.startswith('55') else numero}" if numero else None
-
-            # pega o valor como estiver no banco; se houver legado em 'kit_elastano', usa como fallback
-            raw_elastano = getattr(tear, "elastano", None)
-            if raw_elastano is None:
-                raw_elastano = getattr(tear, "kit_elastano", None)
-
-            item = {
-                "empresa_id": (getattr(emp, "id", None) if emp else None),  # 👈 ID da malharia
-                "empresa": apelido,
-                "tipo": tear.tipo or "—",
-                "galga": tear.finura if tear.finura is not None else "—",
-                "diametro": tear.diametro if tear.diametro is not None else "—",
-                "alimentadores": getattr(tear, "alimentadores", None) if getattr(tear, "alimentadores", None) is not None else "—",
-                "elastano": raw_elastano,          # 👈 agora vai para o template
-                "kit_elastano": raw_elastano,      # 👈 alias para compatibilidade
-                "uf": (emp.estado if emp and getattr(emp, "estado", None) else "—"),
-                "cidade": (emp.cidade if emp and getattr(emp, "cidade", None) else "—"),
-                "contato": contato_link,
-
-                # Aliases para CSV antigo (opcional manter)
-                "Empresa": apelido,
-                "Tipo": tear.tipo or "—",
-                "Galga": tear.finura if tear.finura is not None else "—",
-                "Diâmetro": tear.diametro if tear.diametro is not None else "—",
-                "Alimentadores": getattr(tear, "alimentadores", None) if getattr(tear, "alimentadores", None) is not None else "—",
-                "Elastano": raw_elastano,          # 👈 alias CSV
-                "UF": (emp.estado if emp and getattr(emp, "estado", None) else "—"),
-                "Cidade": (emp.cidade if emp and getattr(emp, "cidade", None) else "—"),
-                "Contato": contato_link,
-            }
-            resultados.append(item)
+        busca = None
+        if BUSCA_INDICE_MEMORIA:
+            try:
+                busca = _busca_via_indice(filtros, pagina, por_pagina, cursor, incluir_total)
+            except Exception:
+                app.logger.exception("[INDEX] índice em memória indisponível; usando SQL")
+        if busca is None:
+            busca = _busca_via_sql(filtros, pagina, por_pagina, cursor, incluir_total)
+
+        total = busca["total"]
+        opcoes = busca["opcoes"]
+        pagina = busca["pagina"]
+        total_paginas = max(1, (total + por_pagina - 1) // por_pagina) if total is not None else None
 
         app.logger.info({
             "rota": "index",
+            "origem": busca["origem"],
             "total_encontrado": total,
             "pagina": pagina,
             "pp": por_pagina,
@@ -1895,13 +4551,16 @@ def index():
             "index.html",
             opcoes=opcoes,
             filtros=filtros,
-            resultados=resultados,
-            teares=teares_page,
+            resultados=busca["resultados"],
             total=total,
             pagina=pagina,
             por_pagina=por_pagina,
             total_paginas=total_paginas,
             estados=opcoes["estado"],
+            facetas=busca["facetas"],
+            cursor_anterior=busca["cursor_anterior"],
+            cursor_proximo=busca["cursor_proximo"],
+            cursor_ultima=cursor_encode({"fim": 1}),
         )
 
     except Exception as e:
@@ -1909,6 +4568,201 @@ def index():
         app.logger.exception("[INDEX] falha ao consultar DB: %s", e)
         return _render_offline()
 
+# =====================[ API - BUSCA DE TEARES (JSON) ]=====================
+# Mesmos filtros da home; resposta enxuta (cards + facetas + cursor).
+# ETag forte = versão do catálogo + parâmetros: If-None-Match -> 304
+# sem rodar a busca (o front e parceiros podem fazer polling barato).
+API_CARD_CAMPOS = ("id", "empresa_id", "empresa", "tipo", "galga", "diametro",
+                   "alimentadores", "elastano", "uf", "cidade", "contato")
+
+def _catalogo_versao_atual() -> int:
+    if BUSCA_INDICE_MEMORIA:
+        try:
+            return _busca_indice().versao
+        except Exception:
+            app.logger.exception("[API] índice em memória indisponível; lendo versão do DB")
+    return _catalogo_versao_vigente()
+
+@app.get("/api/teares")
+def api_teares():
+    if not getattr(g, "db_up", True):
+        return jsonify({"ok": False, "error": "db_offline"}), 503
+
+    v = request.args
+    filtros = _filtros_busca(v)
+    try:
+        pagina = max(1, int(v.get("pagina", 1) or 1))
+        por_pagina = max(1, min(100, int(v.get("pp", 20) or 20)))
+    except ValueError:
+        return jsonify({"ok": False, "error": "bad pagina/pp"}), 400
+    cursor_raw = (v.get("cursor") or "").strip()
+    cursor = cursor_decode(cursor_raw)
+    if cursor_raw and cursor is None:
+        return jsonify({"ok": False, "error": "bad cursor"}), 400
+    incluir_total = (v.get("total") or "1") != "0"
+
+    versao = _catalogo_versao_atual()
+    assinatura = json.dumps([versao, filtros, pagina, por_pagina, cursor_raw, incluir_total],
+                            sort_keys=True, ensure_ascii=False)
+    etag = "v%d-%s" % (versao, hashlib.sha1(assinatura.encode("utf-8")).hexdigest()[:20])
+
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        busca = None
+        if BUSCA_INDICE_MEMORIA:
+            try:
+                busca = _busca_via_indice(filtros, pagina, por_pagina, cursor, incluir_total)
+            except Exception:
+                app.logger.exception("[API] índice em memória indisponível; usando SQL")
+        if busca is None:
+            busca = _busca_via_sql(filtros, pagina, por_pagina, cursor, incluir_total)
+
+        resp = jsonify({
+            "ok": True,
+            "versao": versao,
+            "filtros": filtros,
+            "total": busca["total"],
+            "pagina": busca["pagina"],
+            "pp": por_pagina,
+            "cursor": {"anterior": busca["cursor_anterior"], "proximo": busca["cursor_proximo"]},
+            "facetas": busca["facetas"],
+            "resultados": [{k: c.get(k) for k in API_CARD_CAMPOS} for c in busca["resultados"]],
+        })
+
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "public, no-cache"  # sempre revalida (barato via 304)
+    return resp
+
+def _filtro_txt(valor) -> str:
+    # JSON pode trazer número/bool/lista: só escalares viram texto
+    if valor is None or isinstance(valor, (dict, list)):
+        return ""
+    return str(valor).strip()
+
+def _filtros_busca(v) -> dict:
+    """Filtros da home (mesmos nomes usados por index(), exportar() e /api/teares)."""
+    return {
+        "tipo":     _filtro_txt(v.get("tipo")),
+        "diâmetro": _filtro_txt(v.get("diâmetro") or v.get("diametro")),
+        "galga":    _filtro_txt(v.get("galga")),
+        "estado":   _filtro_txt(v.get("estado")),
+        "cidade":   _filtro_txt(v.get("cidade")),
+    }
+
+def _busca_via_indice(filtros: dict, pagina: int, por_pagina: int,
+                      cursor: dict | None = None, incluir_total: bool = True) -> dict:
+    idx = _busca_indice()
+    posicoes = idx.buscar(filtros)
+    if cursor:
+        ini = idx.inicio_cursor(posicoes, cursor, por_pagina)
+        pagina = ini // por_pagina + 1
+    else:
+        ini = (pagina - 1) * por_pagina
+    fatia = posicoes[ini:ini + por_pagina]
+    return {
+        "origem": "indice",
+        "opcoes": idx.opcoes(filtros),
+        "facetas": idx.facetas(filtros),
+        "total": len(posicoes),  # no índice o total exato é de graça
+        "pagina": pagina,
+        "resultados": [idx.card(p) for p in fatia],
+        "cursor_anterior": cursor_encode({"b": idx.ids[fatia[0]]}) if fatia and ini > 0 else None,
+        "cursor_proximo": cursor_encode({"a": idx.ids[fatia[-1]]}) if fatia and ini + por_pagina < len(posicoes) else None,
+    }
+
+def _busca_via_sql(filtros: dict, pagina: int, por_pagina: int,
+                   cursor: dict | None = None, incluir_total: bool = True) -> dict:
+    """Caminho SQL original (usado quando o índice em memória está desligado/falhou)."""
+    q_base = _teares_query_base()
+
+    opcoes = {"tipo": [], "diâmetro": [], "galga": [], "estado": [], "cidade": []}
+    from collections import defaultdict
+    cidades_por_uf = defaultdict(set)
+    tipos_set, diam_set, galga_set, estados_set = set(), set(), set(), set()
+
+    # Um único GROUP BY: opções + contagens saem das combinações distintas
+    grupos = (q_base
+              .with_entities(Tear.tipo, Tear.diametro, Tear.finura, Empresa.estado, Empresa.cidade,
+                             func.count(Tear.id))
+              .group_by(Tear.tipo, Tear.diametro, Tear.finura, Empresa.estado, Empresa.cidade)
+              .all())
+
+    for t_tipo, t_diam, t_fin, e_uf, e_cid, _n in grupos:
+        if t_tipo:
+            tipos_set.add(t_tipo)
+        if t_diam is not None:
+            diam_set.add(str(t_diam))
+        if t_fin is not None:
+            galga_set.add(str(t_fin))
+        if e_uf:
+            estados_set.add(e_uf)
+            if e_cid:
+                cidades_por_uf[e_uf].add(e_cid)
+
+    opcoes["tipo"] = sorted(tipos_set)
+    opcoes["diâmetro"] = sorted(diam_set, key=_num_key)
+    opcoes["galga"] = sorted(galga_set, key=_num_key)
+    opcoes["estado"] = sorted(estados_set)
+    opcoes["cidade"] = sorted(cidades_por_uf.get(filtros["estado"], set())) if filtros["estado"] else []
+
+    q = q_base
+    if filtros["tipo"]:
+        q = q.filter(db.func.lower(Tear.tipo) == filtros["tipo"].lower())
+    di = _to_int(filtros["diâmetro"])
+    if di is not None:
+        q = q.filter(Tear.diametro == di)
+    ga = _to_int(filtros["galga"])
+    if ga is not None:
+        q = q.filter(Tear.finura == ga)
+    if filtros["estado"]:
+        q = q.filter(db.func.lower(Empresa.estado) == filtros["estado"].lower())
+    if filtros["cidade"]:
+        q = q.filter(db.func.lower(Empresa.cidade) == filtros["cidade"].lower())
+
+    total = None
+    if incluir_total or (cursor or {}).get("fim"):
+        chave = ("busca", _catalogo_versao_vigente()) + tuple(sorted(_IndiceTeares.chaves_filtro(filtros).items()))
+        total = contagem_cacheada(chave, q)
+
+    # Página em UMA query: Tear ⨝ Empresa projetando só as colunas do card
+    # (nada de tear.empresa lazy por linha). Com cursor: keyset em Tear.id,
+    # sem OFFSET. Busca pp+1 linhas para saber se há próxima/anterior.
+    q = q.with_entities(*_IndiceTeares._colunas())
+    cursor = cursor or {}
+    if "a" in cursor:
+        linhas = q.filter(Tear.id < int(cursor["a"])).order_by(Tear.id.desc()).limit(por_pagina + 1).all()
+        tem_prox, tem_ant = len(linhas) > por_pagina, True
+        linhas = linhas[:por_pagina]
+    elif "b" in cursor:
+        linhas = q.filter(Tear.id > int(cursor["b"])).order_by(Tear.id.asc()).limit(por_pagina + 1).all()
+        tem_prox, tem_ant = True, len(linhas) > por_pagina
+        linhas = list(reversed(linhas[:por_pagina]))
+    elif cursor.get("fim"):
+        resto = (total % por_pagina) or por_pagina
+        linhas = list(reversed(q.order_by(Tear.id.asc()).limit(resto).all()))
+        tem_prox, tem_ant = False, total > resto
+        pagina = max(1, (total + por_pagina - 1) // por_pagina)
+    else:
+        # links antigos ?pagina=N continuam funcionando (OFFSET)
+        linhas = (q.order_by(Tear.id.desc())
+                   .offset((pagina - 1) * por_pagina)
+                   .limit(por_pagina + 1)
+                   .all())
+        tem_prox, tem_ant = len(linhas) > por_pagina, pagina > 1
+        linhas = linhas[:por_pagina]
+
+    return {
+        "origem": "sql",
+        "opcoes": opcoes,
+        "facetas": _facetas_de_grupos(grupos, filtros),
+        "total": total,
+        "pagina": pagina,
+        "resultados": [_card_de_linha(r) for r in linhas],
+        "cursor_anterior": cursor_encode({"b": linhas[0][0]}) if linhas and tem_ant else None,
+        "cursor_proximo": cursor_encode({"a": linhas[-1][0]}) if linhas and tem_prox else None,
+    }
+
 # --- OTP / E-mail helpers (força HTML) --------------------------------------
 import random
 from datetime import datetime, timedelta
@@ -1916,182 +4770,152 @@ from flask import current_app, session
 
 def _email_send_html_first(to_email: str, subject: str, text: str, html: str | None) -> bool:
     """
-    Envia priorizando HTML:
-      1) Flask-Mail (via current_app.extensions['mail'] ou 'mail' global);
-      2) SMTP multipart/alternative (env vars);
-      3) Helpers do projeto (último recurso; podem degradar para texto).
+    Enfileira priorizando HTML (prioridade alta: OTP). A entrega passa pela
+    mesma cadeia de provedores de send_email(), no despachante do outbox.
     """
-    # 1) Flask-Mail via registry (funciona mesmo sem 'mail' global)
-    try:
-        mail_ext = (getattr(current_app, "extensions", {}) or {}).get("mail")
-        if (mail_ext or "mail" in globals()) and html:
-            from flask_mail import Message
-            sender = current_app.config.get("MAIL_DEFAULT_SENDER")
-            msg = Message(subject=subject, recipients=[to_email], sender=sender)
-            msg.body = text or ""
-            msg.html = html
-            msg.extra_headers = {"Content-Language": "pt-BR"}
-            (mail_ext or mail).send(msg)  # type: ignore[name-defined]
-            current_app.logger.info("[MAIL_PATH] flask-mail-html")
-            return True
-    except Exception:
-        current_app.logger.exception("[MAIL] Flask-Mail falhou")
+    msg_id = email_enfileirar(to_email, subject, html or "", text, tipo="otp", prioridade=10)
+    if msg_id is None:
+        current_app.logger.error("[MAIL] falha ao enfileirar (outbox)")
+        return False
+    current_app.logger.info(f"[MAIL_PATH] outbox:{msg_id}")
+    return True
+
+# OTP de login persistido em otp_token (antes ficava no cookie da sessão).
+# Só o HMAC(SECRET_KEY, email:código) é gravado; cada e-mail tem no máximo um
+# código ativo (emitir um novo invalida o anterior). Reenvio limitado por
+# token bucket por e-mail e por IP (por processo) e por um intervalo mínimo
+# entre envios lido do banco (vale entre workers).
+import hmac, secrets
+from collections import OrderedDict
+
+OTP_TTL_MIN = int(os.getenv("OTP_TTL_MIN", "30"))
+OTP_MAX_TENTATIVAS = int(os.getenv("OTP_MAX_TENTATIVAS", "5"))
+OTP_REENVIO_MIN_SEG = int(os.getenv("OTP_REENVIO_MIN_SEG", "30"))
+OTP_RL_EMAIL = (int(os.getenv("OTP_RL_EMAIL_MAX", "5")), float(os.getenv("OTP_RL_EMAIL_JANELA_SEG", "900")))
+OTP_RL_IP = (int(os.getenv("OTP_RL_IP_MAX", "20")), float(os.getenv("OTP_RL_IP_JANELA_SEG", "900")))
+OTP_LIMPEZA_SEG = float(os.getenv("OTP_LIMPEZA_SEG", "3600"))
+
+_OTP_BALDES: OrderedDict = OrderedDict()
+_OTP_BALDES_LOCK = threading.Lock()
+
+def _otp_hash(email: str, code: str) -> str:
+    return hmac.new(app.config["SECRET_KEY"].encode(), f"{email}:{code}".encode(), hashlib.sha256).hexdigest()
+
+def _otp_balde(chave: tuple, limite: tuple) -> float:
+    """Token bucket por chave (LRU com até 10 mil chaves); retorna segundos de espera."""
+    maximo, janela = limite
+    with _OTP_BALDES_LOCK:
+        balde = _OTP_BALDES.get(chave)
+        if balde is None:
+            balde = _OTP_BALDES[chave] = _BaldeTokens(maximo / janela, maximo)
+            if len(_OTP_BALDES) > 10000:
+                _OTP_BALDES.popitem(last=False)
+        else:
+            _OTP_BALDES.move_to_end(chave)
+    return balde.tentar()
 
-    # 2) SMTP multipart/alternative
-    try:
-        import os, smtplib, ssl
-        from email.mime.multipart import MIMEMultipart
-        from email.mime.text import MIMEText
-
-        host = os.environ.get("SMTP_HOST")
-        port = int(os.environ.get("SMTP_PORT", "587"))
-        user = os.environ.get("SMTP_USER")
-        pwd  = os.environ.get("SMTP_PASS")
-        sender = os.environ.get("SMTP_SENDER") or current_app.config.get("MAIL_DEFAULT_SENDER") or "no-reply@achetece.com.br"
-        use_tls = os.environ.get("SMTP_TLS", "1") not in ("0","false","False")
-
-        if host and sender and os.environ.get("ALLOW_SMTP", "0").lower() in ("1","true","yes"):
-            msg = MIMEMultipart("alternative")
-            msg["Subject"] = subject
-            msg["From"] = sender
-            msg["To"] = to_email
-            msg["Content-Language"] = "pt-BR"
-            msg.attach(MIMEText(text or "", "plain", "utf-8"))
-            if html:
-                msg.attach(MIMEText(html, "html", "utf-8"))
-
-            with smtplib.SMTP(host, port, timeout=20) as s:
-                if use_tls: s.starttls(context=ssl.create_default_context())
-                if user:    s.login(user, pwd or "")
-                s.sendmail(sender, [to_email], msg.as_string())
-            current_app.logger.info("[MAIL_PATH] smtp-html")
-            return True
-    except Exception:
-        current_app.logger.exception("[MAIL] SMTP falhou")
+# Proxies confiáveis na frente do gunicorn (Render = 1). Cada proxy ACRESCENTA
+# ao X-Forwarded-For; só os últimos PROXY_HOPS itens são nossos, o resto o
+# cliente escreve como quiser. O ProxyFix pega o item certo para remote_addr.
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-    # 3) Helpers do projeto (agora checando retorno!)
-    try:
-        for fname in ("send_email", "enviar_email", "mail_send", "send_mail"):
-            if fname in globals():
-                f = globals()[fname]
-                # use kwargs corretos:
-                res = f(to=to_email, subject=subject, html=html, text=text)
-    
-                ok = True
-                if isinstance(res, bool):
-                    ok = res
-                elif res is None:
-                    ok = True  # muitos helpers não retornam nada; consideramos OK
-                else:
-                    # se retornar tupla (ok, msg) etc.
-                    try:
-                        ok = bool(res[0])
-                    except Exception:
-                        ok = True
-    
-                if ok:
-                    current_app.logger.info(f"[MAIL_PATH] helper:{fname} (html enviado)")
-                    return True
-                else:
-                    current_app.logger.warning(f"[MAIL_PATH] helper:{fname} retornou False")
-    
-    except Exception:
-        current_app.logger.exception("[MAIL] helper falhou")
-
-def _otp_email_html(dest_email: str, code: str, minutes: int = 30) -> str:
-    brand = "AcheTece • Portal de Malharias"
-    primary = "#4B2AC7"
-    chip_bg = "#F5F0FF"
-    chip_bd = "#D9CCFF"
-    text = (
-        f"Seu código para acessar a sua conta\n\n"
-        f"Recebemos uma solicitação de acesso ao AcheTece para: {dest_email}\n\n"
-        f"{code}\n\n"
-        f"Código válido por {minutes} minutos e de uso único.\n"
-        f"Se você não fez esta solicitação, ignore este e-mail.\n\n{brand}"
-    )
-    return f"""<!doctype html>
-<html lang="pt-br">
-<head>
-  <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
-  <meta name="color-scheme" content="light only">
-  <meta name="supported-color-schemes" content="light">
-  <title>Código de acesso</title>
-  <style>@media screen {{ .code-chip {{ letter-spacing: 6px; }} }}</style>
-</head>
-<body style="margin:0;padding:0;background:#F7F7FA;">
-  <table role="presentation" cellpadding="0" cellspacing="0" width="100%" style="background:#F7F7FA;">
-    <tr>
-      <td align="center" style="padding:24px 12px;">
-        <table role="presentation" cellpadding="0" cellspacing="0" width="100%" style="max-width:640px;background:#FFFFFF;border:1px solid #EEE;border-radius:12px;">
-          <tr>
-            <td style="padding:24px 24px 8px 24px;font-family:Inter,Segoe UI,Arial,Helvetica,sans-serif;">
-              <h1 style="margin:0 0 6px 0;font-size:22px;line-height:1.3;color:#1E1B2B;">Seu código para acessar a sua conta</h1>
-              <p style="margin:0 0 14px 0;color:#444;font-size:14px;">
-                Recebemos uma solicitação de acesso ao AcheTece para:<br>
-                <a href="mailto:{dest_email}" style="color:#1E3A8A;text-decoration:underline;">{dest_email}</a>
-              </p>
-            </td>
-          </tr>
-          <tr>
-            <td align="center" style="padding:6px 24px 2px 24px;">
-              <div style="display:inline-block;padding:16px 28px;border-radius:14px;background:{chip_bg};border:2px dotted {chip_bd};">
-                <div class="code-chip" style="font-family:Inter,Segoe UI,Arial,Helvetica,sans-serif;font-size:36px;font-weight:800;color:{primary};letter-spacing:6px;">{code}</div>
-              </div>
-            </td>
-          </tr>
-          <tr>
-            <td style="padding:14px 24px 20px 24px;font-family:Inter,Segoe UI,Arial,Helvetica,sans-serif;color:#555;">
-              <p style="margin:0 0 8px 0;font-size:14px;">Código válido por <strong>{minutes} minutos</strong> e de uso único.</p>
-              <p style="margin:0 0 2px 0;font-size:13px;color:#666;">Se você não fez esta solicitação, ignore este e-mail.</p>
-            </td>
-          </tr>
-          <tr>
-            <td style="padding:10px 24px 22px 24px;">
-              <hr style="border:none;border-top:1px solid #EEE;margin:4px 0 12px 0;">
-              <p style="margin:0;color:#777;font-family:Inter,Segoe UI,Arial,Helvetica,sans-serif;font-size:12px;">{brand}</p>
-            </td>
-          </tr>
-        </table>
-        <div style="display:none;max-height:0;overflow:hidden;color:transparent;">{text}</div>
-      </td>
-    </tr>
-  </table>
-</body>
-</html>"""
+PROXY_HOPS = int(os.getenv("PROXY_HOPS", "1"))
+if PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_HOPS)
+
+def _ip_cliente() -> str:
+    return (request.remote_addr or "")[:64]
 
 def _otp_send(to_email: str, ip: str = "", ua: str = ""):
-    """Gera OTP, salva expiração e envia e-mail HTML (30 min)."""
+    """Gera OTP, grava o hash em otp_token e enfileira o e-mail HTML (OTP_TTL_MIN)."""
+    to_email = (to_email or "").strip().lower()
+    espera = max(_otp_balde(("email", to_email), OTP_RL_EMAIL), _otp_balde(("ip", ip), OTP_RL_IP) if ip else 0.0)
+    if espera:
+        current_app.logger.warning({"rota": "otp", "limitado": True, "ip": ip, "espera_seg": round(espera)})
+        return False, f"Muitas solicitações. Aguarde {max(1, round(espera))} segundos para pedir um novo código."
     try:
-        code = f"{random.randint(0, 999999):06d}"
-        minutes = 30
-
-        data = session.get("otp_login", {})
-        data[to_email] = {
-            "code": code,
-            "exp": (datetime.utcnow() + timedelta(minutes=minutes)).timestamp(),
-            "ip": ip[:64],
-            "ua": ua[:255],
-            "attempts": 0,
-        }
-        session["otp_login"] = data
+        agora = datetime.utcnow()
+        ultimo = db.session.query(OtpToken.created_at).filter(OtpToken.email == to_email) \
+            .order_by(OtpToken.created_at.desc()).limit(1).scalar()
+        if ultimo and (agora - ultimo).total_seconds() < OTP_REENVIO_MIN_SEG:
+            falta = OTP_REENVIO_MIN_SEG - int((agora - ultimo).total_seconds())
+            return False, f"Aguarde {falta} segundos para pedir um novo código."
+
+        code = f"{secrets.randbelow(1_000_000):06d}"
+        OtpToken.query.filter(OtpToken.email == to_email, OtpToken.used_at.is_(None)) \
+            .update({"used_at": agora}, synchronize_session=False)  # um código ativo por e-mail
+        db.session.add(OtpToken(
+            email=to_email, code_hash=_otp_hash(to_email, code), created_at=agora,
+            expires_at=agora + timedelta(minutes=OTP_TTL_MIN), last_sent_at=agora,
+            attempts=0, ip=(ip or "")[:64], user_agent=(ua or "")[:255],
+        ))
+        db.session.commit()
 
-        subject = "Seu código de acesso – AcheTece"
-        text    = f"Seu código é {code}. Ele expira em {minutes} minutos."
-        html    = _otp_email_html(to_email, code, minutes)
+        msg = email_render("otp", dest_email=to_email, code=code, minutes=OTP_TTL_MIN)
 
-        if _email_send_html_first(to_email, subject, text, html):
+        if _email_send_html_first(to_email, msg.subject, msg.text, msg.html):
             current_app.logger.info("[OTP] HTML enviado com sucesso")
             return True, "Enviamos um código para o seu e-mail."
         else:
             current_app.logger.error("[OTP] Falha ao enviar HTML (nenhum backend aceitou)")
             return False, "Não foi possível enviar o código agora. Tente novamente."
     except Exception:
+        db.session.rollback()
         current_app.logger.exception("Falha ao enviar OTP de login")
         return False, "Não foi possível enviar o código agora. Tente novamente."
 
-# Mantém seu _otp_validate como estava (com guard ou não, tanto faz)
-# ----------------------------------------------------------------------
+def _otp_validate(email: str, codigo: str):
+    """Valida o OTP ativo do e-mail em otp_token. Retorna (ok: bool, msg: str)."""
+    email = (email or "").strip().lower()
+    codigo = (codigo or "").strip()
+    session.pop("otp_login", None)  # formatos antigos (cookie) não são mais aceitos
+    session.pop("otp", None)
+
+    agora = datetime.utcnow()
+    tok = db.session.query(OtpToken.id, OtpToken.code_hash, OtpToken.expires_at, OtpToken.attempts) \
+        .filter(OtpToken.email == email, OtpToken.used_at.is_(None)) \
+        .order_by(OtpToken.created_at.desc()).first()
+    if tok is None:
+        return False, "Código não encontrado para este e-mail. Reenvie o código."
+    if tok.expires_at and agora > tok.expires_at:
+        return False, "Código expirado. Solicite um novo."
+
+    # incremento atômico: vários workers não somam tentativas além do limite
+    upd = db.session.execute(
+        text("UPDATE otp_token SET attempts = attempts + 1 WHERE id = :id AND attempts < :max AND used_at IS NULL"),
+        {"id": tok.id, "max": OTP_MAX_TENTATIVAS},
+    )
+    if not upd.rowcount:
+        db.session.commit()
+        return False, "Muitas tentativas. Solicite um novo código."
+
+    if not hmac.compare_digest(tok.code_hash, _otp_hash(email, codigo)):
+        db.session.commit()
+        if int(tok.attempts or 0) + 1 >= OTP_MAX_TENTATIVAS:
+            return False, "Muitas tentativas. Solicite um novo código."
+        return False, "Código incorreto. Tente novamente."
+
+    usado = db.session.execute(
+        text("UPDATE otp_token SET used_at = :agora WHERE id = :id AND used_at IS NULL"),
+        {"id": tok.id, "agora": agora},
+    )
+    db.session.commit()
+    if not usado.rowcount:
+        return False, "Código já utilizado. Solicite um novo."
+    return True, "OK"
+
+@tarefa_periodica("otp_limpeza", OTP_LIMPEZA_SEG)
+def otp_limpeza() -> dict:
+    """Apaga códigos expirados ou já usados (mantém 1 dia p/ auditoria)."""
+    corte = datetime.utcnow() - timedelta(days=1)
+    with db.engine.begin() as conn:
+        n = conn.execute(
+            text("DELETE FROM otp_token WHERE expires_at < :corte OR used_at < :corte"),
+            {"corte": corte},
+        ).rowcount
+    app.logger.info({"rota": "otp_limpeza", "apagados": n})
+    return {"ok": True, "apagados": n}
+
 
 # /login
 @app.route("/login", methods=["GET", "POST"], endpoint="login")
@@ -2146,7 +4970,7 @@ def post_login_code():
 
     ok, msg = _otp_send(
         email,
-        ip=(request.headers.get("X-Forwarded-For") or request.remote_addr or "")[:64],
+        ip=_ip_cliente(),
         ua=(request.headers.get("User-Agent") or "")[:255],
     )
     flash(msg, "success" if ok else "error")
@@ -2176,7 +5000,7 @@ def resend_login_code():
         return redirect(url_for("login"))
     ok, msg = _otp_send(
         email,
-        ip=(request.headers.get("X-Forwarded-For") or request.remote_addr or "")[:64],
+        ip=_ip_cliente(),
         ua=(request.headers.get("User-Agent") or "")[:255],
     )
     flash(msg, "success" if ok else "error")
@@ -2352,25 +5176,12 @@ from flask import make_response
 # --- Rota do Painel (vencimento por plano + ajuste p/ próximo dia útil BR) ---
 @app.route('/painel_malharia', endpoint="painel_malharia")
 def painel_malharia():
+    # A empresa vem da memo do request (carregada nesta mesma sessão do ORM,
+    # então já está "fresca"); os context processors reusam o mesmo objeto.
     emp, u = _get_empresa_usuario_da_sessao()
     if not emp or not u:
         return redirect(url_for('login'))
 
-    # Evita objetos “velhos” ficarem presos na identity map
-    try:
-        db.session.expire_all()
-    except Exception:
-        pass
-
-    # ✅ Recarrega "fresco" após expire_all (garante status/plan/data atualizados)
-    try:
-        emp_id = emp.id
-        emp = Empresa.query.get(emp_id)
-        if not emp:
-            return redirect(url_for("login"))
-    except Exception:
-        pass
-
     step = request.args.get("step") or _proximo_step(emp)
 
     # Reconsulta FRESCA os teares e ordena (mais recente primeiro)
@@ -2423,17 +5234,8 @@ def painel_malharia():
         # ordem de prioridade: último pagamento > data_pagamento > início > criação > hoje
         base_dt = ult_pgto or data_pag or inicio or created or hoje
 
-        # dias do ciclo conforme o plano
-        plano = (getattr(emp, "plano", None) or "mensal").strip().lower()
-        if "anual" in plano:
-            dias_plano = 365
-        else:
-            # ✅ mensal com folga (se você quer 35 como já vinha usando)
-            dias_plano = 35
-
-        # vencimento nominal e ajuste para próximo dia útil BR
-        nominal = base_dt + timedelta(days=dias_plano)
-        venc = _proximo_dia_util_br(nominal)
+        # vencimento nominal (dias do plano) e ajuste para próximo dia útil BR
+        venc = _vencimento_assinatura(base_dt, getattr(emp, "plano", None))
 
         vencimento_proximo = venc
 
@@ -2450,6 +5252,7 @@ def painel_malharia():
             try:
                 emp.status_pagamento = "pendente"
                 db.session.commit()
+                catalogo_alterado(reconstruir=True)
                 status_ok = False
             except Exception:
                 db.session.rollback()
@@ -2468,7 +5271,7 @@ def painel_malharia():
 
     checklist = {
         "perfil_ok": all(_empresa_basica_completa(emp)),
-        "teares_ok": _conta_teares(emp.id) > 0,
+        "teares_ok": len(teares) > 0,  # lista já carregada acima
         "plano_ok": is_ativa or DEMO_MODE,  # <--- aqui é "or"
         "step": step,
     }
@@ -2510,6 +5313,9 @@ def painel_malharia():
 
         # ✅ opcional (para banner/botões de pagar/renovar)
         mostrar_pagamento=mostrar_pagamento,
+
+        # foto enviada que não pôde ser processada (timeout, pool, imagem)
+        avatar_falha=None if _avatar_pendente(emp.id) else avatar_falha(emp.id),
     ))
     resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
     resp.headers["Pragma"] = "no-cache"
@@ -2548,7 +5354,7 @@ def _empresa_avatar_url(emp) -> str | None:
 
     Ordem:
     1) Se emp.foto_url estiver preenchido, usa.
-    2) Procura arquivo físico nas pastas usuais:
+    2) Procura arquivo físico nas pastas usuais (via _AVATARES, sem tocar no disco):
        - static/uploads/avatars/empresa_<id>.(jpg|jpeg|png|webp)
        - static/uploads/perfil/emp_<id>.(jpg|jpeg|png|webp)
     3) Se achar, monta a URL, grava em emp.foto_url e commit.
@@ -2562,31 +5368,19 @@ def _empresa_avatar_url(emp) -> str | None:
     if url:
         return url
 
-    # 2) Procura arquivos físicos (compat com seus diretórios)
-    try:
-        candidates = [
-            (f"uploads/avatars/empresa_{emp.id}", (".webp", ".jpg", ".jpeg", ".png")),
-            (f"uploads/perfil/emp_{emp.id}",      (".webp", ".jpg", ".jpeg", ".png")),
-        ]
-
-        for base_rel, exts in candidates:
-            for ext in exts:
-                rel_path = f"{base_rel}{ext}"
-                abs_path = os.path.join(app.static_folder, rel_path)
-                if os.path.exists(abs_path):
-                    url = url_for("static", filename=rel_path)
-
-                    # grava no banco para próximas vezes
-                    try:
-                        emp.foto_url = url
-                        db.session.commit()
-                    except Exception:
-                        db.session.rollback()
+    # 2) Procura arquivos físicos (compat com seus diretórios) no índice em memória
+    rel_path = _AVATARES.procurar([f"uploads/avatars/empresa_{emp.id}", f"uploads/perfil/emp_{emp.id}"])
+    if rel_path:
+        url = url_for("static", filename=rel_path)
 
-                    return url
+        # grava no banco para próximas vezes
+        try:
+            emp.foto_url = url
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
 
-    except Exception as e:
-        app.logger.warning(f"[avatar] _empresa_avatar_url erro: {e}")
+        return url
 
     return None
 
@@ -2996,66 +5790,35 @@ def perfil_foto_upload():
         })
         return _back_to_panel(int(datetime.utcnow().timestamp()))
 
-    # extensão do arquivo original
-    filename_orig = secure_filename(file.filename)
-    _, ext = os.path.splitext(filename_orig)
-    ext = (ext or "").lower()
-
-    # se quiser ser bem permissivo, aceita tudo como .jpg
-    if ext not in (".jpg", ".jpeg", ".png", ".webp"):
-        # fallback: trata como .jpg mesmo assim
-        ext = ".jpg"
-
-    # Pasta alvo: static/avatars
-    avatars_dir = os.path.join(app.static_folder, "avatars")
+    # Aqui só o cabeçalho é lido; decodificar/redimensionar fica com o pool de imagens
+    dados = file.read()
     try:
-        os.makedirs(avatars_dir, exist_ok=True)
-    except Exception as e:
-        app.logger.error(f"[avatar] erro ao criar pasta avatars: {e}")
-        flash("Erro ao preparar pasta de imagens.", "erro")
+        avatar_imagem.validar(dados)
+    except AVATAR_ERROS_IMAGEM as e:
+        app.logger.info({"rota": "perfil_foto_upload", "empresa_id": emp.id, "motivo": "imagem_invalida", "erro": str(e)})
+        flash("Arquivo de imagem inválido. Envie JPG, PNG ou WebP.", "erro")
         return _back_to_panel(int(datetime.utcnow().timestamp()))
 
-    # Nome fixo por empresa (sobrescreve qualquer anterior)
-    base_name = f"empresa_{emp.id}"
-    filename = base_name + ext
-    filepath = os.path.join(avatars_dir, filename)
-
-    # Remove versões antigas com outras extensões
-    for old_ext in (".jpg", ".jpeg", ".png", ".webp"):
-        old_path = os.path.join(avatars_dir, base_name + old_ext)
-        if old_path != filepath and os.path.exists(old_path):
-            try:
-                os.remove(old_path)
-            except OSError:
-                pass
-
     try:
-        file.save(filepath)
+        agendado = avatar_processar(emp.id, dados)
     except Exception as e:
-        app.logger.error(f"[avatar] erro ao salvar arquivo: {e}")
+        app.logger.error(f"[avatar] erro ao salvar original: {e}")
         flash("Erro ao salvar a imagem enviada.", "erro")
         return _back_to_panel(int(datetime.utcnow().timestamp()))
 
-    # Monta URL pública
-    rel_path = f"avatars/{filename}"
-    novo_url = url_for("static", filename=rel_path)
-
-    # Atualiza empresa + sessão
-    emp.foto_url = novo_url
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        app.logger.error(f"[avatar] erro ao gravar foto_url no banco: {e}")
-        flash("Erro ao salvar a imagem no cadastro.", "erro")
+    if not agendado:
+        app.logger.info({"rota": "perfil_foto_upload", "empresa_id": emp.id, "motivo": "fila_cheia"})
+        flash("Muitas imagens em processamento agora. Tente de novo em alguns segundos.", "erro")
         return _back_to_panel(int(datetime.utcnow().timestamp()))
 
-    session["avatar_url"] = novo_url
+    # foto_url é atualizada pelo job; até lá o painel mostra o placeholder
+    session.pop("avatar_url", None)
 
     app.logger.info({
         "rota": "perfil_foto_upload",
         "empresa_id": emp.id,
-        "foto_url_salva": novo_url,
+        "bytes": len(dados),
+        "status": "agendado",
     })
 
     ts = int(datetime.utcnow().timestamp())
@@ -3066,15 +5829,11 @@ def inject_avatar_url():
     url = None
     try:
         uid, _ = _whoami()
-        # 1) Arquivo físico salvo como <uid>.webp
-        if uid:
-            filename  = f"{uid}.webp"
-            dest_path = os.path.join(AVATAR_DIR, filename)
-            if os.path.exists(dest_path):
-                v = int(os.path.getmtime(dest_path))
-                url = url_for('static', filename=f'uploads/avatars/{filename}') + f'?v={v}'
-
-        # 2) Fallback: caminho salvo no DB (sem ?v)
+        # 1) Arquivo físico salvo como <uid>.webp (índice em memória, com ?v)
+        if uid and _AVATARES.versao(f"uploads/avatars/{uid}.webp"):
+            url = _AVATARES.url(f"uploads/avatars/{uid}.webp")
+
+        # 2) Fallback: caminho salvo no DB (?v do índice quando é arquivo local)
         if not url:
             emp = _pegar_empresa_do_usuario(required=False)
             rel = None
@@ -3086,7 +5845,7 @@ def inject_avatar_url():
                 else:
                     # normaliza quando o DB guarda "/static/..."
                     rel_clean = rel.replace('/static/', '', 1) if rel.startswith('/static/') else rel.lstrip('/')
-                    url = url_for('static', filename=rel_clean)
+                    url = _AVATARES.url(rel_clean)
     except Exception:
         pass
 
@@ -3149,6 +5908,7 @@ def cadastrar_teares():
             pass
 
         db.session.commit()
+        catalogo_alterado(tear_ids=[t.id])
         flash("Tear cadastrado com sucesso!")
         # volta para o próprio formulário para permitir múltiplos cadastros em sequência
         return redirect(url_for("teares_form"))
@@ -3312,6 +6072,7 @@ def editar_tear(id):
 
         db.session.add(tear)
         db.session.commit()
+        catalogo_alterado(tear_ids=[tear.id])
         flash("Tear atualizado com sucesso!", "success")
         return redirect(url_for("painel_malharia"))
 
@@ -3329,6 +6090,7 @@ def excluir_tear(id):
 
     db.session.delete(tear)
     db.session.commit()
+    catalogo_alterado(removidos=[id])
     flash("Tear excluído com sucesso!", "success")
 
     next_url = request.args.get("next") or request.form.get("next")
@@ -3344,15 +6106,11 @@ def excluir_tear(id):
 # --------------------------------------------------------------------
 # Exportação CSV (usa filtros da home)
 # --------------------------------------------------------------------
-@app.route('/exportar')
-def exportar():
-    filtros_raw = {
-        'tipo'    : (request.args.get('tipo', '') or '').strip(),
-        'diâmetro': (request.args.get('diâmetro', '') or request.args.get('diametro', '') or '').strip(),
-        'galga'   : (request.args.get('galga', '') or '').strip(),
-        'estado'  : (request.args.get('estado', '') or '').strip(),
-        'cidade'  : (request.args.get('cidade', '') or '').strip(),
-    }
+EXPORT_CABECALHO = ['Empresa', 'Marca', 'Modelo', 'Tipo', 'Diâmetro', 'Galga', 'Alimentadores', 'Elastano', 'Estado', 'Cidade']
+EXPORT_YIELD_PER = int(os.getenv("EXPORT_YIELD_PER", "1000"))
+
+def _exportar_query(filtros_raw: dict):
+    """Tear ⨝ Empresa já projetado nas colunas do CSV (sem lazy-load por linha)."""
     def to_int(s):
         s = re.sub(r'\D', '', (s or ''))
         return int(s) if s else None
@@ -3374,26 +6132,322 @@ def exportar():
         query = query.filter(Empresa.estado == filtros_raw['estado'])
     if filtros_raw['cidade']:
         query = query.filter(Empresa.cidade == filtros_raw['cidade'])
-    teares = query.all()
-
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Empresa', 'Marca', 'Modelo', 'Tipo', 'Diâmetro', 'Galga', 'Alimentadores', 'Elastano', 'Estado', 'Cidade'])
-    for tear in teares:
-        writer.writerow([
-            tear.empresa.apelido or tear.empresa.nome or tear.empresa.email.split('@')[0],
-            tear.marca, tear.modelo, tear.tipo, tear.diametro, tear.finura,
-            tear.alimentadores, tear.elastano,
-            tear.empresa.estado, tear.empresa.cidade
-        ])
-    output.seek(0)
-    return send_file(
-        io.BytesIO(output.read().encode('utf-8')),
+    return query.with_entities(
+        Empresa.apelido, Empresa.nome, Empresa.email,
+        Tear.marca, Tear.modelo, Tear.tipo, Tear.diametro, Tear.finura,
+        Tear.alimentadores, Tear.elastano,
+        Empresa.estado, Empresa.cidade,
+    ).order_by(Tear.id)
+
+def _exportar_linhas(query):
+    """Linhas do CSV, lidas do banco em lotes (cursor do lado do servidor no Postgres)."""
+    for r in query.yield_per(EXPORT_YIELD_PER):
+        apelido, nome, email = r[0], r[1], r[2]
+        yield [apelido or nome or (email or '').split('@')[0], *r[3:]]
+
+def _csv_em_blocos(linhas, linhas_por_bloco: int = 500):
+    """Serializa em blocos de texto: memória constante, primeiro byte imediato."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(EXPORT_CABECALHO)
+    n = 0
+    for linha in linhas:
+        writer.writerow(linha)
+        n += 1
+        if n % linhas_por_bloco == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate(0)
+    yield buf.getvalue()
+
+@app.route('/exportar')
+def exportar():
+    filtros_raw = _filtros_busca(request.args)
+    query = _exportar_query(filtros_raw)
+
+    def gerar():
+        for bloco in _csv_em_blocos(_exportar_linhas(query)):
+            yield bloco.encode('utf-8')
+
+    return app.response_class(
+        stream_with_context(gerar()),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name='teares_filtrados.csv'
+        headers={
+            'Content-Disposition': 'attachment; filename=teares_filtrados.csv',
+            'X-Accel-Buffering': 'no',  # não segura o stream em proxy (nginx)
+        },
     )
 
+# =====================[ EXPORTAÇÃO EM SEGUNDO PLANO (JOBS) ]=====================
+# Exportações grandes não prendem o worker do gunicorn: POST cria um job que
+# roda numa thread, grava CSV.gz ou XLSX em EXPORT_DIR e o download é servido
+# com suporte a Range. O estado do job fica num .json ao lado do arquivo, então
+# qualquer worker responde status/download. Job id = hash(filtros + formato +
+# versão do catálogo): o mesmo pedido reaproveita o artefato enquanto fresco.
+import gzip
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape as _xml_escape
+
+EXPORT_DIR = os.getenv("EXPORT_DIR") or os.path.join(BASE_DIR, "export_artifacts")
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+EXPORT_TTL_SEG = int(os.getenv("EXPORT_TTL_SEG", "3600"))          # validade do artefato
+EXPORT_JOB_TIMEOUT_SEG = int(os.getenv("EXPORT_JOB_TIMEOUT_SEG", "900"))
+EXPORT_FILA_MAX = int(os.getenv("EXPORT_FILA_MAX", "8"))             # jobs na fila/rodando por processo
+EXPORT_RL_IP = (int(os.getenv("EXPORT_RL_IP_MAX", "10")), float(os.getenv("EXPORT_RL_IP_JANELA_SEG", "600")))
+EXPORT_FORMATOS = {
+    "csv.gz": ("application/gzip", "teares_filtrados.csv.gz"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "teares_filtrados.xlsx"),
+}
+os.makedirs(EXPORT_DIR, exist_ok=True)
+
+_EXPORT_POOL: ThreadPoolExecutor | None = None
+_EXPORT_POOL_LOCK = threading.Lock()
+_EXPORT_PENDENTES = 0  # fila + executando neste processo (protegido por _EXPORT_POOL_LOCK)
+
+def _export_pool() -> ThreadPoolExecutor:
+    global _EXPORT_POOL
+    with _EXPORT_POOL_LOCK:
+        if _EXPORT_POOL is None:
+            _EXPORT_POOL = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="export")
+        return _EXPORT_POOL
+
+def _export_paths(job_id: str, formato: str) -> tuple[str, str]:
+    return (os.path.join(EXPORT_DIR, f"{job_id}.json"),
+            os.path.join(EXPORT_DIR, f"{job_id}.{formato}"))
+
+def _gravar_atomico(caminho: str, escrever) -> None:
+    """Escreve num temporário e troca com os.replace (leitor nunca vê arquivo pela metade)."""
+    tmp = f"{caminho}.{uuid.uuid4().hex[:8]}.tmp"
+    try:
+        escrever(tmp)
+        os.replace(tmp, caminho)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def _export_status_salvar(job: dict) -> None:
+    job["atualizado_em"] = time.time()
+    meta_path, _ = _export_paths(job["id"], job["formato"])
+    def escrever(tmp):
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+    _gravar_atomico(meta_path, escrever)
+
+def _export_status(job_id: str) -> dict | None:
+    if not re.fullmatch(r"[0-9a-f]{24}", job_id or ""):
+        return None
+    try:
+        with open(os.path.join(EXPORT_DIR, f"{job_id}.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _export_fresco(job: dict | None) -> bool:
+    if not job:
+        return False
+    idade = time.time() - float(job.get("atualizado_em") or 0)
+    if job.get("status") == "pronto":
+        _, arq = _export_paths(job["id"], job["formato"])
+        return idade < EXPORT_TTL_SEG and os.path.exists(arq)
+    if job.get("status") in ("fila", "executando"):
+        return idade < EXPORT_JOB_TIMEOUT_SEG
+    return False
+
+def _escrever_csv_gz(caminho: str, linhas) -> int:
+    n = 0
+    with gzip.open(caminho, "wt", encoding="utf-8", newline="", compresslevel=6) as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_CABECALHO)
+        for linha in linhas:
+            writer.writerow(linha)
+            n += 1
+    return n
+
+def _xlsx_coluna(i: int) -> str:
+    letras = ""
+    i += 1
+    while i:
+        i, r = divmod(i - 1, 26)
+        letras = chr(65 + r) + letras
+    return letras
+
+def _xlsx_linha(num: int, valores) -> str:
+    cels = []
+    for i, v in enumerate(valores):
+        ref = f"{_xlsx_coluna(i)}{num}"
+        if v is None or v == "":
+            continue
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            cels.append(f'<c r="{ref}"><v>{v}</v></c>')
+        else:
+            cels.append(f'<c r="{ref}" t="inlineStr"><is><t>{_xml_escape(str(v))}</t></is></c>')
+    return f'<row r="{num}">{"".join(cels)}</row>'
+
+def _escrever_xlsx(caminho: str, linhas) -> int:
+    """XLSX mínimo (uma planilha, inlineStr) gerado em streaming só com a stdlib."""
+    n = 0
+    with zipfile.ZipFile(caminho, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr("[Content_Types].xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>')
+        z.writestr("_rels/.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>')
+        z.writestr("xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Teares" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        z.writestr("xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>')
+        with z.open("xl/worksheets/sheet1.xml", "w") as raw:
+            f = io.TextIOWrapper(raw, encoding="utf-8")
+            f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            f.write(_xlsx_linha(1, EXPORT_CABECALHO))
+            for linha in linhas:
+                n += 1
+                f.write(_xlsx_linha(n + 1, linha))
+            f.write("</sheetData></worksheet>")
+            f.flush()
+            f.detach()
+    return n
+
+def _export_executar(job: dict) -> None:
+    t0 = time.perf_counter()
+    with app.app_context():
+        try:
+            job["status"] = "executando"
+            _export_status_salvar(job)
+
+            _, arq = _export_paths(job["id"], job["formato"])
+            linhas = _exportar_linhas(_exportar_query(job["filtros"]))
+            escritor = _escrever_xlsx if job["formato"] == "xlsx" else _escrever_csv_gz
+            contagem = {"n": 0}
+            def escrever(tmp):
+                contagem["n"] = escritor(tmp, linhas)
+            _gravar_atomico(arq, escrever)
+
+            job.update(status="pronto", linhas=contagem["n"], bytes=os.path.getsize(arq),
+                       ms=round((time.perf_counter() - t0) * 1000, 1))
+            _export_status_salvar(job)
+            app.logger.info({"rota": "export_job", "id": job["id"], "formato": job["formato"],
+                             "linhas": job["linhas"], "ms": job["ms"]})
+        except Exception as e:
+            app.logger.exception("[EXPORT] job %s falhou", job.get("id"))
+            job.update(status="erro", erro=str(e)[:300])
+            _export_status_salvar(job)
+        finally:
+            db.session.remove()
+            _export_liberar_vaga()
+
+def _export_reservar_vaga() -> bool:
+    global _EXPORT_PENDENTES
+    with _EXPORT_POOL_LOCK:
+        if _EXPORT_PENDENTES >= EXPORT_FILA_MAX:
+            return False
+        _EXPORT_PENDENTES += 1
+        return True
+
+def _export_liberar_vaga() -> None:
+    global _EXPORT_PENDENTES
+    with _EXPORT_POOL_LOCK:
+        _EXPORT_PENDENTES = max(0, _EXPORT_PENDENTES - 1)
+
+def _export_limpar_expirados() -> None:
+    agora = time.time()
+    try:
+        for nome in os.listdir(EXPORT_DIR):
+            caminho = os.path.join(EXPORT_DIR, nome)
+            if agora - os.path.getmtime(caminho) > max(EXPORT_TTL_SEG, EXPORT_JOB_TIMEOUT_SEG) * 2:
+                os.remove(caminho)
+    except OSError:
+        pass
+
+def _export_job_json(job: dict) -> dict:
+    return {
+        "ok": job.get("status") != "erro",
+        "id": job["id"],
+        "status": job.get("status"),
+        "formato": job.get("formato"),
+        "linhas": job.get("linhas"),
+        "bytes": job.get("bytes"),
+        "erro": job.get("erro"),
+        "status_url": url_for("exportar_job_status", job_id=job["id"]),
+        "download_url": url_for("exportar_job_download", job_id=job["id"]) if job.get("status") == "pronto" else None,
+    }
+
+@app.post("/exportar/jobs")
+def exportar_job_criar():
+    espera = _otp_balde(("export", _ip_cliente()), EXPORT_RL_IP)
+    if espera:
+        resp = jsonify({"ok": False, "error": "muitas exportações; tente mais tarde"})
+        resp.headers["Retry-After"] = str(max(1, round(espera)))
+        return resp, 429
+
+    dados = request.get_json(silent=True)
+    if not isinstance(dados, dict):
+        dados = request.values
+    formato = (_filtro_txt(dados.get("formato")) or "csv.gz").lower()
+    if formato not in EXPORT_FORMATOS:
+        return jsonify({"ok": False, "error": "formato inválido (csv.gz|xlsx)"}), 400
+
+    filtros = _filtros_busca(dados)
+    versao = _catalogo_versao_atual()
+    assinatura = json.dumps([versao, formato, filtros], sort_keys=True, ensure_ascii=False)
+    job_id = hashlib.sha1(assinatura.encode("utf-8")).hexdigest()[:24]
+
+    job = _export_status(job_id)
+    if _export_fresco(job):
+        return jsonify(_export_job_json(job)), (200 if job["status"] == "pronto" else 202)
+
+    if not _export_reservar_vaga():
+        resp = jsonify({"ok": False, "error": "fila de exportação cheia; tente em instantes"})
+        resp.headers["Retry-After"] = "30"
+        return resp, 503
+
+    _export_limpar_expirados()
+    job = {"id": job_id, "status": "fila", "formato": formato, "filtros": filtros,
+           "versao": versao, "criado_em": time.time()}
+    _export_status_salvar(job)
+    try:
+        _export_pool().submit(_export_executar, dict(job))
+    except Exception:
+        _export_liberar_vaga()
+        raise
+    return jsonify(_export_job_json(job)), 202
+
+@app.get("/exportar/jobs/<job_id>")
+def exportar_job_status(job_id):
+    job = _export_status(job_id)
+    if not job:
+        return jsonify({"ok": False, "error": "job não encontrado"}), 404
+    return jsonify(_export_job_json(job))
+
+@app.get("/exportar/jobs/<job_id>/download")
+def exportar_job_download(job_id):
+    job = _export_status(job_id)
+    if not job or job.get("status") != "pronto":
+        return jsonify({"ok": False, "error": "arquivo não disponível"}), 404
+    _, arq = _export_paths(job["id"], job["formato"])
+    if not os.path.exists(arq):
+        return jsonify({"ok": False, "error": "arquivo expirado"}), 410
+    mimetype, nome = EXPORT_FORMATOS[job["formato"]]
+    # conditional=True -> ETag/Last-Modified + Range (206) pelo Werkzeug
+    return send_file(arq, mimetype=mimetype, as_attachment=True,
+                     download_name=nome, conditional=True, max_age=EXPORT_TTL_SEG)
+
 # --------------------------------------------------------------------
 # Cadastro/edição de empresa (essencial)
 # --------------------------------------------------------------------
@@ -3607,6 +6661,7 @@ def editar_empresa():
         empresa.senha = generate_password_hash(senha)
 
     db.session.commit()
+    catalogo_alterado(reconstruir=True)
     session['empresa_apelido'] = empresa.apelido or empresa.nome or empresa.email.split('@')[0]
     return redirect(url_for('editar_empresa', ok=1))
 
@@ -3617,15 +6672,37 @@ def performance_acesso():
     if not emp or not u:
         return redirect(url_for('login'))
 
-    # Usa o agregador de analytics (A.1) já adicionado acima
-    total_visitas, total_contatos, series = get_performance(emp.id)
+    # Período: ?de=AAAA-MM-DD&ate=AAAA-MM-DD ou ?periodo=7|30|90 (padrão 30 dias)
+    hoje = datetime.utcnow().date()
+    def _data(v):
+        try:
+            return datetime.strptime((v or "").strip(), "%Y-%m-%d").date()
+        except ValueError:
+            return None
+    fim = _data(request.args.get("ate")) or hoje
+    ini = _data(request.args.get("de"))
+    if ini is None:
+        dias = _to_int(request.args.get("periodo")) or 30
+        ini = fim - timedelta(days=max(1, min(dias, 366)) - 1)
+    if ini > fim:
+        ini, fim = fim, ini
+    ini = max(ini, fim - timedelta(days=730))
+    comparar = (request.args.get("comparar") or "1") != "0"
+
+    painel = performance_periodo(emp.id, ini, fim, comparar)
 
     return render_template(
         'performance_acesso.html',
         empresa=emp,
-        series=series,
-        total_visitas=total_visitas,
-        total_contatos=total_contatos
+        series=painel["series"],
+        total_visitas=painel["total_visitas"],
+        total_contatos=painel["total_contatos"],
+        visitantes_unicos=painel["visitantes_unicos"],
+        anterior=painel["anterior"],
+        funil=painel["funil"],
+        periodo_ini=ini,
+        periodo_fim=fim,
+        comparar=comparar,
     )
 
 # --------------------------------------------------------------------
@@ -3728,20 +6805,43 @@ def admin_empresas():
         )
     # 'todos' não filtra
 
-    total = query.count()
-    empresas = (query
-               .order_by(Empresa.nome)
-               .offset((pagina - 1) * por_pagina)
-               .limit(por_pagina)
-               .all())
+    # total: cache curto por combinação de filtros (não recalcula a cada página)
+    total = contagem_cacheada(("admin_empresas", status, data_inicio, data_fim, f_plano), query)
+
+    # Keyset em (nome, id): sem OFFSET; ?pagina= sem cursor ainda funciona
+    cursor = cursor_decode(request.args.get('cursor'), formato=(str, int)) or {}
+    if "a" in cursor:
+        nome_c, id_c = cursor["a"]
+        empresas = (query
+                   .filter(or_(Empresa.nome > nome_c, and_(Empresa.nome == nome_c, Empresa.id > id_c)))
+                   .order_by(Empresa.nome, Empresa.id)
+                   .limit(por_pagina)
+                   .all())
+    elif "b" in cursor:
+        nome_c, id_c = cursor["b"]
+        empresas = list(reversed(query
+                   .filter(or_(Empresa.nome < nome_c, and_(Empresa.nome == nome_c, Empresa.id < id_c)))
+                   .order_by(Empresa.nome.desc(), Empresa.id.desc())
+                   .limit(por_pagina)
+                   .all()))
+    else:
+        empresas = (query
+                   .order_by(Empresa.nome, Empresa.id)
+                   .offset((pagina - 1) * por_pagina)
+                   .limit(por_pagina)
+                   .all())
 
     total_paginas = (total + por_pagina - 1) // por_pagina
+    cursor_anterior = cursor_encode({"b": [empresas[0].nome, empresas[0].id]}) if empresas else None
+    cursor_proximo = cursor_encode({"a": [empresas[-1].nome, empresas[-1].id]}) if empresas else None
 
     return render_template(
         'admin_empresas.html',
         empresas=empresas,
         pagina=pagina,
         total_paginas=total_paginas,
+        cursor_anterior=cursor_anterior,
+        cursor_proximo=cursor_proximo,
         status=status,
         data_inicio=data_inicio,
         data_fim=data_fim,
@@ -3768,6 +6868,7 @@ def admin_editar_status(empresa_id):
     empresa.status_pagamento = novo_status
     empresa.data_pagamento = datetime.utcnow() if novo_status == 'ativo' else None
     db.session.commit()
+    catalogo_alterado(reconstruir=True)
 
     flash(f'Status de "{empresa.apelido or empresa.nome}" atualizado para {novo_status}.', 'success')
 
@@ -3785,6 +6886,8 @@ def empresa_excluir(empresa_id):
         return redirect(url_for('login'))
     empresa = Empresa.query.get_or_404(empresa_id)
     db.session.delete(empresa); db.session.commit()
+    empresa_sessao_invalidar()
+    catalogo_alterado(reconstruir=True)
     flash(f'Empresa "{empresa.nome}" excluída com sucesso!')
     return redirect(url_for('admin_empresas'))
 
@@ -3807,6 +6910,8 @@ def empresa_excluir_by_id(empresa_id):
 
     db.session.delete(empresa)
     db.session.commit()
+    empresa_sessao_invalidar()
+    catalogo_alterado(reconstruir=True)
 
     # limpar sessão básica
     for k in ("auth_user_id", "user_id", "login_email", "auth_email"):
@@ -3863,6 +6968,7 @@ def admin_seed_teares():
     if not empresa_id: return "Informe empresa_id", 400
     emp = Empresa.query.get_or_404(empresa_id)
     qtd = _cria_teares_fake(emp, n)
+    catalogo_alterado(reconstruir=True)
     return f"OK: +{qtd} teares em {emp.apelido or emp.nome or getattr(emp, 'nome_fantasia', emp.id)} (id={emp.id})."
 
 @app.route("/admin/seed_teares_all")
@@ -3897,6 +7003,7 @@ def admin_seed_teares_all():
         add = _topup(e, minimo) if minimo else _cria_teares_fake(e, n or 5)
         total_add += add
         rel.append(f"{e.id}:{add}")
+    catalogo_alterado(reconstruir=True)
     return f"OK: {total_add} teares adicionados em {total_empresas} empresas. Detalhe: {'; '.join(rel)}"
 
 @app.route("/utils/empresas_json")
@@ -3952,8 +7059,9 @@ def admin_test_email():
     if not to_addr:
         return "Informe ?to=destinatario@dominio", 400
     html = "<h3>Teste de e-mail AcheTece</h3><p>Se você recebeu isto, o envio está funcionando.</p>"
-    ok, msg = _smtp_send_direct(to_addr, "Teste AcheTece", html, "Teste AcheTece")
-    return (f"OK: {msg}", 200) if ok else (f"ERRO: {msg}", 500)
+    # síncrono de propósito: é um teste da cadeia de provedores
+    ok, via, msg = _entregar_email(to_addr, "Teste AcheTece", html, "Teste AcheTece")
+    return (f"OK: {via} {msg}", 200) if ok else (f"ERRO: {msg}", 500)
 
 # --------------------------------------------------------------------
 # Outras rotas utilitárias/compat
@@ -4022,75 +7130,12 @@ def _parse_empresa_id_from_external_reference(ext_ref: str):
             return None
     return None
 
-def _send_email(to_email: str, subject: str, text_body: str, html_body: str):
-    # Aceita tanto MAIL_* quanto SMTP_*
-    host = os.environ.get("MAIL_HOST") or os.environ.get("SMTP_HOST")
-    port = int(os.environ.get("MAIL_PORT") or os.environ.get("SMTP_PORT") or "587")
-    user = os.environ.get("MAIL_USER") or os.environ.get("SMTP_USER")
-    pwd  = os.environ.get("MAIL_PASS") or os.environ.get("SMTP_PASS")
-
-    mail_from = os.environ.get("MAIL_FROM") or user
-    from_name = os.environ.get("MAIL_FROM_NAME", "AcheTece")
-
-    reply_to = os.environ.get("MAIL_REPLY_TO") or "gestao.achetece@gmail.com"  # ajuste se quiser
-
-    if not (host and user and pwd and mail_from and to_email):
-        app.logger.warning("[EMAIL] Config incompleta (host/user/pass/from) ou destinatário vazio.")
-        return
-
-    # multipart: texto + html
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = subject
-    msg["From"] = f"{from_name} <{mail_from}>"
-    msg["To"] = to_email
-
-    # Headers de entregabilidade
-    msg["Reply-To"] = reply_to
-    msg["Message-ID"] = make_msgid(domain="achetece.com.br")  # pode manter mesmo usando gmail
-    msg["X-Entity-Ref-ID"] = str(uuid.uuid4())
-
-    # Partes
-    msg.attach(MIMEText(text_body or "", "plain", "utf-8"))
-    msg.attach(MIMEText(html_body or "", "html", "utf-8"))
-
-    try:
-        if port == 465:
-            with smtplib.SMTP_SSL(host, port) as smtp:
-                smtp.login(user, pwd)
-                smtp.sendmail(mail_from, [to_email], msg.as_string())
-        else:
-            with smtplib.SMTP(host, port) as smtp:
-                smtp.ehlo()
-                smtp.starttls()
-                smtp.ehlo()
-                smtp.login(user, pwd)
-                smtp.sendmail(mail_from, [to_email], msg.as_string())
-
-        app.logger.info(f"[EMAIL] Enviado para {to_email}")
-
-    except Exception as e:
-        app.logger.exception(f"[EMAIL] Falha ao enviar: {e}")
-
-def _email_ativacao_html(empresa, magic_link: str) -> str:
-    nome_malharia = (empresa.apelido or empresa.nome or "sua malharia").strip()
-
-    return f"""
-    <div style="font-family:Arial,sans-serif;max-width:640px;line-height:1.5">
-      <h2>Pagamento aprovado ✅</h2>
-      <p>Olá, <strong>{nome_malharia}</strong>!</p>
-      <p>Sua conta no <strong>AcheTece</strong> está ativa.</p>
-
-      <p style="margin:20px 0">
-        <a href="{magic_link}" style="background:#111;color:#fff;padding:12px 16px;border-radius:10px;text-decoration:none;">
-          Entrar no AcheTece
-        </a>
-      </p>
-
-      <p style="color:#666;font-size:12px">
-        Se você não solicitou isso, ignore esta mensagem.
-      </p>
-    </div>
-    """
+def _send_email(to_email: str, subject: str, text_body: str, html_body: str | None = None):
+    """Compat: enfileira (texto + html) no outbox; não bloqueia o webhook."""
+    if not to_email:
+        app.logger.warning("[EMAIL] destinatário vazio.")
+        return None
+    return email_enfileirar(to_email, subject, html_body or "", text_body or None, tipo="ativacao")
 
 def _serializer():
     salt = os.environ.get("MAGIC_LINK_SALT", "achetece-magic")
@@ -4136,12 +7181,13 @@ def _processar_pagamento(payment_id: str):
         empresa.status_pagamento = "ativo"
         empresa.data_pagamento = datetime.utcnow()
         db.session.commit()
+        catalogo_alterado(reconstruir=True)
     
         # envia e-mail só na transição (evita spam por webhooks repetidos)
         if status_atual != "ativo":
-            link = _make_magic_link(empresa.id)
-            html = _email_ativacao_html(empresa, link)
-            _send_email(empresa.email, "Pagamento aprovado - AcheTece", html)
+            msg = email_render("ativacao", link=_make_magic_link(empresa.id),
+                               nome=(empresa.apelido or empresa.nome or "sua malharia").strip())
+            _send_email(empresa.email, msg.subject, msg.text, msg.html)
     
         return {"ok": True, "empresa_id": empresa.id, "ativou": True}
 
@@ -4149,6 +7195,8 @@ def _processar_pagamento(payment_id: str):
     if status_atual != "ativo":
         empresa.status_pagamento = "pendente"
         db.session.commit()
+        if status_atual != "pendente":
+            catalogo_alterado(reconstruir=True)
 
     return {"ok": True, "empresa_id": empresa.id, "ativou": False, "status": status}
 
@@ -4299,12 +7347,7 @@ def contato():
             erro = "Preencha todos os campos."
         else:
             try:
-                html = render_template_string("""
-                <p>Nome: <strong>{{nome}}</strong></p>
-                <p>E-mail: <strong>{{email}}</strong></p>
-                <hr>
-                <p>{{mensagem}}</p>
-                """, nome=nome, email=email, mensagem=mensagem)
+                msg = email_render("contato", nome=nome, email=email, mensagem=mensagem)
 
                 # destino do formulário de contato (defina CONTACT_TO no Render)
                 contato_to = os.getenv("CONTACT_TO") or os.getenv("EMAIL_FROM") or ""
@@ -4313,9 +7356,10 @@ def contato():
 
                 ok = send_email(
                     to=contato_to,
-                    subject=f"[AcheTece] Novo contato — {nome}",
-                    html=html,
-                    text=f"Nome: {nome}\nE-mail: {email}\n\nMensagem:\n{mensagem}"
+                    subject=msg.subject,
+                    html=msg.html,
+                    text=msg.text,
+                    tipo="contato",
                 )
                 enviado = ok
                 if not ok:
@@ -7,6 +7,7 @@ from werkzeug.security import generate_password_hash
 
 from main import app, db
 from main import Empresa, Tear  # ajuste caso seus modelos estejam em outro módulo
+from main import catalogo_alterado  # avisa a busca da home (índice em memória)
 
 DEMO_TAG = "[DEMO]"
 DEFAULT_DEMO_PASSWORD = "demo123"
@@ -127,6 +128,7 @@ def seed():
                 total_teares += 1
 
         db.session.commit()
+        catalogo_alterado(reconstruir=True)
         print(f">> Teares criados: {total_teares}")
 
     print("✅ SEED DEMO concluído.")
@@ -143,6 +145,7 @@ def clear_demo():
 
         deletadas_empresas = Empresa.query.filter(Empresa.apelido.like(f"{DEMO_TAG}%")).delete(synchronize_session=False)
         db.session.commit()
+        catalogo_alterado(reconstruir=True)
         print(f">> Empresas removidas: {deletadas_empresas}")
 
     print("✅ LIMPEZA DEMO concluída.")
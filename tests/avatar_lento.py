@@ -0,0 +1,14 @@
+# Transformação usada pelos testes do pool de avatares (importada no processo filho).
+import os
+import time
+
+import avatar_imagem
+
+
+def transformar(caminho: str) -> dict:
+    # o teste escreve o atraso desejado num arquivo ao lado do original
+    atraso = caminho + ".atraso"
+    if os.path.exists(atraso):
+        with open(atraso) as f:
+            time.sleep(float(f.read()))
+    return avatar_imagem.transformar_arquivo(caminho)
@@ -0,0 +1,57 @@
+# tests/conftest.py
+# Sobe o app num SQLite temporário, com tarefas periódicas desligadas e
+# diretórios de trabalho fora do repositório.
+import os
+import sys
+import tempfile
+
+import pytest
+
+_TMP = tempfile.mkdtemp(prefix="achetece-tests-")
+os.environ.update({
+    "SQLALCHEMY_DATABASE_URI": f"sqlite:///{_TMP}/t.db",
+    "EXPORT_DIR": os.path.join(_TMP, "export"),
+    "AVATAR_ORIGINAIS_DIR": os.path.join(_TMP, "avatar_originais"),
+    "ANALYTICS_ARQUIVO_DIR": os.path.join(_TMP, "analytics_arquivo"),
+    "ANALYTICS_ROLLUP_SEG": "0",
+    "ANALYTICS_ROLLUP_LAG_SEG": "-1",  # consolida na hora o que os testes acabaram de gravar
+    "ANALYTICS_CICLO_VIDA_SEG": "0",
+    "OTP_LIMPEZA_SEG": "0",
+    "LEMBRETE_INTERVALO_SEG": "0",
+    "AVATAR_SCAN_SEG": "0",
+    "AVATAR_GC_SEG": "0",
+    "EMAIL_OUTBOX_POLL_SEG": "3600",  # os testes chamam o despachante na mão
+    "SQL_COUNT_HEADER": "1",          # X-SQL-Count (tests/test_sql_budgets.py)
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def app():
+    main.app.config.update(TESTING=True, SESSION_COOKIE_DOMAIN=None, SESSION_COOKIE_SECURE=False)
+    with main.app.test_client() as c:
+        c.get("/")  # bootstrap (tabelas, analytics)
+    return main.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def nova_empresa(app):
+    """Fábrica de Empresa mínima; devolve o id."""
+    def criar(**campos) -> int:
+        with app.app_context():
+            n = main.Empresa.query.count() + 1
+            dados = dict(nome=f"Malharia Teste {n}", email=f"teste{n}@exemplo.com", senha="x",
+                         estado="SP", cidade="Americana", status_pagamento="ativo")
+            dados.update(campos)
+            emp = main.Empresa(**dados)
+            main.db.session.add(emp)
+            main.db.session.commit()
+            return emp.id
+    return criar
@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+import main
+
+
+def _contar_eventos(sid: str) -> int:
+    with main.app.app_context(), main.db.engine.connect() as conn:
+        return conn.execute(text("SELECT COUNT(*) FROM analytics_events WHERE session_id = :s"), {"s": sid}).scalar()
+
+
+def test_track_recusa_id_fora_da_faixa(client):
+    r = client.post("/api/track", json={"event": "COMPANY_PROFILE_VIEW", "company_id": 2**70})
+    assert r.status_code == 400
+    assert main._ANALYTICS_WRITER.snapshot()["pendentes"] == 0
+
+
+def test_beacon_ignora_so_o_item_invalido(client, monkeypatch):
+    enfileirados = []
+    monkeypatch.setattr(main._ANALYTICS_WRITER, "put", lambda linha: enfileirados.append(linha) or True)
+    r = client.post("/analytics/event", json=[
+        {"type": "view_company", "company_id": 2**70},
+        {"type": "view_company", "company_id": 7},
+    ])
+    assert r.status_code == 204
+    assert [linha[1] for linha in enfileirados] == [7]
+
+
+def test_lote_com_evento_envenenado_grava_os_demais(app):
+    w = main._AnalyticsWriter()
+    agora = datetime.utcnow()
+    bom = (agora, 1, None, "COMPANY_PROFILE_VIEW", "lote-envenenado", "{}")
+    ruim = (agora, 2**70, None, "COMPANY_PROFILE_VIEW", "lote-envenenado", "{}")
+
+    w._descarregar([bom, ruim, bom])
+
+    assert _contar_eventos("lote-envenenado") == 2
+    snap = w.snapshot()
+    assert snap["pendentes"] == 0
+    assert snap["descartados"] == 1
+
+
+def _inserir_eventos(company_id: int, tear_id: int, n: int, dia: datetime) -> None:
+    with main.app.app_context(), main.db.engine.begin() as conn:
+        conn.execute(
+            text("INSERT INTO analytics_events (ts, company_id, tear_id, event, session_id, meta) "
+                 "VALUES (:ts, :c, :t, 'CARD_IMPRESSION', :s, '{}')"),
+            [{"ts": dia, "c": company_id, "t": tear_id, "s": f"s{i}"} for i in range(n)],
+        )
+
+
+def _marca(nome: str) -> int:
+    with main.app.app_context(), main.db.engine.connect() as conn:
+        return main._analytics_state_get(conn, nome)
+
+
+def test_tabela_por_tear_nova_nao_duplica_historico(app, monkeypatch):
+    ontem = datetime.utcnow() - timedelta(days=1)
+    _inserir_eventos(9013, 901, 3, ontem)
+    _inserir_eventos(9013, 902, 2, ontem - timedelta(days=1))
+    with app.app_context():
+        main.analytics_compactar()
+        antes = main.get_performance(9013)
+        marca = _marca(main._ROLLUP_WM)
+
+        with main.db.engine.begin() as conn:
+            conn.execute(text("DROP TABLE analytics_daily_tear"))
+        main._init_analytics_table()
+
+        assert _marca(main._ROLLUP_WM) == marca
+        assert main.get_performance(9013)[:2] == antes[:2] == (5, 0)
+
+        monkeypatch.setattr(main, "ANALYTICS_BACKFILL_LOTE", 2)
+        lotes = 0
+        while main.analytics_backfill_por_tear().get("pendente"):
+            lotes += 1
+        assert lotes > 1
+        funil = {f["tear_id"]: f["impressoes"] for f in main.get_funil_teares(9013)}
+        assert funil == {901: 3, 902: 2}
+        assert main.get_performance(9013)[:2] == (5, 0)
+
+
+def test_evento_atrasado_de_dia_rotacionado_soma_no_rollup(app):
+    dia = main._mes_inicio(datetime.utcnow(), -1) + timedelta(days=2, hours=10)
+    _inserir_eventos(9012, 911, 3, dia)
+    with app.app_context():
+        main.analytics_compactar()
+        rotacao = main.analytics_ciclo_vida()
+        assert f"analytics_events_{dia:%Y%m}" in rotacao["rotacionadas"]
+
+        _inserir_eventos(9012, 911, 1, dia)  # chega depois da rotação
+        main.analytics_compactar()
+
+        inicio = datetime.combine(dia.date(), datetime.min.time())
+        assert main.get_performance(9012, inicio, inicio + timedelta(days=1))[:2] == (4, 0)
+        assert main.get_funil_teares(9012)[0]["impressoes"] == 4
+
+
+def test_beacon_usa_sid_estavel_por_sessao(app, monkeypatch):
+    sids = []
+    monkeypatch.setattr(main._ANALYTICS_WRITER, "put", lambda linha: sids.append(linha[4]) or True)
+    um, outro = app.test_client(), app.test_client()
+    for c in (um, um, outro):
+        assert c.post("/analytics/event", json={"type": "impression", "company_id": 7}).status_code == 204
+
+    assert sids[0] and sids[0] == sids[1]
+    assert sids[2] and sids[2] != sids[0]
+    with um.session_transaction() as s:
+        assert s["_sid"] == sids[0]
+
+
+def test_ids_menores_gravados_depois_nao_ficam_abaixo_da_marca(app):
+    ontem = datetime.utcnow() - timedelta(days=1)  # ts antigo (lote devolvido à fila)
+
+    def gravar(ids):
+        with main.db.engine.begin() as conn:
+            conn.execute(
+                text("INSERT INTO analytics_events (id, ts, company_id, event, session_id, meta) "
+                     "VALUES (:id, :ts, 9010, 'CARD_IMPRESSION', 's', '{}')"),
+                [{"id": i, "ts": ontem} for i in ids],
+            )
+
+    with app.app_context():
+        main.analytics_compactar()
+        with main.db.engine.connect() as conn:
+            base = conn.execute(text("SELECT MAX(id) FROM analytics_events")).scalar() or 0
+
+        gravar(range(base + 11, base + 21))   # worker A commita primeiro
+        main.analytics_compactar()
+        assert _marca(main._ROLLUP_WM) <= base + 10
+
+        gravar(range(base + 1, base + 11))    # worker B commita depois
+        main.analytics_compactar()
+        assert _marca(main._ROLLUP_WM) == base + 20
+        assert main.get_performance(9010)[0] == 20
@@ -0,0 +1,135 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import avatar_lento
+import main
+
+
+def _jpeg() -> bytes:
+    buf = io.BytesIO()
+    Image.new("RGB", (300, 200), (200, 30, 30)).save(buf, "JPEG")
+    return buf.getvalue()
+
+
+@pytest.fixture
+def pool_avatar(app, tmp_path, monkeypatch):
+    """Pool isolado: 1..N workers, static/ e originais em diretório temporário."""
+    def configurar(workers: int, timeout: float):
+        monkeypatch.setattr(main, "AVATAR_WORKERS", workers)
+        monkeypatch.setattr(main, "AVATAR_TIMEOUT_SEG", timeout)
+        monkeypatch.setattr(main, "_AVATAR_VAGAS", threading.BoundedSemaphore(workers))
+        monkeypatch.setattr(main, "_AVATAR_POOL", None)
+        monkeypatch.setattr(main, "_AVATAR_TRANSFORMAR", avatar_lento.transformar)
+        monkeypatch.setattr(main, "AVATAR_ORIGINAIS_DIR", str(tmp_path / "originais"))
+        monkeypatch.setattr(app, "static_folder", str(tmp_path / "static"))
+        os.makedirs(main.AVATAR_ORIGINAIS_DIR)
+    yield configurar
+    if main._AVATAR_POOL is not None:
+        main._AVATAR_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+def _enviar(empresa_id: int, atraso: float = 0.0):
+    if atraso:
+        with open(main._avatar_original(empresa_id) + ".atraso", "w") as f:
+            f.write(str(atraso))
+    assert main.avatar_processar(empresa_id, _jpeg())
+
+
+def _esperar(*ids, limite: float = 60.0):
+    fim = time.monotonic() + limite
+    while any(main._avatar_pendente(i) for i in ids):
+        assert time.monotonic() < fim, "jobs de avatar não terminaram"
+        time.sleep(0.05)
+
+
+def _foto_url(app, empresa_id: int):
+    with app.app_context():
+        return main.db.session.get(main.Empresa, empresa_id).foto_url
+
+
+def test_tempo_na_fila_nao_conta_para_o_timeout(app, client, pool_avatar, nova_empresa):
+    pool_avatar(workers=1, timeout=4.0)
+    lento, rapido = nova_empresa(), nova_empresa()
+
+    _enviar(lento, atraso=60)
+    _enviar(rapido)  # espera a vaga do lento (~4s) e ainda assim termina
+    _esperar(lento, rapido)
+
+    assert _foto_url(app, lento) is None
+    assert main.avatar_hash(_foto_url(app, rapido))
+    assert sorted(os.listdir(main.AVATAR_ORIGINAIS_DIR)) == [f"empresa_{lento}.falha", f"empresa_{lento}.img.atraso"]
+
+    # a falha aparece no painel até a próxima foto
+    assert main.avatar_falha(lento) == "timeout" and main.avatar_falha(rapido) is None
+    with client.session_transaction() as s:
+        s["empresa_id"] = lento
+    assert "Falha ao processar a foto".encode() in client.get("/painel_malharia").data
+    os.remove(main._avatar_original(lento) + ".atraso")
+    _enviar(lento)
+    assert main.avatar_falha(lento) is None
+    _esperar(lento)
+    assert main.avatar_hash(_foto_url(app, lento))
+    assert "Falha ao processar a foto".encode() not in client.get("/painel_malharia").data
+
+
+def test_job_derrubado_junto_com_o_pool_e_reenviado(app, pool_avatar, nova_empresa):
+    pool_avatar(workers=2, timeout=5.0)
+    lento, vizinho = nova_empresa(), nova_empresa()
+
+    _enviar(lento, atraso=60)
+    time.sleep(2.0)
+    _enviar(vizinho, atraso=3.5)  # ainda rodando quando o pool do lento é reciclado
+    _esperar(lento, vizinho)
+
+    assert _foto_url(app, lento) is None
+    assert main.avatar_hash(_foto_url(app, vizinho))
+
+
+def test_gc_conta_carencia_da_troca_da_foto(app, nova_empresa, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "static_folder", str(tmp_path / "static"))
+    empresa_id = nova_empresa()
+    with app.app_context():
+        main._avatar_finalizar(empresa_id, {"400.jpg": b"foto-antiga", "400.webp": b"a"})
+        antigo = main.avatar_hash(main.db.session.get(main.Empresa, empresa_id).foto_url)
+        pasta = tmp_path / "static" / main.AVATAR_CAS_PASTA
+        dois_dias = time.time() - 2 * 86400
+        for p in pasta.glob(f"{antigo}-*"):
+            os.utime(p, (dois_dias, dois_dias))  # blob criado há muito tempo
+
+        main._avatar_finalizar(empresa_id, {"400.jpg": b"foto-nova", "400.webp": b"b"})
+        main.db.session.remove()
+        assert main.avatar_gc()["apagados"] == 0
+        assert len(list(pasta.glob(f"{antigo}-*"))) == 2
+
+        monkeypatch.setattr(main, "AVATAR_GC_CARENCIA_SEG", -1)
+        main.avatar_gc()
+        assert not list(pasta.glob(f"{antigo}-*"))
+
+
+def test_falha_ao_carregar_hashes_espera_antes_de_tentar_de_novo(app, monkeypatch):
+    indice = main._AvatarIndice()
+    tentativas = []
+    carregar = indice.carregar_hashes
+
+    def falhar():
+        tentativas.append(1)
+        if len(tentativas) == 1:
+            raise RuntimeError("banco fora")
+        return carregar()
+
+    monkeypatch.setattr(indice, "carregar_hashes", falhar)
+    monkeypatch.setattr(main, "AVATAR_HASHES_RETRY_SEG", 0.3)
+    assert indice.garantir_hashes() is False
+    assert indice.garantir_hashes() is False
+    assert len(tentativas) == 1 and not indice.hashes_prontos
+
+    time.sleep(0.4)
+    with app.app_context():
+        assert indice.garantir_hashes() is True
+    assert len(tentativas) == 2 and indice.hashes_prontos
+    assert indice.garantir_hashes() is True and len(tentativas) == 2
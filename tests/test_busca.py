@@ -0,0 +1,65 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+
+
+def _novo_tear(app, empresa_id) -> int:
+    with app.app_context():
+        t = main.Tear(marca="Mayer", modelo="MV4", tipo="MONO", finura=28, diametro=30,
+                      alimentadores=90, elastano="Sim", empresa_id=empresa_id)
+        main.db.session.add(t)
+        main.db.session.commit()
+        tid = t.id
+    with app.test_request_context():
+        main.catalogo_alterado(reconstruir=True)
+    return tid
+
+
+def _ids_api(client):
+    r = client.get("/api/teares?pp=100")
+    assert r.status_code == 200
+    return {c["id"] for c in r.get_json()["resultados"]}, r.headers["ETag"]
+
+
+@pytest.mark.parametrize("memoria", [True, False])
+def test_assinatura_vencida_some_da_busca_sem_outra_alteracao(app, client, nova_empresa, monkeypatch, memoria):
+    monkeypatch.setattr(main, "BUSCA_INDICE_MEMORIA", memoria)
+    monkeypatch.setattr(main, "BUSCA_INDICE_CHECK_SEG", 0)
+    # vence daqui a ~1,5 s
+    pago_em = datetime.utcnow() - timedelta(days=main.ASSINATURA_DIAS_MENSAL) + timedelta(seconds=1.5)
+    vencendo = _novo_tear(app, nova_empresa(plano="mensal", data_pagamento=pago_em))
+    em_dia = _novo_tear(app, nova_empresa(plano="mensal", data_pagamento=datetime.utcnow()))
+    pendente = _novo_tear(app, nova_empresa(status_pagamento="pendente"))
+
+    ids, etag = _ids_api(client)
+    assert {vencendo, em_dia} <= ids
+    assert pendente not in ids
+
+    time.sleep(2)
+    ids2, etag2 = _ids_api(client)
+    assert vencendo not in ids2
+    assert em_dia in ids2
+    assert etag2 != etag  # ETag (e a chave dos jobs de exportação) acompanham a versão
+
+
+@pytest.mark.parametrize("payload", [{"a": "x"}, {"a": [1]}, {"b": None}, {"fim": "sim"}, {"a": 1, "b": 2}, []])
+def test_cursor_fora_do_formato_e_cursor_invalido(app, client, payload):
+    token = main.cursor_encode(payload)
+    assert main.cursor_decode(token) is None
+
+    assert client.get(f"/api/teares?cursor={token}").status_code == 400
+    r = client.get(f"/?cursor={token}")
+    assert r.status_code == 200 and b"offline" not in r.data.lower()
+
+    with client.session_transaction() as s:
+        s["admin_email"] = "gestao.achetece@gmail.com"
+    assert client.get(f"/admin/empresas?cursor={token}").status_code == 200
+
+
+def test_cursor_admin_nome_id(app):
+    token = main.cursor_encode({"a": ["Malharia", 3]})
+    assert main.cursor_decode(token, formato=(str, int)) == {"a": ["Malharia", 3]}
+    assert main.cursor_decode(token) is None
@@ -0,0 +1,105 @@
+import time
+
+import pytest
+
+import main
+
+
+def _provedor_unico(monkeypatch, fn, taxa: float):
+    cb = main._Disjuntor("fake")
+    balde = main._BaldeTokens(taxa, 1)
+    monkeypatch.setattr(main, "_provedores_por_saude", lambda: [("fake", fn)])
+    monkeypatch.setitem(main._EMAIL_DISJUNTORES, "fake", cb)
+    monkeypatch.setitem(main._EMAIL_LIMITES, "fake", balde)
+    monkeypatch.setattr(main, "EMAIL_RL_ESPERA_MAX_SEG", 0)
+    return cb, balde
+
+
+def test_meio_aberto_sem_ficha_nao_prende_a_prova(app, monkeypatch):
+    enviados = []
+    cb, balde = _provedor_unico(monkeypatch, lambda *a: (enviados.append(a) or True, "OK"), taxa=0.001)
+    cb.estado = "meio_aberto"
+    balde._fichas = 0  # limite de taxa esgotado
+
+    with app.app_context():
+        ok, _, motivo = main._entregar_email("a@exemplo.com", "assunto", "<p>oi</p>")
+    assert not ok and "limite_de_taxa" in motivo
+    assert cb.estado == "meio_aberto" and not cb._prova_em_curso
+
+    balde._fichas = 1  # ficha de volta: a prova acontece e fecha o circuito
+    with app.app_context():
+        ok, via, _ = main._entregar_email("a@exemplo.com", "assunto", "<p>oi</p>")
+    assert ok and via == "fake"
+    assert cb.estado == "fechado"
+    assert len(enviados) == 1
+
+
+def test_lote_longo_nao_reenvia_mensagem_com_lease_renovado(app, monkeypatch):
+    monkeypatch.setattr(main._EMAIL_DESPACHANTE, "acordar", lambda: None)
+    monkeypatch.setattr(main, "EMAIL_LEASE_SEG", 1)
+    outro_worker = main._EmailDespachante()
+    envios = []
+
+    def entregar(to, subject, html, text=None):
+        envios.append(to)
+        if to == "a@exemplo.com":
+            time.sleep(0.6)
+        elif envios.count(to) == 1:
+            time.sleep(0.5)  # o lote já passou do lease da reivindicação; outro worker varre a fila
+            outro_worker.processar_lote()
+        return True, "fake", "OK"
+
+    monkeypatch.setattr(main, "_entregar_email", entregar)
+    with app.app_context():
+        main.email_enfileirar("a@exemplo.com", "1", "<p>1</p>", tipo="teste")
+        main.email_enfileirar("b@exemplo.com", "2", "<p>2</p>", tipo="teste")
+        assert main._EmailDespachante().processar_lote() == 2
+
+    assert envios == ["a@exemplo.com", "b@exemplo.com"]
+
+
+class _SmtpFalso:
+    def __init__(self, rset_ok=True, erro_envio=None):
+        self.rset_ok, self.erro_envio = rset_ok, erro_envio
+        self.enviadas = 0
+
+    def rset(self):
+        if not self.rset_ok:
+            raise main.smtplib.SMTPServerDisconnected("caiu")
+        return (250, b"OK")
+
+    def send_message(self, msg):
+        self.enviadas += 1
+        if self.erro_envio:
+            raise self.erro_envio
+
+    def quit(self):
+        pass
+
+
+def _pool_com(app, monkeypatch, reusada, nova):
+    pool = main._SmtpPool()
+    abertas = iter([nova])
+    monkeypatch.setattr(pool, "_abrir", lambda chave: [next(abertas), chave, time.monotonic(), time.monotonic(), 0])
+    with app.app_context():
+        pool._livres.append([reusada, pool._chave(), time.monotonic(), time.monotonic(), 0])
+    return pool
+
+
+def test_smtp_conexao_morta_no_rset_abre_outra(app, monkeypatch):
+    morta, nova = _SmtpFalso(rset_ok=False), _SmtpFalso()
+    pool = _pool_com(app, monkeypatch, morta, nova)
+    with app.app_context():
+        pool.enviar(main.EmailMessage())
+    assert (morta.enviadas, nova.enviadas) == (0, 1)
+    assert pool.snapshot()["descartadas"] == 1
+
+
+def test_smtp_queda_depois_do_rset_nao_reenvia(app, monkeypatch):
+    reusada = _SmtpFalso(erro_envio=main.smtplib.SMTPServerDisconnected("caiu após DATA"))
+    nova = _SmtpFalso()
+    pool = _pool_com(app, monkeypatch, reusada, nova)
+    with app.app_context(), pytest.raises(main.smtplib.SMTPServerDisconnected):
+        pool.enviar(main.EmailMessage())  # vai para o backoff do outbox
+    assert (reusada.enviadas, nova.enviadas) == (1, 0)
+    assert pool.snapshot()["livres"] == 0
@@ -0,0 +1,30 @@
+import main
+
+
+def _post(client, ip: str, **dados):
+    return client.post("/exportar/jobs", json=dados, environ_base={"REMOTE_ADDR": ip})
+
+
+def test_job_aceita_valores_json_nao_texto(client):
+    r = _post(client, "10.7.0.1", formato="csv.gz", galga=28, diametro=30.5, estado=["SP"], cidade=None)
+    assert r.status_code in (200, 202)
+    job = main._export_status(r.get_json()["id"])
+    assert job["filtros"]["galga"] == "28" and job["filtros"]["estado"] == ""
+
+
+def test_job_lista_json_nao_quebra(client):
+    r = client.post("/exportar/jobs", json=[1, 2], environ_base={"REMOTE_ADDR": "10.7.0.2"})
+    assert r.status_code in (200, 202)
+
+
+def test_job_limitado_por_ip(client, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_RL_IP", (2, 3600))
+    codigos = [_post(client, "10.7.0.3", galga=str(g)).status_code for g in (1, 2, 3)]
+    assert 429 not in codigos[:2] and codigos[2] == 429
+    assert _post(client, "10.7.0.4", galga="3").status_code != 429  # outro IP segue livre
+
+
+def test_fila_cheia_recusa_job_novo(client, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_FILA_MAX", 0)
+    r = _post(client, "10.7.0.5", cidade="Fila Cheia")
+    assert r.status_code == 503 and r.headers["Retry-After"]
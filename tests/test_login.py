@@ -0,0 +1,13 @@
+import main
+
+
+def test_ip_do_otp_ignora_x_forwarded_for_forjado(client, nova_empresa, monkeypatch):
+    nova_empresa(email="ip@exemplo.com")
+    ips = []
+    monkeypatch.setattr(main, "_otp_send", lambda email, ip="", ua="": ips.append(ip) or (True, "ok"))
+
+    # cliente manda um XFF próprio; o proxy (1 hop) acrescenta o IP real
+    client.post("/login/codigo", data={"email": "ip@exemplo.com"},
+                headers={"X-Forwarded-For": "6.6.6.6, 203.0.113.9"},
+                environ_base={"REMOTE_ADDR": "10.0.0.2"})
+    assert ips == ["203.0.113.9"]
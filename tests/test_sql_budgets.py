@@ -0,0 +1,49 @@
+import pytest
+
+import main
+
+
+def _sql(resp) -> int:
+    return int(resp.headers["X-SQL-Count"])
+
+
+@pytest.fixture
+def catalogo(app, nova_empresa):
+    """Algumas empresas com vários teares (N+1 apareceria como N statements)."""
+    for _ in range(3):
+        empresa_id = nova_empresa()
+        with app.app_context():
+            for finura in (18, 24, 28, 32):
+                main.db.session.add(main.Tear(marca="Mayer", modelo="MV4", tipo="MONO", finura=finura,
+                                              diametro=30, alimentadores=90, elastano="Sim",
+                                              empresa_id=empresa_id))
+            main.db.session.commit()
+    with app.test_request_context():
+        main.catalogo_alterado(reconstruir=True)
+    return empresa_id
+
+
+@pytest.mark.parametrize("memoria", [True, False])
+@pytest.mark.parametrize("rota,endpoint", [("/", "index"), ("/api/teares", "api_teares")])
+def test_busca_dentro_do_orcamento(client, catalogo, monkeypatch, memoria, rota, endpoint):
+    monkeypatch.setattr(main, "BUSCA_INDICE_MEMORIA", memoria)
+    for url in (rota, rota + "?galga=28", rota + "?estado=SP&pp=2"):
+        r = client.get(url)
+        assert r.status_code == 200
+        assert _sql(r) <= main.SQL_BUDGETS[endpoint], url
+
+
+def test_api_teares_304_so_le_a_versao(client, catalogo):
+    r = client.get("/api/teares")
+    r2 = client.get("/api/teares", headers={"If-None-Match": r.headers["ETag"]})
+    assert r2.status_code == 304
+    assert _sql(r2) <= 1
+
+
+def test_painel_malharia_dentro_do_orcamento(client, catalogo):
+    with client.session_transaction() as s:
+        s["empresa_id"] = catalogo
+    client.get("/painel_malharia")  # 1ª vez cria o Usuario espelho
+    r = client.get("/painel_malharia")
+    assert r.status_code == 200
+    assert _sql(r) <= main.SQL_BUDGETS["painel_malharia"]